@@ -1,12 +1,32 @@
-from flask import Flask, render_template, request, jsonify, abort, Response, session, redirect, url_for
-import os, json, datetime, csv
+from flask import Flask, render_template, request, jsonify, abort, Response, session, redirect, url_for, g, has_request_context
+from flask.json.provider import DefaultJSONProvider
+import os, json, datetime, csv, math, time, threading, zlib, queue, select, gzip, hashlib, secrets, sqlite3
+import click
 from zoneinfo import ZoneInfo
-from io import StringIO
+from collections import OrderedDict
+from decimal import Decimal
+from io import StringIO, BytesIO
+from html import escape
 import psycopg2
 import psycopg2.extras
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
 import urllib.parse
+from reportlab.lib import colors
+from reportlab.lib.enums import TA_CENTER
+from reportlab.lib.pagesizes import A5
+from reportlab.lib.styles import ParagraphStyle
+from reportlab.lib.units import mm
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.platypus import (
+    SimpleDocTemplate, Paragraph, Table, TableStyle, Spacer, PageBreak
+)
+
+try:
+    import brotli  # optional: br responses when installed
+except ImportError:
+    brotli = None
 
 # ================= APP =================
 app = Flask(__name__, template_folder="templates")
@@ -19,204 +39,1498 @@ def now():
 
 def now_ist():
     return datetime.datetime.now(ZoneInfo("Asia/Kolkata"))
+
+def fmt_date(v):
+    # native date columns -> the text format the API has always used
+    if isinstance(v, datetime.datetime):
+        return v.astimezone(ZoneInfo("Asia/Kolkata")).strftime("%Y-%m-%d %H:%M:%S")
+    if isinstance(v, datetime.date):
+        return v.isoformat()
+    return v
+
+class JSONProvider(DefaultJSONProvider):
+    @staticmethod
+    def default(o):
+        if isinstance(o, (datetime.date, datetime.datetime)):
+            return fmt_date(o)
+        return DefaultJSONProvider.default(o)
+
+    def response(self, *args, **kwargs):
+        t = time.perf_counter()
+        resp = super().response(*args, **kwargs)
+        perf_add("serialize_s", time.perf_counter() - t)
+        return resp
+
+app.json = JSONProvider(app)
+
+# Urgent: 24 hours, Regular / Rework: 10 days
+OVERDUE_WHERE = """
+    status != 'Delivered'
+    AND receive_date <= now() - interval '24 hours'
+    AND (
+        receive_date <= now() - interval '10 days'
+        OR btrim(priority) = 'Urgent'
+    )
+"""
+
 def get_overdue_entries():
 
     conn = get_db()
     cur = conn.cursor()
 
-    cur.execute("""
+    cur.execute(f"""
         SELECT *
         FROM entries
-        WHERE status != 'Delivered'
+        WHERE {OVERDUE_WHERE}
+        ORDER BY receive_date
     """)
 
     rows = cur.fetchall()
 
     cur.close()
-    conn.close()
 
-    current_time = now_ist()
-    overdue_rows = []
+    return rows
 
-    for r in rows:
-
-        if not r["receive_date"]:
-            continue
-
-        try:
-            receive_time = datetime.datetime.strptime(
-                r["receive_date"],
-                "%Y-%m-%d %H:%M:%S"
-            ).replace(
-                tzinfo=ZoneInfo("Asia/Kolkata")
-            )
-        except:
-            continue
-
-        age = current_time - receive_time
-
-        priority = (r["priority"] or "Regular").strip()
-
-        if priority == "Urgent":
-            limit = datetime.timedelta(hours=24)
-        else:
-            limit = datetime.timedelta(days=10)
+# ================= AUTH HELPERS ================
+# role -> permissions, checked against the cached session (no DB hit)
+ROLE_PERMISSIONS = {
+    "admin": {"entries.delete", "users.manage", "jobs.all", "admin.db"},
+    "staff": set()
+}
 
-        if age >= limit:
-            overdue_rows.append(r)
+def can(permission):
+    user = current_user()
+    return user is not None and permission in ROLE_PERMISSIONS.get(user["role"], ())
 
-    return overdue_rows
-# ================= AUTH HELPERS ================
 def login_required(fn):
     @wraps(fn)
     def wrapper(*args, **kwargs):
-        if "user_id" not in session:
+        if current_user() is None:
             return redirect(url_for("login"))
         return fn(*args, **kwargs)
     return wrapper
 
-def admin_required(fn):
-    @wraps(fn)
-    def wrapper(*args, **kwargs):
-        if session.get("role") != "admin":
-            return jsonify({"error": "Admin only"}), 403
-        return fn(*args, **kwargs)
-    return wrapper
+def permission_required(permission):
+    def deco(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not can(permission):
+                return jsonify({"error": "Not allowed"}), 403
+            return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+# ================= DATABASE =================
+# Pool settings (per worker process)
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 10))
+DB_POOL_MIN_IDLE = int(os.environ.get("DB_POOL_MIN_IDLE", 1))
+DB_POOL_MAX_LIFETIME = float(os.environ.get("DB_POOL_MAX_LIFETIME", 1800))
+DB_POOL_IDLE_TIMEOUT = float(os.environ.get("DB_POOL_IDLE_TIMEOUT", 300))
+DB_POOL_HEALTH_CHECK = float(os.environ.get("DB_POOL_HEALTH_CHECK", 30))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 10))
+DB_SSLMODE = os.environ.get("DB_SSLMODE", "require")
+DB_CONNECT_TIMEOUT = int(os.environ.get("DB_CONNECT_TIMEOUT", 5))
+DB_RETRY_AFTER = float(os.environ.get("DB_RETRY_AFTER", 10))
+
+class TimedCursor(psycopg2.extras.RealDictCursor):
+    """RealDictCursor that reports query time and row counts (see METRICS)."""
+
+    def execute(self, query, vars=None):
+        t = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record_query(self, query, time.perf_counter() - t)
 
-# ================= DATABASE =================   
-def get_db():
+    def executemany(self, query, vars_list):
+        t = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            record_query(self, query, time.perf_counter() - t)
+
+def connect():
     db_url = os.environ.get("DATABASE_URL")
     if not db_url:
         raise RuntimeError("DATABASE_URL not set")
 
     return psycopg2.connect(
         db_url,
-        sslmode="require",
-        cursor_factory=psycopg2.extras.RealDictCursor
+        sslmode=DB_SSLMODE,
+        options="-c timezone=Asia/Kolkata",
+        connect_timeout=DB_CONNECT_TIMEOUT,
+        cursor_factory=TimedCursor
+    )
+
+class PoolTimeout(Exception):
+    pass
+
+class DatabaseOffline(Exception):
+    pass
+
+class DBLink:
+    """
+    Is Postgres reachable from this process? After a failed connect
+    get_db() fails fast for retry_after seconds instead of every request
+    sitting out the connect timeout; then a single request probes again.
+    """
+
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._retry_at = 0.0
+        self.down_since = None
+        self.on_reconnect = []   # callbacks, run by the first request back
+
+    def may_try(self):
+        if self.down_since is None:
+            return True
+        with self._lock:
+            if time.monotonic() < self._retry_at:
+                return False
+            # the others keep failing fast while this request probes
+            self._retry_at = time.monotonic() + self.retry_after
+            return True
+
+    def failed(self):
+        with self._lock:
+            if self.down_since is None:
+                self.down_since = time.time()
+                print("database unreachable, failing fast")
+            self._retry_at = time.monotonic() + self.retry_after
+
+    def succeeded(self):
+        with self._lock:
+            was_down, self.down_since = self.down_since is not None, None
+        if was_down:
+            print("database reachable again")
+            for fn in self.on_reconnect:
+                fn()
+
+db_link = DBLink(DB_RETRY_AFTER)
+
+class DBPool:
+    """
+    Thread-safe connection pool.
+    Idle connections are pinged before reuse if they sat longer than
+    health_check seconds, and are retired after max_lifetime seconds.
+    """
+
+    def __init__(self, size, min_idle, max_lifetime, idle_timeout,
+                 health_check, timeout):
+        self.size = size
+        self.min_idle = min_idle
+        self.max_lifetime = max_lifetime
+        self.idle_timeout = idle_timeout
+        self.health_check = health_check
+        self.timeout = timeout
+
+        self._cond = threading.Condition()
+        self._idle = []        # [(conn, last_used)]
+        self._born = {}        # id(conn) -> created time
+        self._in_use = 0
+        self._waiting = 0
+
+        self._opened = 0
+        self._closed = 0
+        self._timeouts = 0
+        self._checkouts = 0
+        self._checkout_total = 0.0
+        self._checkout_max = 0.0
+
+    # ---- checkout ----
+    def getconn(self):
+        start = time.monotonic()
+
+        with self._cond:
+            if not self._idle and self._in_use >= self.size:
+                self._waiting += 1
+                try:
+                    while not self._idle and self._in_use >= self.size:
+                        remaining = start + self.timeout - time.monotonic()
+                        if remaining <= 0:
+                            self._timeouts += 1
+                            raise PoolTimeout(
+                                f"no free DB connection after {self.timeout}s"
+                            )
+                        self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+
+            item = self._idle.pop() if self._idle else None
+            self._in_use += 1
+
+        try:
+            conn = self._usable(item)
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        elapsed = time.monotonic() - start
+        with self._cond:
+            self._checkouts += 1
+            self._checkout_total += elapsed
+            self._checkout_max = max(self._checkout_max, elapsed)
+
+        return conn
+
+    def _usable(self, item):
+        if item:
+            conn, last_used = item
+            t = time.monotonic()
+
+            if conn.closed or t - self._born.get(id(conn), t) > self.max_lifetime:
+                self._discard(conn)
+            elif t - last_used > self.health_check and not self._ping(conn):
+                self._discard(conn)
+            else:
+                return conn
+
+        conn = connect()
+        with self._cond:
+            self._born[id(conn)] = time.monotonic()
+            self._opened += 1
+        return conn
+
+    def _ping(self, conn):
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._born.pop(id(conn), None)
+            self._closed += 1
+
+    # ---- return ----
+    def putconn(self, conn, discard=False):
+        if not conn.closed and not discard:
+            try:
+                status = conn.info.transaction_status
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    discard = True
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+
+        t = time.monotonic()
+        if (
+            discard or conn.closed
+            or t - self._born.get(id(conn), t) > self.max_lifetime
+        ):
+            self._discard(conn)
+            conn = None
+
+        stale = []
+        with self._cond:
+            self._in_use -= 1
+            if conn is not None:
+                self._idle.append((conn, t))
+
+            # close connections idle too long, keeping min_idle warm
+            while (
+                len(self._idle) > self.min_idle
+                and t - self._idle[0][1] > self.idle_timeout
+            ):
+                stale.append(self._idle.pop(0)[0])
+
+            self._cond.notify()
+
+        for c in stale:
+            self._discard(c)
+
+    # ---- stats ----
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self.size,
+                "min_idle": self.min_idle,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+                "opened": self._opened,
+                "closed": self._closed,
+                "timeouts": self._timeouts,
+                "checkouts": self._checkouts,
+                "checkout_avg_ms": round(
+                    self._checkout_total / self._checkouts * 1000, 3
+                ) if self._checkouts else 0,
+                "checkout_max_ms": round(self._checkout_max * 1000, 3)
+            }
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    # gunicorn forks workers: every process gets its own pool
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = DBPool(
+                    DB_POOL_SIZE,
+                    DB_POOL_MIN_IDLE,
+                    DB_POOL_MAX_LIFETIME,
+                    DB_POOL_IDLE_TIMEOUT,
+                    DB_POOL_HEALTH_CHECK,
+                    DB_POOL_TIMEOUT
+                )
+                _pool_pid = os.getpid()
+    return _pool
+
+def get_db():
+    # one pooled connection per request, returned on teardown
+    if "db" not in g:
+        if not db_link.may_try():
+            raise DatabaseOffline("database unreachable")
+        t = time.perf_counter()
+        try:
+            g.db = get_pool().getconn()
+        except psycopg2.OperationalError as e:
+            db_link.failed()
+            raise DatabaseOffline(str(e).strip()) from e
+        if db_link.down_since is not None:
+            db_link.succeeded()
+        perf_add("pool_wait_s", time.perf_counter() - t)
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exc):
+    conn = g.pop("db", None)
+    if conn is not None:
+        get_pool().putconn(conn)
+
+@app.errorhandler(PoolTimeout)
+def pool_timeout(e):
+    return jsonify({"error": "Server busy, try again"}), 503
+
+@app.errorhandler(DatabaseOffline)
+def database_offline(e):
+    # GET APIs fall back to the last copy seen (see OFFLINE)
+    resp = offline_read()
+    if resp is not None:
+        return resp
+    return jsonify({"error": "Database offline, try again shortly", "offline": True}), 503
+
+@app.errorhandler(psycopg2.OperationalError)
+def database_lost(e):
+    conn = g.get("db")
+    if conn is None or not conn.closed:
+        raise e
+    # the link dropped mid-request
+    db_link.failed()
+    return jsonify({"error": "Database connection lost, try again", "offline": True}), 503
+
+# ================= MIGRATIONS =================
+# Versioned schema changes, applied in order and recorded in
+# schema_migrations. Each migration gets the connection so long
+# backfills can commit in batches and resume after an interruption.
+MIGRATIONS = []
+MIGRATION_LOCK = 7301  # pg advisory lock key
+BACKFILL_BATCH_SIZE = int(os.environ.get("BACKFILL_BATCH_SIZE", 5000))
+
+def migration(version, name):
+    def register(fn):
+        MIGRATIONS.append((version, name, fn))
+        return fn
+    return register
+
+def migrate(conn, log=print):
+    cur = conn.cursor()
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS schema_migrations(
+        version INTEGER PRIMARY KEY,
+        name TEXT,
+        applied_at TIMESTAMPTZ DEFAULT now()
     )
-def init_db():
+    """)
+    conn.commit()
+
+    # several workers may boot at once
+    migration_lock(conn, True)
     try:
-        conn = get_db()
-        cur = conn.cursor()
+        cur.execute("SELECT version FROM schema_migrations")
+        done = {r["version"] for r in cur.fetchall()}
+        conn.commit()
+
+        for version, name, fn in sorted(MIGRATIONS):
+            if version in done:
+                continue
+            log(f"Migration {version}: {name}")
+            fn(conn)
+            cur.execute(
+                "INSERT INTO schema_migrations(version,name) VALUES(%s,%s)",
+                (version, name)
+            )
+            conn.commit()
+
+        ensure_indexes(conn, log)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        migration_lock(conn, False)
+
+MIGRATION_LOCK_POLL = 0.5
+
+def migration_lock(conn, take):
+    """
+    Take / release MIGRATION_LOCK outside any transaction. Waiters poll
+    pg_try_advisory_lock: a backend blocked inside pg_advisory_lock holds
+    a snapshot, and the holder's CREATE INDEX CONCURRENTLY would wait for
+    it forever.
+    """
+    conn.commit()
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        if not take:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK,))
+            return
+        while True:
+            cur.execute("SELECT pg_try_advisory_lock(%s) ok", (MIGRATION_LOCK,))
+            if cur.fetchone()["ok"]:
+                return
+            time.sleep(MIGRATION_LOCK_POLL)
+    finally:
+        cur.close()
+        conn.autocommit = autocommit
+
+@migration(1, "base schema")
+def m001_base_schema(conn):
+    cur = conn.cursor()
+
+    # ---- USERS ----
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS users(
+        id SERIAL PRIMARY KEY,
+        username TEXT UNIQUE,
+        password_hash TEXT,
+        role TEXT
+    )
+    """)
+
+    # ---- ENTRIES ----
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS entries(
+        id SERIAL PRIMARY KEY,
+        type TEXT, customer TEXT, phone TEXT, model TEXT, problem TEXT,
+        receive_date TEXT,
+        out_date TEXT,
+        in_date TEXT,
+        ready_date TEXT,
+        return_date TEXT,
+        reject_date TEXT,
+        status TEXT,
+        bill_json TEXT
+    )
+    """)
+    cur.execute("""
+        ALTER TABLE entries
+        ADD COLUMN IF NOT EXISTS priority TEXT DEFAULT 'Regular'
+    """)
+
+    # ---- SALES ----
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS sales(
+        id SERIAL PRIMARY KEY,
+        sale_date TEXT,
+        item TEXT,
+        qty REAL,
+        rate REAL,
+        amount REAL,
+        payment_mode TEXT,
+        note TEXT
+    )
+    """)
+
+    # ---- CUSTOMERS ----
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS customers(
+        id SERIAL PRIMARY KEY,
+        name TEXT,
+        mobile TEXT UNIQUE,
+        address TEXT
+    )
+    """)
+
+    # ---- LEDGER ----
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS ledger(
+        id SERIAL PRIMARY KEY,
+        customer_id INTEGER,
+        entry_date TEXT,
+        remark TEXT,
+        dr REAL DEFAULT 0,
+        cr REAL DEFAULT 0
+    )
+    """)
+
+    # ---- INK ----
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS ink_master(
+        id SERIAL PRIMARY KEY,
+        ink_name TEXT UNIQUE
+    )
+    """)
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS ink_stock(
+        ink_id INTEGER PRIMARY KEY,
+        qty INTEGER DEFAULT 0,
+        updated_at TEXT
+    )
+    """)
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS ink_transactions(
+        id SERIAL PRIMARY KEY,
+        ink_id INTEGER,
+        ink_name TEXT,
+        qty INTEGER,
+        action TEXT,
+        action_date TEXT
+    )
+    """)
+
+    cur.close()
+
+@migration(2, "entries.receive_at for overdue checks")
+def m002_receive_at(conn):
+    cur = conn.cursor()
+    cur.execute("""
+        ALTER TABLE entries
+        ADD COLUMN IF NOT EXISTS receive_at TIMESTAMPTZ
+    """)
+    cur.close()
+
+# ---------- TEXT dates -> native types ----------
+# table -> (key column, [(column, native type)])
+NATIVE_DATE_COLUMNS = {
+    "entries": ("id", [
+        ("receive_date", "TIMESTAMPTZ"),
+        ("out_date", "TIMESTAMPTZ"),
+        ("in_date", "TIMESTAMPTZ"),
+        ("ready_date", "TIMESTAMPTZ"),
+        ("return_date", "TIMESTAMPTZ"),
+        ("reject_date", "TIMESTAMPTZ")
+    ]),
+    "sales": ("id", [("sale_date", "TIMESTAMPTZ")]),
+    "ledger": ("id", [("entry_date", "DATE")]),
+    "ink_stock": ("ink_id", [("updated_at", "TIMESTAMPTZ")]),
+    "ink_transactions": ("id", [("action_date", "TIMESTAMPTZ")])
+}
+
+def _shadow(table, col):
+    # receive_at already exists since migration 2
+    if (table, col) == ("entries", "receive_date"):
+        return "receive_at"
+    return col + "_native"
+
+def _column_type(cur, table, col):
+    cur.execute("""
+        SELECT data_type FROM information_schema.columns
+        WHERE table_schema = current_schema()
+          AND table_name = %s AND column_name = %s
+    """, (table, col))
+    r = cur.fetchone()
+    return r["data_type"] if r else None
+
+def _prepare_native_dates(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS migration_progress(
+        name TEXT PRIMARY KEY,
+        last_key BIGINT DEFAULT 0,
+        done BOOLEAN DEFAULT FALSE,
+        updated_at TIMESTAMPTZ DEFAULT now()
+    )
+    """)
+
+    # values that could not be parsed are kept here instead of lost
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS legacy_date_values(
+        table_name TEXT,
+        row_key BIGINT,
+        column_name TEXT,
+        value TEXT
+    )
+    """)
+
+    cur.execute("""
+    CREATE OR REPLACE FUNCTION it_parse_ts(v TEXT) RETURNS TIMESTAMPTZ
+    LANGUAGE plpgsql STABLE AS $$
+    BEGIN
+        IF v IS NULL OR btrim(v) = '' THEN
+            RETURN NULL;
+        END IF;
+        RETURN btrim(v)::timestamp AT TIME ZONE 'Asia/Kolkata';
+    EXCEPTION WHEN others THEN
+        RETURN NULL;
+    END
+    $$
+    """)
+
+    cur.execute("""
+    CREATE OR REPLACE FUNCTION it_parse_date(v TEXT) RETURNS DATE
+    LANGUAGE plpgsql STABLE AS $$
+    BEGIN
+        IF v IS NULL OR btrim(v) = '' THEN
+            RETURN NULL;
+        END IF;
+        RETURN left(btrim(v), 10)::date;
+    EXCEPTION WHEN others THEN
+        RETURN NULL;
+    END
+    $$
+    """)
 
-        # ---- USERS ----
+    for table, (key, cols) in NATIVE_DATE_COLUMNS.items():
+        if _column_type(cur, table, cols[0][0]) != "text":
+            continue  # already converted
+
+        sets = []
+        for col, typ in cols:
+            shadow = _shadow(table, col)
+            parse = "it_parse_date" if typ == "DATE" else "it_parse_ts"
+            cur.execute(
+                f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {shadow} {typ}"
+            )
+            sets.append(f"NEW.{shadow} := {parse}(NEW.{col});")
+
+        # keep shadow columns in sync with writes while the backfill runs
+        cur.execute(f"""
+        CREATE OR REPLACE FUNCTION {table}_native_dates() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            {" ".join(sets)}
+            RETURN NEW;
+        END
+        $$
+        """)
+        cur.execute(f"DROP TRIGGER IF EXISTS {table}_native_dates ON {table}")
+        cur.execute(f"""
+            CREATE TRIGGER {table}_native_dates
+            BEFORE INSERT OR UPDATE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION {table}_native_dates()
+        """)
+
+def backfill_native_dates(conn, batch_size=BACKFILL_BATCH_SIZE, log=print):
+    """
+    Fill the shadow columns batch by batch, committing after each one.
+    Progress is kept in migration_progress, so a rerun resumes.
+    """
+    cur = conn.cursor()
+    _prepare_native_dates(cur)
+    conn.commit()
+
+    for table, (key, cols) in NATIVE_DATE_COLUMNS.items():
+        if _column_type(cur, table, cols[0][0]) != "text":
+            continue
+
+        name = f"native_dates:{table}"
         cur.execute("""
-        CREATE TABLE IF NOT EXISTS users(
-            id SERIAL PRIMARY KEY,
-            username TEXT UNIQUE,
-            password_hash TEXT,
-            role TEXT
+            INSERT INTO migration_progress(name) VALUES(%s)
+            ON CONFLICT (name) DO NOTHING
+        """, (name,))
+        cur.execute(
+            "SELECT last_key, done FROM migration_progress WHERE name=%s",
+            (name,)
+        )
+        p = cur.fetchone()
+        conn.commit()
+
+        last_key, done = p["last_key"], p["done"]
+        sets = ", ".join(
+            f"{_shadow(table, col)} = "
+            f"{'it_parse_date' if typ == 'DATE' else 'it_parse_ts'}(t.{col})"
+            for col, typ in cols
         )
+
+        while not done:
+            cur.execute(f"""
+                WITH batch AS (
+                    SELECT {key} FROM {table}
+                    WHERE {key} > %s
+                    ORDER BY {key}
+                    LIMIT %s
+                )
+                UPDATE {table} t SET {sets}
+                FROM batch WHERE t.{key} = batch.{key}
+                RETURNING t.{key} k
+            """, (last_key, batch_size))
+            keys = [r["k"] for r in cur.fetchall()]
+
+            if keys:
+                last_key = max(keys)
+            done = len(keys) < batch_size
+
+            cur.execute("""
+                UPDATE migration_progress
+                SET last_key=%s, done=%s, updated_at=now()
+                WHERE name=%s
+            """, (last_key, done, name))
+            conn.commit()
+
+        log(f"{table}: backfilled up to {key}={last_key}")
+
+    cur.close()
+
+@migration(3, "native timestamp/date columns")
+def m003_native_dates(conn):
+    backfill_native_dates(conn)
+
+    cur = conn.cursor()
+    for table, (key, cols) in NATIVE_DATE_COLUMNS.items():
+        if _column_type(cur, table, cols[0][0]) != "text":
+            continue
+
+        # the trigger kept rows written during the backfill in sync
+        cur.execute(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE")
+
+        for col, typ in cols:
+            shadow = _shadow(table, col)
+            cur.execute(f"""
+                INSERT INTO legacy_date_values(
+                    table_name, row_key, column_name, value
+                )
+                SELECT %s, {key}, %s, {col}
+                FROM {table}
+                WHERE btrim(COALESCE({col}, '')) != ''
+                  AND {shadow} IS NULL
+            """, (table, col))
+
+        cur.execute(f"DROP TRIGGER {table}_native_dates ON {table}")
+        cur.execute(f"DROP FUNCTION {table}_native_dates()")
+
+        for col, typ in cols:
+            cur.execute(f"ALTER TABLE {table} DROP COLUMN {col}")
+            cur.execute(
+                f"ALTER TABLE {table} RENAME COLUMN {_shadow(table, col)} TO {col}"
+            )
+
+    cur.execute("DROP FUNCTION IF EXISTS it_parse_ts(TEXT)")
+    cur.execute("DROP FUNCTION IF EXISTS it_parse_date(TEXT)")
+    cur.close()
+
+@migration(4, "customer search columns and indexes")
+def m004_customer_search(conn):
+    cur = conn.cursor()
+    cur.execute("""
+        ALTER TABLE customers
+        ADD COLUMN IF NOT EXISTS name_norm TEXT
+            GENERATED ALWAYS AS (lower(btrim(name))) STORED,
+        ADD COLUMN IF NOT EXISTS mobile_digits TEXT
+            GENERATED ALWAYS AS (
+                right(regexp_replace(mobile, '[^0-9]', '', 'g'), 10)
+            ) STORED
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS customers_name_prefix
+        ON customers(name_norm text_pattern_ops)
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS customers_mobile_prefix
+        ON customers(mobile_digits text_pattern_ops)
+    """)
+
+    # substring search needs pg_trgm; without it search falls back to prefixes
+    cur.execute("SAVEPOINT trgm")
+    try:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS customers_name_trgm
+            ON customers USING gin(name_norm gin_trgm_ops)
         """)
+        cur.execute("RELEASE SAVEPOINT trgm")
+    except psycopg2.Error as e:
+        cur.execute("ROLLBACK TO SAVEPOINT trgm")
+        print("pg_trgm not available, name search is prefix only:", e)
+    cur.close()
+
+@migration(5, "customer ledger balances")
+def m005_customer_balances(conn):
+    cur = conn.cursor()
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS customer_balances(
+        customer_id INTEGER PRIMARY KEY,
+        balance NUMERIC(14,2) NOT NULL DEFAULT 0,
+        updated_at TIMESTAMPTZ DEFAULT now()
+    )
+    """)
+
+    cur.execute("LOCK TABLE ledger IN SHARE MODE")
+    cur.execute("""
+        INSERT INTO customer_balances(customer_id, balance)
+        SELECT customer_id, COALESCE(SUM(cr),0) - COALESCE(SUM(dr),0)
+        FROM ledger
+        WHERE customer_id IS NOT NULL
+        GROUP BY customer_id
+        ON CONFLICT (customer_id) DO UPDATE SET balance = EXCLUDED.balance
+    """)
+
+    # history is paged on (entry_date, id): undated rows sort first
+    cur.execute("""
+        UPDATE ledger SET entry_date = DATE '1970-01-01'
+        WHERE entry_date IS NULL
+    """)
+    # the old add_ledger stored NULL for "dr": null / "cr": null
+    cur.execute("""
+        UPDATE ledger SET dr = COALESCE(dr, 0), cr = COALESCE(cr, 0)
+        WHERE dr IS NULL OR cr IS NULL
+    """)
+    cur.execute("""
+        ALTER TABLE ledger
+        ALTER COLUMN entry_date SET DEFAULT CURRENT_DATE,
+        ALTER COLUMN entry_date SET NOT NULL,
+        ALTER COLUMN dr SET NOT NULL,
+        ALTER COLUMN cr SET NOT NULL
+    """)
+    cur.close()
+
+CHANGE_CHANNEL = "app_changes"
+CHANGE_FEED_TABLES = {"entries": "id", "ink_stock": "ink_id", "sales": "id"}
+
+@migration(6, "change feed triggers")
+def m006_change_feed(conn):
+    cur = conn.cursor()
+    # payload stays tiny (8000 byte NOTIFY limit): the listener reads the row
+    cur.execute(f"""
+    CREATE OR REPLACE FUNCTION notify_change() RETURNS trigger AS $$
+    DECLARE
+        r RECORD;
+    BEGIN
+        IF TG_OP = 'DELETE' THEN r := OLD; ELSE r := NEW; END IF;
+        PERFORM pg_notify('{CHANGE_CHANNEL}', json_build_object(
+            'table', TG_TABLE_NAME,
+            'op', lower(TG_OP),
+            'id', to_jsonb(r) -> TG_ARGV[0]
+        )::text);
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """)
+    for table, pk in CHANGE_FEED_TABLES.items():
+        cur.execute(f"DROP TRIGGER IF EXISTS {table}_notify ON {table}")
+        cur.execute(f"""
+            CREATE TRIGGER {table}_notify
+            AFTER INSERT OR UPDATE OR DELETE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION notify_change('{pk}')
+        """)
+    cur.close()
+
+@migration(7, "change versions for conditional GET")
+def m007_change_versions(conn):
+    cur = conn.cursor()
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS change_versions(
+        name TEXT PRIMARY KEY,
+        version BIGINT NOT NULL DEFAULT 0
+    )
+    """)
+    cur.close()
+
+@migration(8, "typed bill columns")
+def m008_bill_columns(conn):
+    cur = conn.cursor()
+    cur.execute("""
+        ALTER TABLE entries
+        ADD COLUMN IF NOT EXISTS bill_parts NUMERIC(12,2),
+        ADD COLUMN IF NOT EXISTS bill_service NUMERIC(12,2),
+        ADD COLUMN IF NOT EXISTS bill_other NUMERIC(12,2),
+        ADD COLUMN IF NOT EXISTS billed_at TIMESTAMPTZ,
+        ADD COLUMN IF NOT EXISTS bill_total NUMERIC(12,2)
+            GENERATED ALWAYS AS (bill_parts + bill_service + bill_other) STORED
+    """)
 
-        # ---- ENTRIES ----
+    cur.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'entries' AND column_name = 'bill_json'
+    """)
+    if cur.fetchone():
         cur.execute("""
-        CREATE TABLE IF NOT EXISTS entries(
-            id SERIAL PRIMARY KEY,
-            type TEXT, customer TEXT, phone TEXT, model TEXT, problem TEXT,
-            receive_date TEXT,
-            out_date TEXT,
-            in_date TEXT,
-            ready_date TEXT,
-            return_date TEXT,
-            reject_date TEXT,
-            status TEXT,
-            bill_json TEXT
-        )
+        CREATE OR REPLACE FUNCTION pg_temp.it_bill(v TEXT) RETURNS JSONB
+        LANGUAGE plpgsql IMMUTABLE AS $$
+        BEGIN
+            RETURN v::jsonb;
+        EXCEPTION WHEN others THEN
+            RETURN NULL;
+        END
+        $$
         """)
-        # ---- ADD PRIORITY COLUMN IF NOT EXISTS ----
         cur.execute("""
-            ALTER TABLE entries
-            ADD COLUMN IF NOT EXISTS priority TEXT DEFAULT 'Regular'
+        CREATE OR REPLACE FUNCTION pg_temp.it_bill_num(b JSONB, k TEXT)
+        RETURNS NUMERIC LANGUAGE plpgsql IMMUTABLE AS $$
+        BEGIN
+            RETURN COALESCE(round((b ->> k)::numeric, 2), 0);
+        EXCEPTION WHEN others THEN
+            RETURN 0;
+        END
+        $$
         """)
 
-        # ---- SALES ----
+        # bills that are not JSON objects are kept here instead of lost
         cur.execute("""
-        CREATE TABLE IF NOT EXISTS sales(
-            id SERIAL PRIMARY KEY,
-            sale_date TEXT,
-            item TEXT,
-            qty REAL,
-            rate REAL,
-            amount REAL,
-            payment_mode TEXT,
-            note TEXT
+        CREATE TABLE IF NOT EXISTS legacy_bill_json(
+            entry_id INTEGER,
+            value TEXT
         )
         """)
-
-        # ---- CUSTOMERS ----
         cur.execute("""
-        CREATE TABLE IF NOT EXISTS customers(
-            id SERIAL PRIMARY KEY,
-            name TEXT,
-            mobile TEXT UNIQUE,
-            address TEXT
-        )
+            INSERT INTO legacy_bill_json(entry_id, value)
+            SELECT id, bill_json FROM entries
+            WHERE btrim(COALESCE(bill_json, '')) NOT IN ('', '{}')
+              AND jsonb_typeof(pg_temp.it_bill(bill_json)) IS DISTINCT FROM 'object'
         """)
 
-        # ---- LEDGER ----
+        # bill time: the sale save_bill wrote for it, else the entry's dates
         cur.execute("""
-        CREATE TABLE IF NOT EXISTS ledger(
-            id SERIAL PRIMARY KEY,
-            customer_id INTEGER,
-            entry_date TEXT,
-            remark TEXT,
-            dr REAL DEFAULT 0,
-            cr REAL DEFAULT 0
-        )
+            UPDATE entries e SET
+                bill_parts = pg_temp.it_bill_num(b.j, 'parts_total'),
+                bill_service = pg_temp.it_bill_num(b.j, 'service_charge'),
+                bill_other = pg_temp.it_bill_num(b.j, 'other'),
+                billed_at = COALESCE(
+                    (SELECT max(s.sale_date) FROM sales s
+                     WHERE s.note = 'Entry ' || e.id),
+                    e.return_date, e.ready_date, e.receive_date
+                )
+            FROM (
+                SELECT id, pg_temp.it_bill(bill_json) j FROM entries
+                WHERE bill_json IS NOT NULL
+            ) b
+            WHERE e.id = b.id
+              AND jsonb_typeof(b.j) = 'object'
+              AND b.j != '{}'::jsonb
         """)
+        cur.execute("ALTER TABLE entries DROP COLUMN bill_json")
+    cur.close()
 
-        # ---- INK ----
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS ink_master(
-            id SERIAL PRIMARY KEY,
-            ink_name TEXT UNIQUE
+@migration(9, "sales.entry_id, daily sales rollup, idempotency keys")
+def m009_sales_rollup(conn):
+    cur = conn.cursor()
+    cur.execute("LOCK TABLE sales IN SHARE ROW EXCLUSIVE MODE")
+
+    cur.execute("""
+        ALTER TABLE sales
+        ADD COLUMN IF NOT EXISTS entry_id INTEGER
+            REFERENCES entries(id) ON DELETE SET NULL
+    """)
+    cur.execute("""
+        UPDATE sales s SET entry_id = e.id
+        FROM entries e
+        WHERE s.entry_id IS NULL
+          AND s.note ~ '^Entry [0-9]{1,9}$'
+          AND e.id = substring(s.note FROM 7)::int
+    """)
+
+    # re-saved bills used to add a sale each time: keep the latest one,
+    # the older copies move here
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS legacy_duplicate_sales
+        (LIKE sales INCLUDING DEFAULTS)
+    """)
+    cur.execute("""
+        WITH dup AS (
+            DELETE FROM sales s
+            WHERE s.entry_id IS NOT NULL
+              AND s.id < (SELECT max(id) FROM sales x WHERE x.entry_id = s.entry_id)
+            RETURNING s.*
         )
+        INSERT INTO legacy_duplicate_sales SELECT * FROM dup
+    """)
+    cur.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS sales_entry_id
+        ON sales(entry_id)
+    """)
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS sales_daily(
+        day DATE,
+        payment_mode TEXT,
+        amount NUMERIC(14,2) NOT NULL DEFAULT 0,
+        sale_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(day, payment_mode)
+    )
+    """)
+    cur.execute("""
+    CREATE OR REPLACE FUNCTION sales_daily_apply() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.sale_date IS NOT NULL THEN
+            UPDATE sales_daily
+            SET amount = amount - COALESCE(OLD.amount, 0),
+                sale_count = sale_count - 1
+            WHERE day = (OLD.sale_date AT TIME ZONE 'Asia/Kolkata')::date
+              AND payment_mode = COALESCE(OLD.payment_mode, '');
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.sale_date IS NOT NULL THEN
+            INSERT INTO sales_daily(day, payment_mode, amount, sale_count)
+            VALUES (
+                (NEW.sale_date AT TIME ZONE 'Asia/Kolkata')::date,
+                COALESCE(NEW.payment_mode, ''),
+                COALESCE(NEW.amount, 0),
+                1
+            )
+            ON CONFLICT (day, payment_mode) DO UPDATE
+            SET amount = sales_daily.amount + EXCLUDED.amount,
+                sale_count = sales_daily.sale_count + 1;
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """)
+    cur.execute("DROP TRIGGER IF EXISTS sales_daily_apply ON sales")
+    cur.execute("""
+        CREATE TRIGGER sales_daily_apply
+        AFTER INSERT OR DELETE OR UPDATE OF sale_date, amount, payment_mode
+        ON sales
+        FOR EACH ROW EXECUTE FUNCTION sales_daily_apply()
+    """)
+    cur.execute("TRUNCATE sales_daily")
+    cur.execute("""
+        INSERT INTO sales_daily(day, payment_mode, amount, sale_count)
+        SELECT (sale_date AT TIME ZONE 'Asia/Kolkata')::date,
+               COALESCE(payment_mode, ''),
+               COALESCE(SUM(amount), 0),
+               COUNT(*)
+        FROM sales
+        WHERE sale_date IS NOT NULL
+        GROUP BY 1, 2
+    """)
+
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS idempotency_keys(
+        key TEXT,
+        route TEXT,
+        status INTEGER,
+        response TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY(key, route)
+    )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idempotency_keys_created_at
+        ON idempotency_keys(created_at)
+    """)
+    cur.close()
+
+@migration(10, "background jobs")
+def m010_jobs(conn):
+    cur = conn.cursor()
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS jobs(
+        id BIGSERIAL PRIMARY KEY,
+        kind TEXT NOT NULL,
+        params JSONB NOT NULL DEFAULT '{}',
+        status TEXT NOT NULL DEFAULT 'queued',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        progress_done BIGINT NOT NULL DEFAULT 0,
+        progress_total BIGINT,
+        message TEXT,
+        error TEXT,
+        result BYTEA,
+        result_name TEXT,
+        result_type TEXT,
+        created_by INTEGER,
+        worker TEXT,
+        run_after TIMESTAMPTZ NOT NULL DEFAULT now(),
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        started_at TIMESTAMPTZ,
+        heartbeat_at TIMESTAMPTZ,
+        finished_at TIMESTAMPTZ
+    )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS jobs_pending
+        ON jobs(id) WHERE status IN ('queued', 'running')
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS jobs_finished_at
+        ON jobs(finished_at)
+    """)
+    cur.close()
+
+AUTH_CHANNEL = "auth_changes"
+
+@migration(11, "server-side sessions, user active flag")
+def m011_sessions(conn):
+    cur = conn.cursor()
+    cur.execute("""
+        ALTER TABLE users
+        ADD COLUMN IF NOT EXISTS active BOOLEAN NOT NULL DEFAULT true,
+        ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ DEFAULT now()
+    """)
+    # id is sha256 of the cookie token, the token itself is never stored
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS sessions(
+        id TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        last_seen_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        expires_at TIMESTAMPTZ NOT NULL,
+        ip TEXT,
+        user_agent TEXT
+    )
+    """)
+    # every worker evicts its cached sessions of that user, also for
+    # changes made straight in SQL
+    cur.execute(f"""
+    CREATE OR REPLACE FUNCTION notify_auth_change() RETURNS trigger AS $$
+    DECLARE
+        uid INTEGER;
+    BEGIN
+        IF TG_TABLE_NAME = 'users' THEN uid := OLD.id; ELSE uid := OLD.user_id; END IF;
+        PERFORM pg_notify('{AUTH_CHANNEL}', uid::text);
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """)
+    cur.execute("DROP TRIGGER IF EXISTS sessions_auth_notify ON sessions")
+    cur.execute("""
+        CREATE TRIGGER sessions_auth_notify
+        AFTER DELETE ON sessions
+        FOR EACH ROW EXECUTE FUNCTION notify_auth_change()
+    """)
+    cur.execute("DROP TRIGGER IF EXISTS users_auth_notify ON users")
+    cur.execute("""
+        CREATE TRIGGER users_auth_notify
+        AFTER UPDATE OF role, active, password_hash OR DELETE ON users
+        FOR EACH ROW EXECUTE FUNCTION notify_auth_change()
+    """)
+    cur.close()
+
+@migration(12, "entry status history")
+def m012_entry_events(conn):
+    cur = conn.cursor()
+    # from_status NULL: entry created, to_status NULL: entry deleted.
+    # No FK on entry_id, history outlives the entry.
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS entry_events(
+        id BIGSERIAL PRIMARY KEY,
+        entry_id INTEGER NOT NULL,
+        from_status TEXT,
+        to_status TEXT,
+        at TIMESTAMPTZ NOT NULL,
+        user_id INTEGER,
+        recorded_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+    """)
+    cur.execute("""
+    CREATE OR REPLACE FUNCTION entry_events_append_only() RETURNS trigger AS $$
+    BEGIN
+        RAISE EXCEPTION 'entry_events is append-only';
+    END
+    $$ LANGUAGE plpgsql
+    """)
+    cur.execute("DROP TRIGGER IF EXISTS entry_events_append_only ON entry_events")
+    cur.execute("""
+        CREATE TRIGGER entry_events_append_only
+        BEFORE UPDATE OR DELETE ON entry_events
+        FOR EACH STATEMENT EXECUTE FUNCTION entry_events_append_only()
+    """)
+    backfill_entry_events(cur)
+    cur.close()
+
+@migration(13, "analytics materialized views")
+def m013_analytics(conn):
+    cur = conn.cursor()
+    # lower bound of a turnaround histogram bucket, in hours: hourly for
+    # two days, 6-hourly to a week, daily to 60 days (see hours_bucket_mid)
+    cur.execute("""
+    CREATE OR REPLACE FUNCTION analytics_hours_bucket(h DOUBLE PRECISION)
+    RETURNS INTEGER AS $$
+        SELECT CASE
+            WHEN h < 48 THEN floor(h)
+            WHEN h < 168 THEN 48 + floor((h - 48) / 6) * 6
+            WHEN h < 1440 THEN 168 + floor((h - 168) / 24) * 24
+            ELSE 1440
+        END::int
+    $$ LANGUAGE sql IMMUTABLE
+    """)
+    # receive -> ready (or delivered, when Ready was skipped). Counts per
+    # bucket add up across months, so any range gets a median.
+    cur.execute("""
+    CREATE MATERIALIZED VIEW IF NOT EXISTS analytics_turnaround AS
+    SELECT date_trunc('month', receive_date AT TIME ZONE 'Asia/Kolkata')::date AS month,
+           COALESCE(NULLIF(btrim(type), ''), 'Other') AS type,
+           COALESCE(NULLIF(btrim(priority), ''), 'Regular') AS priority,
+           analytics_hours_bucket(hours) AS bucket,
+           COUNT(*) AS jobs,
+           SUM(hours) AS sum_hours
+    FROM (
+        SELECT receive_date, type, priority,
+               EXTRACT(EPOCH FROM COALESCE(ready_date, return_date) - receive_date) / 3600 AS hours
+        FROM entries
+        WHERE receive_date IS NOT NULL
+          AND COALESCE(ready_date, return_date) >= receive_date
+    ) t
+    GROUP BY 1, 2, 3, 4
+    """)
+    cur.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS analytics_turnaround_key
+        ON analytics_turnaround(month, type, priority, bucket)
+    """)
+    # jobs in / out per week, by the date of each step
+    cur.execute("""
+    CREATE MATERIALIZED VIEW IF NOT EXISTS analytics_volume AS
+    SELECT date_trunc('week', at AT TIME ZONE 'Asia/Kolkata')::date AS week,
+           COALESCE(NULLIF(btrim(type), ''), 'Other') AS type,
+           COALESCE(NULLIF(btrim(priority), ''), 'Regular') AS priority,
+           COUNT(*) FILTER (WHERE step = 'received') AS received,
+           COUNT(*) FILTER (WHERE step = 'delivered') AS delivered,
+           COUNT(*) FILTER (WHERE step = 'rejected') AS rejected
+    FROM (
+        SELECT receive_date AS at, type, priority, 'received' AS step
+        FROM entries WHERE receive_date IS NOT NULL
+        UNION ALL
+        SELECT return_date, type, priority, 'delivered'
+        FROM entries WHERE status = 'Delivered' AND return_date IS NOT NULL
+        UNION ALL
+        SELECT reject_date, type, priority, 'rejected'
+        FROM entries WHERE status = 'Rejected' AND reject_date IS NOT NULL
+    ) t
+    GROUP BY 1, 2, 3
+    """)
+    cur.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS analytics_volume_key
+        ON analytics_volume(week, type, priority)
+    """)
+    # status changes per user per week (backfilled history has no user)
+    cur.execute("""
+    CREATE MATERIALIZED VIEW IF NOT EXISTS analytics_throughput AS
+    SELECT date_trunc('week', at AT TIME ZONE 'Asia/Kolkata')::date AS week,
+           user_id,
+           to_status AS status,
+           COUNT(*) AS events
+    FROM entry_events
+    WHERE user_id IS NOT NULL AND to_status IS NOT NULL
+    GROUP BY 1, 2, 3
+    """)
+    cur.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS analytics_throughput_key
+        ON analytics_throughput(week, user_id, status)
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS analytics_refreshes(
+        view TEXT PRIMARY KEY,
+        source_version BIGINT NOT NULL,
+        refreshed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        seconds DOUBLE PRECISION
+    )
+    """)
+    cur.close()
+
+def backfill_entry_events(cur, min_id=None):
+    # history rebuilt from the date columns of entries that have none;
+    # only the latest date per status survives there, so reworks are lost
+    cur.execute("""
+        INSERT INTO entry_events(entry_id, from_status, to_status, at, recorded_at)
+        SELECT id, lag(status) OVER w, status, at, at
+        FROM (
+            SELECT e.id, v.status, v.at, v.n
+            FROM entries e
+            CROSS JOIN LATERAL (VALUES
+                (1, 'Received', e.receive_date),
+                (2, 'Out', e.out_date),
+                (3, 'In', e.in_date),
+                (4, 'Ready', e.ready_date),
+                (5, 'Rejected', e.reject_date),
+                (6, 'Delivered', e.return_date)
+            ) v(n, status, at)
+            WHERE v.at IS NOT NULL
+              AND e.id >= %s
+              AND NOT EXISTS (SELECT 1 FROM entry_events x WHERE x.entry_id = e.id)
+        ) s
+        WINDOW w AS (PARTITION BY id ORDER BY at, n)
+        ORDER BY id, at, n
+    """, (min_id or 0,))
+    return cur.rowcount
+
+# ---------- secondary indexes ----------
+# name -> definition (after ON). The only place these indexes are
+# declared: migrate() creates missing ones, rebuilds any whose definition
+# changed here and drops RETIRED_INDEXES.
+INDEXES = {
+    # pending count, overdue list / count (OVERDUE_WHERE)
+    "entries_open_receive_date": "entries(receive_date) WHERE status != 'Delivered'",
+    # dashboard warnings (Out / Ready), status filters on /api/entries
+    "entries_open_status_id": "entries(status, id) WHERE status != 'Delivered'",
+    # OUT list and WhatsApp report, newest out_date first
+    "entries_out_out_date": "entries(out_date) WHERE status = 'Out'",
+    # /api/entries?phone= prefix filter
+    "entries_phone_prefix": "entries(phone text_pattern_ops)",
+    "entries_billed_at": "entries(billed_at) WHERE billed_at IS NOT NULL",
+    # /api/sales keyset order, and with a payment mode filter
+    "sales_sale_date_id": "sales(sale_date, id)",
+    "sales_payment_mode_date": "sales(payment_mode, sale_date, id)",
+    "ledger_customer_date_id": "ledger(customer_id, entry_date, id)",
+    "ink_transactions_action_date": "ink_transactions(action_date)",
+    # revoke all sessions of a user
+    "sessions_user_id": "sessions(user_id)",
+    # per-entry timeline, and the time-window feed on /api/activity
+    "entry_events_entry_at": "entry_events(entry_id, at, id)",
+    "entry_events_at": "entry_events(at, id)"
+}
+# names dropped by the next db-upgrade (renamed or no longer needed)
+RETIRED_INDEXES = ()
+
+def index_tag(definition):
+    return "index:" + hashlib.sha1(definition.encode()).hexdigest()[:12]
+
+def build_index(cur, name, definition, log, attempts=2):
+    # a failed concurrent build leaves an INVALID index behind: drop it
+    # and try again
+    for attempt in range(1, attempts + 1):
+        try:
+            cur.execute(f"CREATE INDEX CONCURRENTLY {name} ON {definition}")
+            return
+        except psycopg2.Error as e:
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+            if attempt == attempts:
+                raise
+            log(f"Index {name}: build failed, retrying: {str(e).splitlines()[0]}")
+
+def ensure_indexes(conn, log=print):
+    # CONCURRENTLY: a db-upgrade on a live shop does not block writes
+    conn.commit()
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            SELECT c.relname AS name, i.indisvalid AS valid,
+                   obj_description(c.oid, 'pg_class') AS tag
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relnamespace = current_schema()::regnamespace
         """)
+        existing = {r["name"]: r for r in cur.fetchall()}
+
+        for name in RETIRED_INDEXES:
+            if name in existing:
+                log(f"Index {name}: drop")
+                cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+        for name, definition in INDEXES.items():
+            tag = index_tag(definition)
+            r = existing.get(name)
+            if r and r["valid"] and r["tag"] == tag:
+                continue
+            if r:
+                # changed definition, or left invalid by a failed build
+                log(f"Index {name}: rebuild")
+                cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+            else:
+                log(f"Index {name}: create")
+            build_index(cur, name, definition, log)
+            cur.execute(f"COMMENT ON INDEX {name} IS %s", (tag,))
+    finally:
+        cur.close()
+        conn.autocommit = autocommit
+
+@app.cli.command("db-backfill")
+@click.option("--batch-size", default=BACKFILL_BATCH_SIZE, show_default=True)
+def db_backfill_command(batch_size):
+    """Pre-fill native date columns ahead of migration 3 (resumable)."""
+    conn = connect()
+    backfill_native_dates(conn, batch_size, log=click.echo)
+    conn.close()
+
+SCHEMA_VERSION = max(v for v, _, _ in MIGRATIONS)
+DB_AUTO_UPGRADE = os.environ.get("DB_AUTO_UPGRADE") == "1"
+_schema_ok = False
+_schema_checked_at = None
+
+def schema_version(cur):
+    cur.execute("SELECT to_regclass('schema_migrations') t")
+    if cur.fetchone()["t"] is None:
+        return 0
+    cur.execute("SELECT COALESCE(MAX(version),0) v FROM schema_migrations")
+    return cur.fetchone()["v"]
+
+@app.before_request
+def check_schema():
+    # one cheap query per worker; DDL only runs from the CLI
+    global _schema_ok, _schema_checked_at
+    if _schema_ok:
+        return None
+    if _schema_checked_at and time.monotonic() - _schema_checked_at < 30:
+        return schema_outdated()
+
+    try:
+        cur = get_db().cursor()
+    except DatabaseOffline:
+        return None   # checked once the database is back
+    version = schema_version(cur)
+    cur.close()
+    get_db().commit()   # concurrent index builds wait on open transactions
+
+    if version < SCHEMA_VERSION and DB_AUTO_UPGRADE:
+        conn = connect()
+        migrate(conn)
+        conn.close()
+        version = SCHEMA_VERSION
 
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS ink_stock(
-            ink_id INTEGER PRIMARY KEY,
-            qty INTEGER DEFAULT 0,
-            updated_at TEXT
-        )
-        """)
+    _schema_checked_at = time.monotonic()
+    _schema_ok = version >= SCHEMA_VERSION
+    if not _schema_ok:
+        print(f"DB schema at version {version}, app needs {SCHEMA_VERSION}")
+        return schema_outdated()
 
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS ink_transactions(
-            id SERIAL PRIMARY KEY,
-            ink_id INTEGER,
-            ink_name TEXT,
-            qty INTEGER,
-            action TEXT,
-            action_date TEXT
-        )
-        """)
+def schema_outdated():
+    return jsonify({
+        "error": "Database schema out of date. Run: flask --app app db-upgrade"
+    }), 503
 
-        # ---- DEFAULT ADMIN ----
-        cur.execute("SELECT COUNT(*) c FROM users")
-        if cur.fetchone()["c"] == 0:
-            cur.execute(
-                "INSERT INTO users(username,password_hash,role) VALUES(%s,%s,%s)",
-                ("admin", generate_password_hash("admin@123"), "admin")
-            )
+@app.cli.command("db-upgrade")
+def db_upgrade_command():
+    """Apply pending schema migrations."""
+    conn = connect()
+    cur = conn.cursor()
+    before = schema_version(cur)
+    conn.commit()
 
-        conn.commit()
-        cur.close()
-        conn.close()
+    migrate(conn, log=click.echo)
+
+    click.echo(f"Schema version {before} -> {schema_version(cur)}")
+    cur.close()
+    conn.close()
 
-        print("DB init done")
+@app.cli.command("db-init")
+@click.option("--admin-password", default="admin@123", show_default=True)
+def db_init_command(admin_password):
+    """Create / upgrade the schema and add the default admin user."""
+    conn = connect()
+    migrate(conn, log=click.echo)
 
-    except Exception as e:
-        print("DB init skipped:", e)
-   
-    
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) c FROM users")
+    if cur.fetchone()["c"] == 0:
+        cur.execute(
+            "INSERT INTO users(username,password_hash,role) VALUES(%s,%s,%s)",
+            ("admin", generate_password_hash(admin_password), "admin")
+        )
+        click.echo("Created user: admin")
+    conn.commit()
+
+    click.echo(f"Schema version {schema_version(cur)}")
+    cur.close()
+    conn.close()
 
-init_db()
-        
-        
-        
-               
 
 # ================= LOGIN =================
 @app.route("/login", methods=["GET","POST"])
@@ -230,11 +1544,9 @@ def login():
         cur.execute("SELECT * FROM users WHERE username=%s", (u,))
         user = cur.fetchone()
         cur.close()
-        conn.close()
 
-        if user and check_password_hash(user["password_hash"], p):
-            session["user_id"] = user["id"]
-            session["role"] = user["role"]
+        if user and user["active"] and check_password_hash(user["password_hash"], p):
+            start_session(user["id"])
             return redirect(url_for("dashboard"))
 
         return render_template("login.html", error="Invalid login")
@@ -243,9 +1555,150 @@ def login():
 
 @app.route("/logout")
 def logout():
-    session.clear()
+    end_session()
     return redirect(url_for("login"))
 
+# ================= USERS =================
+PASSWORD_MIN_LENGTH = 6
+
+@app.context_processor
+def auth_context():
+    # templates: {% if can("users.manage") %}
+    return {"can": can}
+
+def create_user(username, password, role):
+    """Returns an error message, or None when the user was added."""
+    username = (username or "").strip()
+    if not username or not password:
+        return "Username aur password dono chahiye"
+    if len(password) < PASSWORD_MIN_LENGTH:
+        return f"Password kam se kam {PASSWORD_MIN_LENGTH} characters ka ho"
+    if role not in ROLE_PERMISSIONS:
+        return "Invalid role"
+
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO users(username, password_hash, role)
+        VALUES(%s, %s, %s)
+        ON CONFLICT (username) DO NOTHING
+        RETURNING id
+    """, (username, generate_password_hash(password), role))
+    added = cur.fetchone()
+    conn.commit()
+    cur.close()
+    return None if added else "Username already exists"
+
+def render_users(msg=None):
+    cur = get_db().cursor()
+    cur.execute("""
+        SELECT u.id, u.username, u.role, u.active,
+               COUNT(s.id) FILTER (WHERE s.expires_at > now()) AS sessions,
+               MAX(s.last_seen_at) AS last_seen
+        FROM users u
+        LEFT JOIN sessions s ON s.user_id = u.id
+        GROUP BY u.id
+        ORDER BY u.id
+    """)
+    users = cur.fetchall()
+    cur.close()
+    for u in users:
+        u["last_seen"] = fmt_date(u["last_seen"])
+    return render_template(
+        "users.html", users=users, roles=ROLE_PERMISSIONS, msg=msg,
+        me=current_user()["id"]
+    )
+
+@app.route("/users", methods=["GET", "POST"])
+@login_required
+@permission_required("users.manage")
+def users_page():
+    msg = None
+    if request.method == "POST":
+        f = request.form
+        msg = create_user(f.get("username"), f.get("password"), f.get("role")) or "User added"
+    return render_users(msg)
+
+@app.post("/users/<int:uid>")
+@login_required
+@permission_required("users.manage")
+def update_user(uid):
+    """action = role | activate | deactivate | revoke (log out everywhere)"""
+    action = request.form.get("action")
+    if uid == current_user()["id"] and action != "revoke":
+        # apne aap ko lock out na kar dein
+        return render_users("Apna role / status khud nahi badal sakte")
+
+    conn = get_db()
+    cur = conn.cursor()
+    if action == "role":
+        role = request.form.get("role")
+        if role not in ROLE_PERMISSIONS:
+            cur.close()
+            return render_users("Invalid role")
+        cur.execute("UPDATE users SET role=%s WHERE id=%s", (role, uid))
+    elif action in ("activate", "deactivate"):
+        cur.execute(
+            "UPDATE users SET active=%s WHERE id=%s",
+            (action == "activate", uid)
+        )
+        if action == "deactivate":
+            revoke_sessions(cur, uid)
+    elif action == "revoke":
+        revoke_sessions(cur, uid, keep=session.get("sid"))
+    else:
+        cur.close()
+        return render_users("Unknown action")
+    conn.commit()
+    cur.close()
+    evict_user_sessions(uid)
+    return render_users("Saved")
+
+@app.route("/add-staff", methods=["GET", "POST"])
+@login_required
+@permission_required("users.manage")
+def add_staff():
+    msg = None
+    if request.method == "POST":
+        f = request.form
+        msg = create_user(f.get("username"), f.get("password"), "staff") or "Staff created"
+    return render_template("add_staff.html", msg=msg)
+
+@app.route("/change-password", methods=["GET", "POST"])
+@login_required
+def change_password():
+    if request.method == "GET":
+        return render_template("change_password.html")
+
+    f = request.form
+    new = f.get("new_password") or ""
+    if new != f.get("confirm_password"):
+        return render_template("change_password.html", msg="New password match nahi kar raha")
+    if len(new) < PASSWORD_MIN_LENGTH:
+        return render_template(
+            "change_password.html",
+            msg=f"Password kam se kam {PASSWORD_MIN_LENGTH} characters ka ho"
+        )
+
+    uid = current_user()["id"]
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT password_hash FROM users WHERE id=%s", (uid,))
+    if not check_password_hash(cur.fetchone()["password_hash"], f.get("old_password") or ""):
+        cur.close()
+        return render_template("change_password.html", msg="Old password galat hai")
+
+    cur.execute(
+        "UPDATE users SET password_hash=%s WHERE id=%s",
+        (generate_password_hash(new), uid)
+    )
+    # other devices are logged out, this one stays
+    revoke_sessions(cur, uid, keep=session.get("sid"))
+    conn.commit()
+    cur.close()
+    evict_user_sessions(uid)
+    return render_template("change_password.html", msg="Password updated")
+
 # ================= HELPERS =================
 def row_to_obj(r):
     return {
@@ -256,47 +1709,989 @@ def row_to_obj(r):
         "model": r["model"],
         "problem": r["problem"],
         "priority": r["priority"] or "Regular",
-        "receive_date": r["receive_date"],
-        "out_date": r["out_date"],
-        "in_date": r["in_date"],
-        "ready_date": r["ready_date"],
-        "return_date": r["return_date"],
-        "reject_date": r["reject_date"],
+        "receive_date": fmt_date(r["receive_date"]),
+        "out_date": fmt_date(r["out_date"]),
+        "in_date": fmt_date(r["in_date"]),
+        "ready_date": fmt_date(r["ready_date"]),
+        "return_date": fmt_date(r["return_date"]),
+        "reject_date": fmt_date(r["reject_date"]),
         "status": r["status"],
-        "bill": json.loads(r["bill_json"]) if r["bill_json"] else {}
+        "bill": {
+            "parts_total": float(r["bill_parts"]),
+            "service_charge": float(r["bill_service"]),
+            "other": float(r["bill_other"])
+        } if r["bill_total"] is not None else {}
     }
 
-def whatsapp_link(entry, total):
-    msg = f"IT SOLUTIONS\nModel: {entry['model']}\nTotal: ₹{total}"
-    return f"https://wa.me/91{entry['phone']}?text={urllib.parse.quote(msg)}"
-
-# ================= DASHBOARD =================
-@app.route("/")
-@login_required
-def dashboard():
+def entry_json(r):
+    # row shape used by /api/entries and the change feed
+    obj = row_to_obj(r)
+    obj["whatsapp"] = f"/api/entries/{r['id']}/whatsapp" if obj["status"]=="Delivered" else ""
+    return obj
+
+# ================= CACHE =================
+class TTLCache:
+    """
+    Small per-process cache. Items expire after ttl seconds, or earlier
+    when one of their tags (table names) is invalidated by a write.
+    """
+
+    def __init__(self, ttl, maxsize=256):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._data = OrderedDict()  # key -> (expires, tags, value)
+        CACHES.append(self)
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return item[2]
+
+    def set(self, key, value, tags=()):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, frozenset(tags), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, *tags):
+        with self._lock:
+            for key in [k for k, v in self._data.items() if v[1] & set(tags)]:
+                del self._data[key]
+
+CACHES = []
+
+def invalidate_cache(*tables):
+    # call after commit in every route that writes these tables
+    for c in CACHES:
+        c.invalidate(*tables)
+
+# ================= SESSIONS =================
+# The signed cookie only carries a random token; the `sessions` row is the
+# truth, so deleting it or deactivating the user logs that person out.
+SESSION_LIFETIME = datetime.timedelta(
+    hours=float(os.environ.get("SESSION_LIFETIME_HOURS", 24 * 7))
+)
+SESSION_CACHE_TTL = float(os.environ.get("SESSION_CACHE_TTL", 30))
+
+# sid -> {id, username, role}, or False for a dead session
+session_cache = TTLCache(SESSION_CACHE_TTL, maxsize=1024)
+# last good lookup per session, used only while the database is offline
+# (nothing can be revoked then anyway)
+session_fallback = TTLCache(SESSION_LIFETIME.total_seconds(), maxsize=1024)
+
+def session_key(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+class AuthListener:
+    """
+    One LISTEN connection per worker process. Each NOTIFY names a user
+    whose sessions, role or password changed; their cached sessions are
+    dropped. While it is not connected current_user() skips the cache, so
+    a revocation is never missed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self.live = False
+        self.generation = 0   # bumped on every eviction
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid, self.live = os.getpid(), False
+            threading.Thread(target=self._run, name="auth-listener", daemon=True).start()
+
+    def evict(self, *tags):
+        self.generation += 1
+        session_cache.invalidate(*tags)
+        session_fallback.invalidate(*tags)
+
+    def _run(self):
+        failures = 0
+        while True:
+            conn = None
+            try:
+                conn = connect()
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute(f"LISTEN {AUTH_CHANNEL}")
+                # whatever changed while we were not listening
+                self.evict("sessions")
+                self.live = True
+                failures = 0
+
+                while True:
+                    if select.select([conn], [], [], 60)[0]:
+                        conn.poll()
+                        self.evict(*(f"user:{n.payload}" for n in conn.notifies))
+                        conn.notifies.clear()
+                    else:
+                        cur.execute("SELECT 1")   # notice a dead connection
+            except (psycopg2.Error, OSError, RuntimeError) as e:
+                self.live = False
+                failures += 1
+                print("auth listener:", e)
+                time.sleep(min(30, 2 ** failures))
+            finally:
+                if conn is not None:
+                    conn.close()
+
+auth_listener = AuthListener()
+
+def current_user():
+    """
+    {id, username, role} of the logged-in user, or None. Comes from
+    session_cache; the DB is read (and the expiry slid forward) at most
+    once per SESSION_CACHE_TTL per session and worker.
+    """
+    if "user" in g:
+        return g.user
+    g.user = None
+    token = session.get("sid")
+    if not token:
+        return None
+    sid = session_key(token)
+
+    auth_listener.start()
+    cached = auth_listener.live
+    user = session_cache.get(sid) if cached else None
+    if user is None:
+        generation = auth_listener.generation
+        try:
+            conn = get_db()
+        except DatabaseOffline:
+            # keep the cookie: the session is checked again once back online
+            g.user = session_fallback.get(sid)
+            return g.user
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE sessions s
+            SET last_seen_at = now(), expires_at = now() + %s
+            FROM users u
+            WHERE s.id = %s AND u.id = s.user_id
+              AND s.expires_at > now() AND u.active
+            RETURNING u.id, u.username, u.role
+        """, (SESSION_LIFETIME, sid))
+        user = cur.fetchone() or False
+        conn.commit()
+        cur.close()
+        # an eviction during the read means the row may already be stale
+        if generation == auth_listener.generation:
+            tags = ("sessions", f"user:{user['id']}") if user else ("sessions",)
+            if cached:
+                session_cache.set(sid, user, tags=tags)
+            if user:
+                session_fallback.set(sid, user, tags=tags)
+
+    if not user:
+        session.clear()
+        return None
+    g.user = user
+    return user
+
+def start_session(user_id):
+    token = secrets.token_urlsafe(32)
     conn = get_db()
     cur = conn.cursor()
+    cur.execute("DELETE FROM sessions WHERE expires_at < now()")
+    cur.execute("""
+        INSERT INTO sessions(id, user_id, expires_at, ip, user_agent)
+        VALUES(%s, %s, now() + %s, %s, %s)
+    """, (
+        session_key(token), user_id, SESSION_LIFETIME,
+        request.remote_addr, request.user_agent.string[:200]
+    ))
+    conn.commit()
+    cur.close()
+    session.clear()
+    session["sid"] = token
 
-    today = now_ist().strftime("%Y-%m-%d")
+def end_session():
+    token = session.pop("sid", None)
+    if token:
+        conn = get_db()
+        cur = conn.cursor()
+        cur.execute("DELETE FROM sessions WHERE id=%s", (session_key(token),))
+        conn.commit()
+        cur.close()
+    session.clear()
 
-    cur.execute("SELECT COALESCE(SUM(amount),0) s FROM sales WHERE sale_date LIKE %s", (today+"%",))
-    today_sales = cur.fetchone()["s"]
+def revoke_sessions(cur, user_id, keep=None):
+    # keep: token of the session that stays (the caller's own)
+    cur.execute(
+        "DELETE FROM sessions WHERE user_id=%s AND id IS DISTINCT FROM %s",
+        (user_id, session_key(keep) if keep else None)
+    )
 
-    cur.execute("SELECT COUNT(*) n FROM entries WHERE status!='Delivered'")
-    pending = cur.fetchone()["n"]
+def evict_user_sessions(user_id):
+    # this worker right away; the others via the NOTIFY trigger
+    auth_listener.evict(f"user:{user_id}")
 
-    overdue = len(get_overdue_entries())
+# ================= CONDITIONAL GET =================
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_TYPES = ("application/json", "text/html")
 
-    cur.close()
-    conn.close()
+def bump_version(cur, *tables):
+    """
+    Bump the change version of each table inside the writer's transaction
+    (call before commit, next to invalidate_cache after it). A reader never
+    sees the new version before the new rows.
+    """
+    cur.execute("""
+        INSERT INTO change_versions(name, version)
+        SELECT unnest(%s::text[]), 1
+        ON CONFLICT (name) DO UPDATE
+        SET version = change_versions.version + 1
+    """, (sorted(set(tables)),))
+
+def table_versions(cur, tables):
+    cur.execute(
+        "SELECT name, version FROM change_versions WHERE name = ANY(%s)",
+        (list(tables),)
+    )
+    v = {r["name"]: r["version"] for r in cur.fetchall()}
+    return [v.get(t, 0) for t in tables]
+
+def conditional(*tables, every=None):
+    """
+    Strong ETag from the tables' change versions + the request URL.
+    A matching If-None-Match gets a 304 without running the view.
+    every=N seconds also rolls the tag over for time-based results
+    (overdue list).
+    """
+    def deco(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            cur = get_db().cursor()
+            key = [request.full_path, table_versions(cur, tables)]
+            cur.close()
+            if every:
+                key.append(int(time.time() // every))
+            tag = hashlib.sha1(json.dumps(key).encode()).hexdigest()[:20]
+
+            # compressed variants carry a -gzip / -br suffix
+            sent = request.if_none_match
+            hit = [t for t in sent.as_set(include_weak=True)
+                   if t.split("-")[0] == tag]
+            if hit or sent.star_tag:
+                resp = Response(status=304)
+                resp.set_etag(hit[0] if hit else tag)
+            else:
+                resp = app.make_response(fn(*args, **kwargs))
+                if resp.status_code != 200:
+                    return resp
+                resp.set_etag(tag)
+
+            resp.headers["Cache-Control"] = "private, no-cache"
+            resp.vary.add("Accept-Encoding")
+            return resp
+        return wrapper
+    return deco
+
+@app.after_request
+def compress(resp):
+    if (resp.status_code != 200 or resp.direct_passthrough or resp.is_streamed
+            or resp.mimetype not in COMPRESS_TYPES
+            or "Content-Encoding" in resp.headers):
+        return resp
+
+    resp.vary.add("Accept-Encoding")
+    data = resp.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return resp
+
+    accept = request.accept_encodings
+    if brotli is not None and accept["br"]:
+        enc, data = "br", brotli.compress(data, quality=5)
+    elif accept["gzip"]:
+        enc, data = "gzip", gzip.compress(data, compresslevel=6, mtime=0)
+    else:
+        return resp
+
+    resp.set_data(data)
+    resp.headers["Content-Encoding"] = enc
+    etag, weak = resp.get_etag()
+    if etag:
+        resp.set_etag(f"{etag}-{enc}", weak)
+    return resp
+
+# ================= IDEMPOTENCY =================
+IDEMPOTENCY_TTL_HOURS = 24
+
+def idempotent(fn):
+    """
+    POSTs carrying an Idempotency-Key header run once per key and route;
+    a retry gets the stored response back. The key row is inserted on the
+    request's connection, so it commits (or rolls back) with the view.
+    """
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get("Idempotency-Key", "").strip()
+        if not key:
+            return fn(*args, **kwargs)
+
+        try:
+            conn = get_db()
+        except DatabaseOffline:
+            # the view journals the write under this key (see OFFLINE)
+            return fn(*args, **kwargs)
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO idempotency_keys(key, route) VALUES(%s, %s)
+            ON CONFLICT DO NOTHING
+            RETURNING key
+        """, (key[:200], request.path))
+
+        if cur.fetchone() is None:
+            # waits for the first request's commit, then replays it
+            cur.execute("""
+                SELECT status, response FROM idempotency_keys
+                WHERE key=%s AND route=%s
+            """, (key[:200], request.path))
+            r = cur.fetchone()
+            conn.rollback()
+            cur.close()
+            if r["response"] is None:
+                return jsonify({"error": "Request still in progress"}), 409
+            resp = Response(r["response"], status=r["status"],
+                            mimetype="application/json")
+            resp.headers["Idempotent-Replayed"] = "true"
+            return resp
+
+        resp = app.make_response(fn(*args, **kwargs))
+
+        if resp.status_code >= 400:
+            # failed requests may be retried with the same key; the view
+            # may have committed the key row along with its own work
+            conn.rollback()
+            cur.execute("""
+                DELETE FROM idempotency_keys
+                WHERE key=%s AND route=%s AND response IS NULL
+            """, (key[:200], request.path))
+            conn.commit()
+        else:
+            cur.execute("""
+                UPDATE idempotency_keys SET status=%s, response=%s
+                WHERE key=%s AND route=%s
+            """, (resp.status_code, resp.get_data(as_text=True),
+                  key[:200], request.path))
+            cur.execute(f"""
+                DELETE FROM idempotency_keys
+                WHERE created_at < now() - interval '{IDEMPOTENCY_TTL_HOURS} hours'
+            """)
+            conn.commit()
+        cur.close()
+        return resp
+    return wrapper
+
+# ================= OFFLINE =================
+# OFFLINE_MODE=1 keeps the counter working while Postgres is unreachable.
+# New entries, status actions and ink moves go to a local SQLite journal
+# and are replayed in order once the link is back. GET APIs listed in
+# OFFLINE_READS are answered from the last copy this machine served.
+OFFLINE_MODE = os.environ.get("OFFLINE_MODE") == "1"
+OFFLINE_DB = os.environ.get(
+    "OFFLINE_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "offline.db")
+)
+OFFLINE_REPLAY_BATCH = int(os.environ.get("OFFLINE_REPLAY_BATCH", 50))
+OFFLINE_REPLICA_MAX = 500      # cached responses kept
+OFFLINE_LOCK = 7302            # pg advisory lock key: one replayer at a time
+OFFLINE_READS = (
+    "/api/entries", "/api/overdue", "/api/out-devices", "/api/ink",
+    "/api/dashboard/summary", "/api/dashboard-warnings", "/api/analytics"
+)
+
+OFFLINE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS journal(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL UNIQUE,
+    op TEXT NOT NULL,
+    route TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    user_id INTEGER,
+    created_at TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    error TEXT,
+    applied_at TEXT
+);
+CREATE INDEX IF NOT EXISTS journal_status ON journal(status, id);
+CREATE TABLE IF NOT EXISTS replica(
+    path TEXT PRIMARY KEY,
+    body BLOB NOT NULL,
+    mimetype TEXT,
+    saved_at REAL NOT NULL
+);
+"""
+
+class OfflineStore:
+    """
+    The SQLite file, shared by every worker on this machine (WAL mode).
+    One connection per thread.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._saved = OrderedDict()   # path -> body hash already on disk
+        self.pending = None           # unknown until the first replay
+        self.replaying = threading.Lock()
+
+    def db(self):
+        c = getattr(self._local, "conn", None)
+        if c is None or self._local.pid != os.getpid():
+            c = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            c.row_factory = sqlite3.Row
+            c.execute("PRAGMA journal_mode=WAL")
+            c.executescript(OFFLINE_SCHEMA)
+            self._local.conn, self._local.pid = c, os.getpid()
+        return c
+
+    # ---- journal ----
+    def append(self, op, route, payload, key, user_id):
+        c = self.db()
+        # a retried request (same Idempotency-Key) is journaled once
+        c.execute("""
+            INSERT OR IGNORE INTO journal(key, op, route, payload, user_id, created_at)
+            VALUES(?, ?, ?, ?, ?, ?)
+        """, (key, op, route, json.dumps(payload), user_id, now()))
+        self.pending = True
+        return c.execute("SELECT id FROM journal WHERE key=?", (key,)).fetchone()["id"]
+
+    def queued(self, limit=None, ops=None):
+        sql = "SELECT * FROM journal WHERE status='pending'"
+        params = []
+        if ops:
+            sql += f" AND op IN ({','.join('?' * len(ops))})"
+            params += ops
+        sql += " ORDER BY id"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return self.db().execute(sql, params).fetchall()
+
+    def mark(self, marks):
+        c = self.db()
+        c.execute("BEGIN")
+        c.executemany(
+            "UPDATE journal SET status=?, error=?, applied_at=? WHERE id=?",
+            [(status, error, now(), jid) for jid, status, error in marks]
+        )
+        c.execute("COMMIT")
+
+    def status(self):
+        c = self.db()
+        counts = {
+            r["status"]: r["n"] for r in
+            c.execute("SELECT status, COUNT(*) n FROM journal GROUP BY status")
+        }
+        failed = c.execute("""
+            SELECT id, op, payload, created_at, error FROM journal
+            WHERE status='failed' ORDER BY id DESC LIMIT 20
+        """).fetchall()
+        return counts, [dict(r) for r in failed]
+
+    # ---- replica ----
+    def save(self, path, body, mimetype):
+        digest = hashlib.sha1(body).digest()
+        if self._saved.get(path) == digest:
+            return
+        c = self.db()
+        c.execute("""
+            INSERT INTO replica(path, body, mimetype, saved_at) VALUES(?, ?, ?, ?)
+            ON CONFLICT(path) DO UPDATE
+            SET body=excluded.body, mimetype=excluded.mimetype, saved_at=excluded.saved_at
+        """, (path, body, mimetype, time.time()))
+        self._saved[path] = digest
+        self._saved.move_to_end(path)
+        if len(self._saved) > OFFLINE_REPLICA_MAX:
+            self._saved.popitem(last=False)
+            c.execute("""
+                DELETE FROM replica WHERE path NOT IN (
+                    SELECT path FROM replica ORDER BY saved_at DESC LIMIT ?
+                )
+            """, (OFFLINE_REPLICA_MAX,))
+
+    def load(self, path):
+        return self.db().execute(
+            "SELECT body, mimetype, saved_at FROM replica WHERE path=?", (path,)
+        ).fetchone()
+
+offline_store = OfflineStore(OFFLINE_DB)
+
+def offline_write(op, payload, body):
+    """
+    Journal a write the view could not send to Postgres and answer 202.
+    Re-raises DatabaseOffline when offline mode is off.
+    """
+    if not OFFLINE_MODE:
+        raise DatabaseOffline("database unreachable")
+    key = request.headers.get("Idempotency-Key", "").strip()[:200] \
+        or "offline-" + secrets.token_hex(16)
+    user = current_user()
+    jid = offline_store.append(op, request.path, payload, key, user and user["id"])
+    return jsonify(dict(body, queued=True, journal_id=jid)), 202
+
+@app.after_request
+def offline_save(resp):
+    # runs before compress (registered later), so the body is plain JSON
+    if (
+        OFFLINE_MODE and request.method == "GET" and resp.status_code == 200
+        and request.path in OFFLINE_READS
+        and not resp.is_streamed and not resp.direct_passthrough
+    ):
+        try:
+            offline_store.save(request.full_path, resp.get_data(), resp.mimetype)
+        except sqlite3.Error as e:
+            print("offline replica:", e)
+    return resp
+
+def offline_read():
+    """Replica copy of this GET, with queued writes laid over it; or None."""
+    if not (OFFLINE_MODE and request.method == "GET" and request.path in OFFLINE_READS):
+        return None
+    r = offline_store.load(request.full_path)
+    if r is None:
+        return None
+
+    body = r["body"]
+    if request.path in OFFLINE_OVERLAYS:
+        body = json.dumps(OFFLINE_OVERLAYS[request.path](json.loads(body)))
+    resp = Response(body, mimetype=r["mimetype"])
+    resp.headers["X-Offline"] = "1"
+    resp.headers["X-Offline-Age"] = str(int(time.time() - r["saved_at"]))
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
+
+def overlay_entries(rows):
+    # queued status changes, then queued new entries on the first page
+    by_id = {r["id"]: r for r in rows}
+    for j in offline_store.queued(ops=["entry_action"]):
+        p = json.loads(j["payload"])
+        r = by_id.get(p["eid"])
+        if r is not None:
+            r["status"] = p["status"]
+            r[p["column"]] = p["date"]
+    if request.args.get("after_id"):
+        return rows
+    new = [
+        dict(json.loads(j["payload"]), id=None, status="Received",
+             out_date="", in_date="", ready_date="", return_date="",
+             reject_date="", bill={}, whatsapp="", pending=True)
+        for j in offline_store.queued(ops=["entry_add"])
+    ]
+    return new[::-1] + rows
+
+def overlay_ink(rows):
+    qty = {r["id"]: r for r in rows}
+    for j in offline_store.queued(ops=["ink_moves"]):
+        for m in json.loads(j["payload"])["moves"]:
+            r = qty.get(m["id"])
+            if r is not None:
+                r["qty"] += m["qty"] if m["action"] == "in" else -m["qty"]
+    return rows
+
+OFFLINE_OVERLAYS = {"/api/entries": overlay_entries, "/api/ink": overlay_ink}
+
+# ---------- replay ----------
+# op -> fn(cur, payload, user_id) returning the JSON body the live route
+# would have sent; ValueError marks the row failed (kept for review, not
+# retried)
+def replay_entry_add(cur, p, user_id):
+    insert_entry(cur, p, user_id)
+    return {"ok": True, "receive_date": p["receive_date"]}
+
+def replay_entry_action(cur, p, user_id):
+    if not update_entry_status(cur, p["eid"], p["status"], p["column"], p["date"], user_id):
+        raise ValueError(f"Entry {p['eid']} not found")
+    return {"ok": True, "status": p["status"], "date": p["date"]}
+
+def replay_ink_moves(cur, p, user_id):
+    results = apply_ink_moves(cur, p["moves"])
+    errors = [f"line {r['line']}: {r['error']}" for r in results if not r["ok"]]
+    if errors and (p["atomic"] or len(errors) == len(results)):
+        raise ValueError("; ".join(errors))
+    # same body the live route sends
+    if p.get("single"):
+        return {"ok": True, "qty": results[0]["stock"]}
+    return {
+        "ok": not errors,
+        "applied": len(results) - len(errors),
+        "failed": len(errors),
+        "results": results
+    }
+
+OFFLINE_OPS = {
+    "entry_add": replay_entry_add,
+    "entry_action": replay_entry_action,
+    "ink_moves": replay_ink_moves
+}
+
+def replay_journal(log=print):
+    """
+    Send pending journal rows to Postgres in order, OFFLINE_REPLAY_BATCH
+    per transaction. Each row's key is written to idempotency_keys in the
+    same transaction, so a row that was applied but not yet marked done
+    here (crash in between) is skipped instead of applied twice.
+    Returns (applied, failed).
+    """
+    applied = failed = 0
+    conn = connect()
+    try:
+        while True:
+            cur = conn.cursor()
+            cur.execute("SELECT pg_try_advisory_xact_lock(%s) ok", (OFFLINE_LOCK,))
+            if not cur.fetchone()["ok"]:
+                break   # another worker is replaying
+            rows = offline_store.queued(OFFLINE_REPLAY_BATCH)
+            if not rows:
+                break
+
+            marks = []
+            for j in rows:
+                cur.execute("SAVEPOINT op")
+                cur.execute("""
+                    INSERT INTO idempotency_keys(key, route) VALUES(%s, %s)
+                    ON CONFLICT DO NOTHING
+                    RETURNING key
+                """, (j["key"], j["route"]))
+                if cur.fetchone() is None:
+                    cur.execute("RELEASE SAVEPOINT op")
+                    marks.append((j["id"], "done", "already applied"))
+                    continue
+                try:
+                    body = OFFLINE_OPS[j["op"]](cur, json.loads(j["payload"]), j["user_id"])
+                except (ValueError, KeyError, psycopg2.DataError, psycopg2.IntegrityError) as e:
+                    cur.execute("ROLLBACK TO SAVEPOINT op")
+                    marks.append((j["id"], "failed", str(e)))
+                    continue
+                # a client retrying with its Idempotency-Key gets this back
+                cur.execute("""
+                    UPDATE idempotency_keys SET status=200, response=%s
+                    WHERE key=%s AND route=%s
+                """, (json.dumps(body, default=str), j["key"], j["route"]))
+                cur.execute("RELEASE SAVEPOINT op")
+                marks.append((j["id"], "done", None if body.get("ok") else "partly applied"))
+
+            n = sum(1 for m in marks if m[1] == "failed")
+            skipped = sum(1 for m in marks if m[2] == "already applied")
+            done = len(marks) - n - skipped
+            # nothing changed: keep every client's ETag
+            if done:
+                bump_version(cur, "entries", "ink")
+            conn.commit()
+            cur.close()
+            offline_store.mark(marks)
+
+            applied += done
+            failed += n
+            log(f"offline replay: {done} applied, "
+                f"{skipped} already applied, {n} failed")
+        conn.rollback()
+    finally:
+        conn.close()
+
+    offline_store.pending = bool(offline_store.queued(1))
+    if applied:
+        invalidate_cache("entries", "ink")
+    return applied, failed
 
-    return render_template("dashboard.html", kp={
-        "today_sales": today_sales,
-        "pending": pending,
-        "overdue": overdue,
-        "ledger_bal": 0
+def replay_in_background():
+    if not OFFLINE_MODE or not offline_store.replaying.acquire(blocking=False):
+        return
+
+    def run():
+        try:
+            replay_journal()
+        except (psycopg2.Error, sqlite3.Error, RuntimeError) as e:
+            print("offline replay:", e)
+        finally:
+            offline_store.replaying.release()
+
+    threading.Thread(target=run, name="offline-replay", daemon=True).start()
+
+db_link.on_reconnect.append(replay_in_background)
+
+@app.before_request
+def offline_replay_pending():
+    # journal rows left from before this process started
+    if OFFLINE_MODE and offline_store.pending is None and db_link.down_since is None:
+        offline_store.pending = False
+        replay_in_background()
+
+@app.cli.command("offline-sync")
+def offline_sync_command():
+    """Replay the offline journal to Postgres now."""
+    applied, failed = replay_journal(log=click.echo)
+    click.echo(f"{applied} applied, {failed} failed")
+
+@app.get("/api/offline")
+@login_required
+def offline_status():
+    # SQLite only: answers while Postgres is down
+    counts, failed = offline_store.status() if OFFLINE_MODE else ({}, [])
+    return jsonify({
+        "enabled": OFFLINE_MODE,
+        "online": db_link.down_since is None,
+        "down_since": db_link.down_since,
+        "pending": counts.get("pending", 0),
+        "done": counts.get("done", 0),
+        "failed": failed
     })
 
+# ================= METRICS =================
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", 500))
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 200))
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def perf_add(name, value):
+    # per-request counters in g._perf; no-op outside a request
+    if METRICS_ENABLED and has_request_context() and "_perf" in g:
+        g._perf[name] = g._perf.get(name, 0) + value
+
+def record_query(cur, query, seconds):
+    if not METRICS_ENABLED:
+        return
+    rows = cur.rowcount if cur.description is not None and cur.rowcount > 0 else 0
+    perf_add("queries", 1)
+    perf_add("db_s", seconds)
+    perf_add("rows", rows)
+    if seconds * 1000 >= SLOW_QUERY_MS:
+        sql = query if isinstance(query, str) else getattr(cur, "query", b"") or b""
+        if isinstance(sql, bytes):
+            sql = sql.decode("utf-8", "replace")
+        app.logger.warning(
+            "slow query %.0fms rows=%s: %s", seconds * 1000, rows,
+            " ".join(str(sql).split())[:500]
+        )
+
+class Metrics:
+    """In-process counters and histograms, rendered as Prometheus text."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}    # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+
+    def inc(self, name, labels, value=1):
+        with self._lock:
+            key = (name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            h = self.histograms.get((name, labels))
+            if h is None:
+                h = self.histograms[(name, labels)] = [0] * (len(METRIC_BUCKETS) + 2)
+            for i, b in enumerate(METRIC_BUCKETS):
+                if value <= b:
+                    h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    def render(self):
+        def fmt(labels, extra=()):
+            items = list(labels) + list(extra)
+            if not items:
+                return ""
+            # label values are endpoint names, methods and numbers
+            return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+        out = []
+        with self._lock:
+            seen = set()
+            for (name, labels), h in sorted(self.histograms.items()):
+                if name not in seen:
+                    out.append(f"# TYPE {name} histogram")
+                    seen.add(name)
+                for i, b in enumerate(METRIC_BUCKETS):
+                    out.append(f"{name}_bucket{fmt(labels, [('le', b)])} {h[i]}")
+                out.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {h[-1]}")
+                out.append(f"{name}_sum{fmt(labels)} {h[-2]:.6f}")
+                out.append(f"{name}_count{fmt(labels)} {h[-1]}")
+            for (name, labels), v in sorted(self.counters.items()):
+                if name not in seen:
+                    out.append(f"# TYPE {name} counter")
+                    seen.add(name)
+                out.append(f"{name}{fmt(labels)} {v:g}")
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+
+def record_request_metrics(info):
+    labels = (("endpoint", info["endpoint"]), ("method", info["method"]))
+    metrics.observe(
+        "http_request_duration_seconds",
+        labels + (("status", f"{info['status'] // 100}xx"),),
+        info["total_s"]
+    )
+    for key, name in (
+        ("db_s", "db_query_seconds_total"),
+        ("queries", "db_queries_total"),
+        ("rows", "db_rows_fetched_total"),
+        ("pool_wait_s", "db_pool_wait_seconds_total"),
+        ("serialize_s", "serialize_seconds_total"),
+        ("bytes", "http_response_bytes_total"),
+    ):
+        if info.get(key):
+            metrics.inc(name, labels, info[key])
+
+def log_slow_request(info):
+    if info["total_s"] * 1000 >= SLOW_REQUEST_MS:
+        app.logger.warning("slow request %s", json.dumps(info, default=str))
+
+# called with the per-request info dict; append to plug in more sinks
+REQUEST_OBSERVERS = [record_request_metrics, log_slow_request]
+
+def perf_start():
+    if METRICS_ENABLED:
+        g._perf = {"t0": time.perf_counter()}
+
+def perf_finish(resp):
+    perf = g.pop("_perf", None)
+    if perf is None:
+        return resp
+
+    info = {
+        "method": request.method,
+        "path": request.path,
+        "endpoint": request.endpoint or "unmatched",
+        "status": resp.status_code,
+        "total_s": round(time.perf_counter() - perf.pop("t0"), 6),
+        "bytes": 0 if resp.is_streamed else resp.content_length or 0,
+    }
+    info.update({k: round(v, 6) for k, v in perf.items()})
+    for fn in REQUEST_OBSERVERS:
+        try:
+            fn(info)
+        except Exception as e:
+            app.logger.error("request observer %s failed: %s", fn.__name__, e)
+    resp.headers["Server-Timing"] = ", ".join(
+        f"{k[:-2]};dur={v * 1000:.1f}" for k, v in
+        (("total_s", info["total_s"]), ("db_s", info.get("db_s", 0)),
+         ("pool_wait_s", info.get("pool_wait_s", 0)),
+         ("serialize_s", info.get("serialize_s", 0)))
+    )
+    return resp
+
+# first before_request and last after_request, so the timing covers the
+# schema check, login, compression and everything in between
+app.before_request_funcs.setdefault(None, []).insert(0, perf_start)
+app.after_request_funcs.setdefault(None, []).insert(0, perf_finish)
+
+@app.get("/metrics")
+def metrics_endpoint():
+    # per worker process: scrape each worker or run a single worker
+    if METRICS_TOKEN:
+        if request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+            abort(403)
+    elif not can("admin.db"):
+        # no token configured: admin session only, hidden from everyone else
+        abort(404)
+
+    text = metrics.render()
+    stats = get_pool().stats()
+    for k, v in stats.items():
+        if isinstance(v, (int, float)):
+            text += f"# TYPE db_pool_{k} gauge\ndb_pool_{k} {v}\n"
+    return Response(text, mimetype="text/plain; version=0.0.4")
+
+# ================= DASHBOARD =================
+DASHBOARD_CACHE_TTL = float(os.environ.get("DASHBOARD_CACHE_TTL", 15))
+dashboard_cache = TTLCache(DASHBOARD_CACHE_TTL, maxsize=4)
+
+def dashboard_summary_data():
+    data = dashboard_cache.get("summary")
+    if data is not None:
+        return data
+
+    today = now_ist().date()
+
+    conn = get_db()
+    cur = conn.cursor()
+
+    # one round-trip for KPIs, warnings and ink levels
+    cur.execute(f"""
+        SELECT
+            (SELECT COALESCE(SUM(amount),0)::float8
+             FROM sales_daily
+             WHERE day = %s) AS today_sales,
+
+            (SELECT COUNT(*)
+             FROM entries
+             WHERE status != 'Delivered') AS pending,
+
+            (SELECT COUNT(*)
+             FROM entries
+             WHERE {OVERDUE_WHERE}) AS overdue,
+
+            (SELECT COALESCE(SUM(balance),0)::float8
+             FROM customer_balances) AS ledger_bal,
+
+            (SELECT COALESCE(json_agg(json_build_object(
+                        'id', id, 'status', status, 'customer', customer,
+                        'type', type, 'model', model
+                    ) ORDER BY status, id), '[]')
+             FROM entries
+             WHERE status IN ('Out','Ready')) AS warnings,
+
+            (SELECT COALESCE(json_agg(json_build_object(
+                        'id', m.id, 'model', m.ink_name, 'qty', COALESCE(s.qty,0)
+                    ) ORDER BY m.ink_name), '[]')
+             FROM ink_master m
+             LEFT JOIN ink_stock s ON m.id = s.ink_id) AS ink
+    """, (today,))
+    r = cur.fetchone()
+    cur.close()
+
+    data = {
+        "kpis": {
+            "today_sales": r["today_sales"],
+            "pending": r["pending"],
+            "overdue": r["overdue"],
+            "ledger_bal": r["ledger_bal"]
+        },
+        "warnings": r["warnings"],
+        "ink": r["ink"]
+    }
+
+    dashboard_cache.set("summary", data, tags=("entries", "sales", "ink", "ledger"))
+    return data
+
+@app.route("/")
+@login_required
+def dashboard():
+    try:
+        kp = dashboard_summary_data()["kpis"]
+    except DatabaseOffline:
+        r = offline_store.load("/api/dashboard/summary?") if OFFLINE_MODE else None
+        if r is None:
+            raise
+        kp = json.loads(r["body"])["kpis"]
+    return render_template(
+        "dashboard.html",
+        kp=kp
+    )
+
+@app.get("/api/dashboard/summary")
+@login_required
+def dashboard_summary():
+    return jsonify(dashboard_summary_data())
+
 @app.get("/api/dashboard-warnings")
 @login_required
 def dashboard_warnings():
@@ -340,267 +2735,302 @@ def dashboard_warnings():
         )
 
     cur.close()
-    conn.close()
 
     return jsonify(warnings)
 
-# ================= WHATSAPP OVERDUE LIST =================
-
-@app.get("/api/overdue-whatsapp")
-@login_required
-def overdue_whatsapp():
-
-    rows = get_overdue_entries()
-
-    if not rows:
-        return jsonify({
-            "ok": False,
-            "message": "अभी कोई overdue device नहीं है।"
-        })
-
-    lines = []
-
-    lines.append("IT SOLUTIONS")
-    lines.append("GHATSILA COLLEGE ROAD")
-    lines.append("")
-    lines.append("⚠️ OVERDUE DEVICE LIST")
-    lines.append("")
-
-    for i, r in enumerate(rows, 1):
-
-        priority = (r["priority"] or "Regular").strip()
-
-        if priority == "Urgent":
-            p_icon = "🔴"
-        elif priority == "Rework":
-            p_icon = "🔵"
-        else:
-            p_icon = "🟢"
-
-        lines.append(
-            f"{i}. Customer: {r['customer'] or '-'}"
-        )
-
-        lines.append(
-            f"   Mobile: {r['phone'] or '-'}"
-        )
-
-        lines.append(
-            f"   Device: {r['type'] or '-'}"
-        )
-
-        lines.append(
-            f"   Model: {r['model'] or '-'}"
-        )
-
-        lines.append(
-            f"   Problem: {r['problem'] or '-'}"
-        )
-
-        lines.append(
-            f"   Priority: {p_icon} {priority}"
-        )
-
-        lines.append(
-            f"   Receive: {r['receive_date'] or '-'}"
-        )
-
-        lines.append(
-            f"   Status: {r['status'] or '-'}"
-        )
-
-        lines.append("")
-        lines.append("--------------------------")
-        lines.append("")
-
-    lines.append(
-        f"Total Overdue: {len(rows)}"
-    )
-
-    message = "\n".join(lines)
-
-    # Aapka WhatsApp number
-    whatsapp_number = "9113171781"
-
-    whatsapp_url = (
-        "https://wa.me/"
-        + whatsapp_number
-        + "?text="
-        + urllib.parse.quote(message)
-    )
-
-    return jsonify({
-        "ok": True,
-        "count": len(rows),
-        "message": message,
-        "whatsapp_url": whatsapp_url
-    })
-
-# ================= OUT DEVICES =================
-
-@app.route("/out-devices")
-@login_required
-def out_devices_page():
-    return render_template("out_devices.html")
-
+# ================= WHATSAPP REPORTS =================
+WHATSAPP_REPORT_NUMBER = os.environ.get("WHATSAPP_REPORT_NUMBER", "919113171781")
+WHATSAPP_URL_MAX = int(os.environ.get("WHATSAPP_URL_MAX", 2000))
+WHATSAPP_CACHE_TTL = 300
+PRIORITY_ICONS = {"Urgent": "🔴", "Rework": "🔵"}
 
-@app.get("/api/out-devices")
-@login_required
-def out_devices_list():
+whatsapp_cache = TTLCache(WHATSAPP_CACHE_TTL, maxsize=32)
 
+def get_out_entries():
     conn = get_db()
     cur = conn.cursor()
-
     cur.execute("""
         SELECT *
         FROM entries
         WHERE status = 'Out'
         ORDER BY out_date DESC
     """)
-
     rows = cur.fetchall()
-
     cur.close()
-    conn.close()
-
-    return jsonify([
-        row_to_obj(r)
-        for r in rows
+    return rows
+
+# every=N: the list depends on the clock, re-render at most every N seconds
+WHATSAPP_REPORTS = {
+    "overdue": {
+        "rows": get_overdue_entries,
+        "title": "⚠️ OVERDUE DEVICE LIST",
+        "date": ("Receive", "receive_date"),
+        "total": "Total Overdue",
+        "empty": "अभी कोई overdue device नहीं है।",
+        "every": 60
+    },
+    "out": {
+        "rows": get_out_entries,
+        "title": "⚠️ OUT DEVICE LIST",
+        "date": ("OUT Date", "out_date"),
+        "total": "Total OUT Devices",
+        "empty": "अभी कोई OUT device नहीं है।"
+    }
+}
+
+def wa_url(number, text):
+    return f"https://wa.me/{number}?text={urllib.parse.quote(text)}"
+
+def report_block(i, r, date_label, date_col):
+    priority = (r["priority"] or "Regular").strip()
+    icon = PRIORITY_ICONS.get(priority, "🟢")
+    return "\n".join([
+        f"{i}. Customer: {r['customer'] or '-'}",
+        f"   Mobile: {r['phone'] or '-'}",
+        f"   Device: {r['type'] or '-'}",
+        f"   Model: {r['model'] or '-'}",
+        f"   Problem: {r['problem'] or '-'}",
+        f"   Priority: {icon} {priority}",
+        f"   {date_label}: {fmt_date(r[date_col]) or '-'}",
+        f"   Status: {r['status'] or '-'}",
+        "",
+        "--------------------------",
+        "",
+        ""
     ])
 
-
-# ================= WHATSAPP OUT LIST =================
-
-@app.get("/api/out-whatsapp")
-@login_required
-def out_whatsapp():
-
-    conn = get_db()
-    cur = conn.cursor()
-
-    cur.execute("""
-        SELECT *
-        FROM entries
-        WHERE status = 'Out'
-        ORDER BY out_date DESC
-    """)
-
-    rows = cur.fetchall()
-
-    cur.close()
-    conn.close()
-
+def chunk_blocks(head, blocks, foot, number, limit=WHATSAPP_URL_MAX):
+    """
+    Split a report on entry boundaries so every wa.me link stays under
+    limit characters. Each part repeats the header; the total goes last.
+    """
+    reserve = len(urllib.parse.quote("Part 99/99\n\n"))
+    parts, cur = [], []
+
+    def size(bs, tail=""):
+        return len(wa_url(number, head + "".join(bs) + tail)) + reserve
+
+    for b in blocks:
+        if cur and size(cur + [b]) > limit:
+            parts.append(cur)
+            cur = []
+        cur.append(b)
+    if cur and size(cur, foot) > limit:
+        parts.append(cur)
+        cur = []
+    parts.append(cur)
+
+    if len(parts) == 1:
+        return [head + "".join(parts[0]) + foot]
+    return [
+        head + f"Part {n}/{len(parts)}\n\n" + "".join(p)
+        + (foot if n == len(parts) else "")
+        for n, p in enumerate(parts, 1)
+    ]
+
+def render_report(kind, rows):
+    spec = WHATSAPP_REPORTS[kind]
     if not rows:
-        return jsonify({
-            "ok": False,
-            "message": "अभी कोई OUT device नहीं है।"
-        })
+        return {"ok": False, "message": spec["empty"]}
 
-    lines = []
-
-    lines.append("IT SOLUTIONS")
-    lines.append("GHATSILA COLLEGE ROAD")
-    lines.append("")
-    lines.append("⚠️ OUT DEVICE LIST")
-    lines.append("")
+    head = "IT SOLUTIONS\nGHATSILA COLLEGE ROAD\n\n" + spec["title"] + "\n\n"
+    blocks = [report_block(i, r, *spec["date"]) for i, r in enumerate(rows, 1)]
+    foot = f"{spec['total']}: {len(rows)}"
 
-    for i, r in enumerate(rows, 1):
-
-        priority = (r["priority"] or "Regular").strip()
+    texts = chunk_blocks(head, blocks, foot, WHATSAPP_REPORT_NUMBER)
+    urls = [wa_url(WHATSAPP_REPORT_NUMBER, t) for t in texts]
+    return {
+        "ok": True,
+        "count": len(rows),
+        "message": head + "".join(blocks) + foot,
+        "whatsapp_url": urls[0],
+        "whatsapp_urls": urls
+    }
 
-        if priority == "Urgent":
-            p_icon = "🔴"
-        elif priority == "Rework":
-            p_icon = "🔵"
-        else:
-            p_icon = "🟢"
+def whatsapp_report(kind):
+    # cached per entries version, so every worker agrees on fresh data
+    spec = WHATSAPP_REPORTS[kind]
+    cur = get_db().cursor()
+    key = (kind, table_versions(cur, ["entries"])[0],
+           int(time.time() // spec["every"]) if spec.get("every") else 0)
+    cur.close()
 
-        lines.append(
-            f"{i}. Customer: {r['customer'] or '-'}"
-        )
+    data = whatsapp_cache.get(key)
+    if data is None:
+        data = render_report(kind, spec["rows"]())
+        whatsapp_cache.set(key, data, tags=("entries",))
+    return jsonify(data)
 
-        lines.append(
-            f"   Mobile: {r['phone'] or '-'}"
-        )
+def customer_message(r):
+    total = float(r["bill_total"] or 0)
+    return f"IT SOLUTIONS\nModel: {r['model']}\nTotal: ₹{total}"
 
-        lines.append(
-            f"   Device: {r['type'] or '-'}"
-        )
+@app.get("/api/overdue-whatsapp")
+@login_required
+def overdue_whatsapp():
+    return whatsapp_report("overdue")
 
-        lines.append(
-            f"   Model: {r['model'] or '-'}"
-        )
+@app.get("/api/out-whatsapp")
+@login_required
+def out_whatsapp():
+    return whatsapp_report("out")
 
-        lines.append(
-            f"   Problem: {r['problem'] or '-'}"
-        )
+@app.get("/api/entries/<int:eid>/whatsapp")
+@login_required
+def entry_whatsapp(eid):
+    # built on click instead of for every row of /api/entries
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM entries WHERE id=%s", (eid,))
+    r = cur.fetchone()
+    cur.close()
+    if r is None:
+        abort(404)
 
-        lines.append(
-            f"   Priority: {p_icon} {priority}"
-        )
+    digits = "".join(ch for ch in (r["phone"] or "") if ch.isdigit())[-10:]
+    return redirect(wa_url("91" + digits, customer_message(r)))
 
-        lines.append(
-            f"   OUT Date: {r['out_date'] or '-'}"
-        )
+# ================= OUT DEVICES =================
 
-        lines.append(
-            f"   Status: {r['status'] or '-'}"
-        )
+@app.route("/out-devices")
+@login_required
+def out_devices_page():
+    return render_template("out_devices.html")
 
-        lines.append("")
-        lines.append("--------------------------")
-        lines.append("")
 
-    lines.append(
-        f"Total OUT Devices: {len(rows)}"
-    )
+@app.get("/api/out-devices")
+@login_required
+@conditional("entries")
+def out_devices_list():
 
-    message = "\n".join(lines)
+    rows = get_out_entries()
 
-    # WhatsApp number
-    whatsapp_number = "919113171781"
+    return jsonify([
+        row_to_obj(r)
+        for r in rows
+    ])
 
-    whatsapp_url = (
-        "https://wa.me/"
-        + whatsapp_number
-        + "?text="
-        + urllib.parse.quote(message)
-    )
 
-    return jsonify({
-        "ok": True,
-        "count": len(rows),
-        "message": message,
-        "whatsapp_url": whatsapp_url
-    })
 # ================= SERVICE =================
 @app.route("/service")
 @login_required
 def service_page():
     return render_template("service.html")
 
+ENTRIES_PAGE_SIZE = 50
+ENTRIES_PAGE_MAX = 500
+ENTRY_DATE_FIELDS = (
+    "receive_date", "out_date", "in_date",
+    "ready_date", "return_date", "reject_date"
+)
+
+def parse_day(v, end=False):
+    # "2026-08-16" or datetime-local; a bare date used as "to" covers the whole day
+    dt = datetime.datetime.fromisoformat(v)
+    if end and len(v) <= 10:
+        dt += datetime.timedelta(days=1)
+    return dt
+
+def entry_filters(args):
+    """
+    WHERE clause + params from query args:
+    status, priority, type (comma separated), phone (prefix),
+    q (free text), from / to on date_field (default receive_date).
+    Raises ValueError on bad input.
+    """
+    where, params = [], []
+
+    for name, col in (
+        ("status", "status"),
+        ("priority", "COALESCE(priority,'Regular')"),
+        ("type", "type")
+    ):
+        vals = [v.strip() for v in args.get(name, "").split(",") if v.strip()]
+        if vals:
+            where.append(f"{col} = ANY(%s)")
+            params.append(vals)
+
+    phone = args.get("phone", "").strip()
+    if phone:
+        where.append("phone LIKE %s")
+        params.append(phone.replace("%", "") + "%")
+
+    q = args.get("q", "").strip()
+    if q:
+        where.append(
+            "(customer ILIKE %s OR phone ILIKE %s OR model ILIKE %s OR problem ILIKE %s)"
+        )
+        params += [f"%{q}%"] * 4
+
+    field = args.get("date_field", "receive_date")
+    if field not in ENTRY_DATE_FIELDS:
+        raise ValueError("invalid date_field")
+
+    if args.get("from"):
+        where.append(f"{field} >= %s")
+        params.append(parse_day(args["from"]))
+    if args.get("to"):
+        where.append(f"{field} < %s")
+        params.append(parse_day(args["to"], end=True))
+
+    return where, params
+
 @app.get("/api/entries")
 @login_required
+@conditional("entries")
 def list_entries():
+    """
+    Newest first, keyset paginated: ?after_id=<last id seen>&limit=
+    X-Next-After-Id is set while more rows exist; X-Total-Count (rows
+    matching the filters) is sent with the first page.
+    """
+    try:
+        where, params = entry_filters(request.args)
+        limit = max(1, min(
+            int(request.args.get("limit") or ENTRIES_PAGE_SIZE),
+            ENTRIES_PAGE_MAX
+        ))
+        after_id = request.args.get("after_id", type=int)
+    except ValueError:
+        return jsonify({"error": "Invalid filter"}), 400
+
     conn = get_db()
     cur = conn.cursor()
-    cur.execute("SELECT * FROM entries ORDER BY id DESC")
+
+    total = None
+    if after_id is None:
+        cur.execute(
+            "SELECT COUNT(*) n FROM entries"
+            + (" WHERE " + " AND ".join(where) if where else ""),
+            params
+        )
+        total = cur.fetchone()["n"]
+    else:
+        where.append("id < %s")
+        params.append(after_id)
+
+    cur.execute(
+        "SELECT * FROM entries"
+        + (" WHERE " + " AND ".join(where) if where else "")
+        + " ORDER BY id DESC LIMIT %s",
+        params + [limit + 1]
+    )
     rows = cur.fetchall()
     cur.close()
-    conn.close()
 
-    out = []
-    for r in rows:
-        obj = row_to_obj(r)
-        b = obj["bill"]
-        total = b.get("parts_total",0)+b.get("service_charge",0)+b.get("other",0)
-        obj["whatsapp"] = whatsapp_link(obj,total) if obj["status"]=="Delivered" else ""
-        out.append(obj)
+    more = len(rows) > limit
+    rows = rows[:limit]
 
-    return jsonify(out)
+    resp = jsonify([entry_json(r) for r in rows])
+    if total is not None:
+        resp.headers["X-Total-Count"] = str(total)
+    if more:
+        resp.headers["X-Next-After-Id"] = str(rows[-1]["id"])
+    return resp
 
 @app.post("/api/entries")
 @login_required
+@idempotent
 def add_entry():
     d = request.get_json(force=True)
 
@@ -619,41 +3049,67 @@ def add_entry():
         # Agar date blank hai to current date/time
         receive_date = now()
 
-    conn = get_db()
+    fields = {
+        "type": d.get("type", ""),
+        "customer": d.get("customer", ""),
+        "phone": d.get("phone", ""),
+        "model": d.get("model", ""),
+        "problem": d.get("problem", ""),
+        "priority": d.get("priority", "Regular"),
+        "receive_date": receive_date
+    }
+
+    try:
+        conn = get_db()
+    except DatabaseOffline:
+        return offline_write("entry_add", fields, {"ok": True, "receive_date": receive_date})
     cur = conn.cursor()
 
-    cur.execute("""
-    INSERT INTO entries(
-        type,
-        customer,
-        phone,
-        model,
-        problem,
-        priority,
-        receive_date,
-        status
-    )
-    VALUES(%s,%s,%s,%s,%s,%s,%s,%s)
-""", (
-    d.get("type", ""),
-    d.get("customer", ""),
-    d.get("phone", ""),
-    d.get("model", ""),
-    d.get("problem", ""),
-    d.get("priority", "Regular"),
-    receive_date,
-    "Received"
-))
+    insert_entry(cur, fields, current_user()["id"])
 
+    bump_version(cur, "entries")
     conn.commit()
+    invalidate_cache("entries")
     cur.close()
-    conn.close()
 
     return jsonify({
         "ok": True,
         "receive_date": receive_date
     })
 
+def insert_entry(cur, d, user_id=None):
+    # the entry and its first history row go in one statement
+    cur.execute("""
+    WITH e AS (
+        INSERT INTO entries(
+            type,
+            customer,
+            phone,
+            model,
+            problem,
+            priority,
+            receive_date,
+            status
+        )
+        VALUES(%s,%s,%s,%s,%s,%s,%s,%s)
+        RETURNING id, status, receive_date
+    )
+    INSERT INTO entry_events(entry_id, to_status, at, user_id)
+    SELECT id, status, receive_date, %s FROM e
+    RETURNING entry_id
+""", (
+    d["type"],
+    d["customer"],
+    d["phone"],
+    d["model"],
+    d["problem"],
+    d["priority"],
+    d["receive_date"],
+    "Received",
+    user_id
+))
+    return cur.fetchone()["entry_id"]
+
 # ================= ENTRY ACTION =================
 @app.post("/api/entries/<int:eid>/action")
 @login_required
@@ -707,128 +3163,1325 @@ def entry_action(eid):
 
     # ================= UPDATE =================
 
-    conn = get_db()
+    try:
+        conn = get_db()
+    except DatabaseOffline:
+        return offline_write(
+            "entry_action",
+            {"eid": eid, "status": status, "column": col, "date": action_time},
+            {"ok": True, "status": status, "date": action_time}
+        )
     cur = conn.cursor()
 
+    if not update_entry_status(cur, eid, status, col, action_time, current_user()["id"]):
+        conn.rollback()
+        cur.close()
+        return jsonify({"error": "Entry not found"}), 404
+
+    bump_version(cur, "entries")
+    conn.commit()
+    invalidate_cache("entries")
+
+    cur.close()
+
+    return jsonify({
+        "ok": True,
+        "status": status,
+        "date": action_time
+    })
+
+def update_entry_status(cur, eid, status, col, when, user_id=None):
+    # col comes from the action map, never from the request.
+    # Old status is read under the row lock, history row written in the
+    # same statement
     cur.execute(
         f"""
-        UPDATE entries
-        SET status=%s, {col}=%s
-        WHERE id=%s
+        WITH old AS (
+            SELECT id, status FROM entries WHERE id=%s FOR UPDATE
+        ), e AS (
+            UPDATE entries
+            SET status=%s, {col}=%s
+            FROM old
+            WHERE entries.id = old.id
+            RETURNING entries.id, old.status AS from_status, entries.{col} AS at
+        )
+        INSERT INTO entry_events(entry_id, from_status, to_status, at, user_id)
+        SELECT id, from_status, %s, at, %s FROM e
         """,
         (
+            eid,
             status,
-            action_time,
-            eid
+            when,
+            status,
+            user_id
         )
     )
+    return cur.rowcount
 
-    conn.commit()
+# ================= BILL =================
+@app.post("/api/entries/<int:eid>/bill")
+@login_required
+@idempotent
+def save_bill(eid):
+    d=request.get_json(force=True)
+    try:
+        bill={
+            "parts_total":float(d.get("parts_total") or 0),
+            "service_charge":float(d.get("service_charge") or 0),
+            "other":float(d.get("other") or 0)
+        }
+        if not all(math.isfinite(v) for v in bill.values()):
+            raise ValueError
+    except (TypeError, ValueError):
+        return jsonify({"error":"Invalid amount"}),400
+    total=sum(bill.values())
+
+    conn=get_db();cur=conn.cursor()
+    cur.execute("""
+        UPDATE entries
+        SET bill_parts=%s, bill_service=%s, bill_other=%s, billed_at=now()
+        WHERE id=%s
+        RETURNING id
+    """,(bill["parts_total"],bill["service_charge"],bill["other"],eid))
+    if cur.fetchone() is None:
+        conn.rollback();cur.close()
+        return jsonify({"error":"Entry not found"}),404
+
+    # one sale per job: saving the bill again replaces it
+    cur.execute("""
+        INSERT INTO sales(entry_id,sale_date,item,qty,rate,amount,payment_mode,note)
+        VALUES(%s,now(),'Service',1,%s,%s,%s,%s)
+        ON CONFLICT (entry_id) DO UPDATE
+        SET sale_date=EXCLUDED.sale_date, rate=EXCLUDED.rate,
+            amount=EXCLUDED.amount, payment_mode=EXCLUDED.payment_mode
+    """,(eid,total,total,d.get("payment_mode") or "Cash",f"Entry {eid}"))
+    bump_version(cur, "entries", "sales")
+    conn.commit();cur.close()
+    invalidate_cache("entries", "sales")
+    return jsonify({"ok":True})
+
+# ================= REVENUE =================
+REVENUE_GROUPS = {
+    "day": "to_char(billed_at, 'YYYY-MM-DD')",
+    "month": "to_char(billed_at, 'YYYY-MM')",
+    "type": "COALESCE(NULLIF(type, ''), 'Other')",
+}
+
+@app.get("/api/revenue")
+@login_required
+@conditional("entries")
+def revenue():
+    """
+    Billed revenue grouped by ?by=day|month|type, optional from / to on
+    the bill date. Summed in SQL from the typed bill columns.
+    """
+    key = REVENUE_GROUPS.get(request.args.get("by", "day"))
+    if key is None:
+        return jsonify({"error": "by must be day, month or type"}), 400
+
+    where, params = ["billed_at IS NOT NULL"], []
+    try:
+        if request.args.get("from"):
+            where.append("billed_at >= %s")
+            params.append(parse_day(request.args["from"]))
+        if request.args.get("to"):
+            where.append("billed_at < %s")
+            params.append(parse_day(request.args["to"], end=True))
+    except ValueError:
+        return jsonify({"error": "Invalid date"}), 400
+
+    conn = get_db()
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT {key} AS key,
+               COUNT(*) AS jobs,
+               SUM(bill_parts)::float8 AS parts,
+               SUM(bill_service)::float8 AS service,
+               SUM(bill_other)::float8 AS other,
+               SUM(bill_total)::float8 AS total
+        FROM entries
+        WHERE {" AND ".join(where)}
+        GROUP BY 1
+        ORDER BY 1
+    """, params)
+    rows = cur.fetchall()
+    cur.close()
+
+    return jsonify({
+        "rows": rows,
+        "total": round(sum(r["total"] for r in rows), 2)
+    })
+
+# ================= SALES =================
+SALES_PAGE_SIZE = 50
+SALES_PAGE_MAX = 500
+SALE_PAYMENT_MODES = ("Cash", "Online", "Card")
+SALES_ROLLUP_PERIODS = {
+    "day": "day",
+    "month": "date_trunc('month', day)::date"
+}
+
+def sale_json(r):
+    return {
+        "id": r["id"],
+        "sale_date": fmt_date(r["sale_date"]),
+        "item": r["item"],
+        "qty": r["qty"],
+        "rate": r["rate"],
+        "amount": r["amount"],
+        "payment_mode": r["payment_mode"],
+        "note": r["note"],
+        "entry_id": r["entry_id"]
+    }
+
+def sales_rollup(args, by):
+    """
+    Totals per day / month from sales_daily, never from sales itself.
+    ?from=&to= dates (to included), ?payment_mode=Cash,UPI.
+    """
+    where, params = [], []
+    if args.get("from"):
+        where.append("day >= %s")
+        params.append(datetime.date.fromisoformat(args["from"]))
+    if args.get("to"):
+        where.append("day <= %s")
+        params.append(datetime.date.fromisoformat(args["to"]))
+    modes = [m for m in args.get("payment_mode", "").split(",") if m]
+    if modes:
+        where.append("payment_mode = ANY(%s)")
+        params.append(modes)
+
+    cur = get_db().cursor()
+    cur.execute(
+        f"""
+        SELECT {by},
+               SUM(sale_count)::int AS sales,
+               SUM(amount)::float8 AS amount,
+               json_object_agg(payment_mode, amount::float8) AS by_mode
+        FROM (
+            SELECT {SALES_ROLLUP_PERIODS[by]} AS {by}, payment_mode,
+                   SUM(sale_count) AS sale_count, SUM(amount) AS amount
+            FROM sales_daily
+        """
+        + (" WHERE " + " AND ".join(where) if where else "")
+        + f""" GROUP BY 1, 2
+        ) d
+        GROUP BY 1 HAVING SUM(sale_count) > 0 ORDER BY 1
+        """,
+        params
+    )
+    rows = cur.fetchall()
+    cur.close()
+    return {
+        "rows": rows,
+        "total": round(sum(r["amount"] for r in rows), 2)
+    }
+
+def sales_page(args):
+    """
+    Newest sale first. Keyset on (sale_date, id): ?after_id=<last id seen>
+    continues below that sale, so backdated counter sales page cleanly.
+    Filters: payment_mode (comma list), kind=service|counter, from / to.
+    Returns (rows, more).
+    """
+    where, params = ["sale_date IS NOT NULL"], []
+    modes = [m for m in args.get("payment_mode", "").split(",") if m]
+    if modes:
+        where.append("payment_mode = ANY(%s)")
+        params.append(modes)
+    kind = args.get("kind")
+    if kind == "service":
+        where.append("entry_id IS NOT NULL")
+    elif kind == "counter":
+        where.append("entry_id IS NULL")
+    elif kind:
+        raise ValueError("invalid kind")
+    if args.get("from"):
+        where.append("sale_date >= %s")
+        params.append(parse_day(args["from"]))
+    if args.get("to"):
+        where.append("sale_date < %s")
+        params.append(parse_day(args["to"], end=True))
+    if args.get("after_id"):
+        where.append("(sale_date, id) < (SELECT sale_date, id FROM sales WHERE id = %s)")
+        params.append(int(args["after_id"]))
+    limit = max(1, min(int(args.get("limit") or SALES_PAGE_SIZE), SALES_PAGE_MAX))
+
+    cur = get_db().cursor()
+    cur.execute(
+        "SELECT * FROM sales WHERE " + " AND ".join(where)
+        + " ORDER BY sale_date DESC, id DESC LIMIT %s",
+        params + [limit + 1]
+    )
+    rows = cur.fetchall()
+    cur.close()
+    return [sale_json(r) for r in rows[:limit]], len(rows) > limit
+
+def insert_sales(cur, lines):
+    """
+    Counter sales (no job): [{"item", "qty", "rate", "payment_mode"?,
+    "note"?, "date"?}, ...]. amount = qty * rate. Invalid lines are
+    reported and skipped; the rest go out in one execute_values().
+    Returns one result dict per line.
+    """
+    results, rows = [], []
+    for n, s in enumerate(lines, 1):
+        try:
+            item = str(s["item"]).strip()
+            qty = float(s["qty"])
+            rate = float(s["rate"])
+            # NaN slips through every comparison below
+            if not (math.isfinite(qty) and math.isfinite(rate)):
+                raise ValueError
+            if not item or qty <= 0 or rate < 0:
+                raise ValueError
+            when = (
+                datetime.datetime.fromisoformat(s["date"])
+                if s.get("date") else now_ist()
+            )
+        except (KeyError, TypeError, ValueError):
+            results.append({"line": n, "ok": False, "error": "Invalid line"})
+            continue
+        results.append({"line": n, "ok": True, "amount": round(qty * rate, 2)})
+        rows.append((
+            when, item, qty, rate, round(qty * rate, 2),
+            str(s.get("payment_mode") or "Cash"), str(s.get("note") or "")
+        ))
+
+    if rows:
+        ids = psycopg2.extras.execute_values(cur, """
+            INSERT INTO sales(sale_date, item, qty, rate, amount, payment_mode, note)
+            VALUES %s
+            RETURNING id
+        """, rows, fetch=True)
+        ok = [r for r in results if r["ok"]]
+        for res, row in zip(ok, ids):
+            res["id"] = row["id"]
+    return results
+
+@app.route("/sales", methods=["GET", "POST"])
+@login_required
+def sales_view():
+    msg = None
+    if request.method == "POST":
+        # one or more item rows, payment and note shared
+        f = request.form
+        lines = [
+            {"item": i, "qty": q, "rate": r,
+             "payment_mode": f.get("payment"), "note": f.get("note")}
+            for i, q, r in zip(f.getlist("item"), f.getlist("qty"), f.getlist("rate"))
+            if i.strip()
+        ]
+        conn = get_db()
+        cur = conn.cursor()
+        results = insert_sales(cur, lines)
+        saved = sum(1 for r in results if r["ok"])
+        if saved:
+            bump_version(cur, "sales")
+        conn.commit()
+        cur.close()
+        if saved:
+            invalidate_cache("sales")
+        msg = f"{saved} sale(s) saved" + (
+            f", {len(results) - saved} line(s) galat the" if saved < len(results) else ""
+        )
+
+    try:
+        rows, more = sales_page(request.args)
+        # totals for the picked range, else the last 30 days; day-wise up
+        # to two months, month-wise beyond
+        today = now_ist().date()
+        to = datetime.date.fromisoformat(request.args.get("to", "")[:10] or today.isoformat())
+        start = (
+            datetime.date.fromisoformat(request.args["from"][:10])
+            if request.args.get("from") else to - datetime.timedelta(days=29)
+        )
+        by = "day" if (to - start).days <= 62 else "month"
+        totals = sales_rollup({
+            "from": start.isoformat(),
+            "to": to.isoformat(),
+            "payment_mode": request.args.get("payment_mode", "")
+        }, by)
+    except ValueError:
+        return "Invalid filter", 400
+
+    # filter list: the form's modes plus any older sales used (UPI etc.)
+    cur = get_db().cursor()
+    cur.execute("SELECT DISTINCT payment_mode FROM sales_daily WHERE payment_mode != ''")
+    modes = sorted(set(SALE_PAYMENT_MODES) | {r["payment_mode"] for r in cur.fetchall()})
+    cur.close()
+
+    return render_template(
+        "sales.html",
+        rows=rows,
+        next_after=rows[-1]["id"] if more else None,
+        totals=totals,
+        by=by,
+        total=totals["total"],
+        modes=modes,
+        pay_modes=SALE_PAYMENT_MODES,
+        msg=msg
+    )
+
+@app.get("/api/sales")
+@login_required
+@conditional("sales")
+def sales_list():
+    """X-Next-After-Id is set while more rows exist (see sales_page)."""
+    try:
+        rows, more = sales_page(request.args)
+    except ValueError:
+        return jsonify({"error": "Invalid filter"}), 400
+    resp = jsonify(rows)
+    if more:
+        resp.headers["X-Next-After-Id"] = str(rows[-1]["id"])
+    return resp
+
+@app.get("/api/sales/totals")
+@app.get("/api/sales/daily", defaults={"by": "day"})
+@login_required
+@conditional("sales")
+def sales_totals(by=None):
+    """
+    ?by=day|month&from=&to=&payment_mode= from the sales_daily rollup.
+    /api/sales/daily is the same view fixed to by=day.
+    """
+    by = by or request.args.get("by", "day")
+    if by not in SALES_ROLLUP_PERIODS:
+        return jsonify({"error": "by must be day or month"}), 400
+    try:
+        return jsonify(sales_rollup(request.args, by))
+    except ValueError:
+        return jsonify({"error": "Invalid date"}), 400
+
+@app.post("/api/sales")
+@login_required
+@idempotent
+def add_sales():
+    """
+    {"sales": [{"item", "qty", "rate", ...}, ...], "atomic": false}, or
+    one sale object. One transaction; with atomic=true an invalid line
+    saves nothing.
+    """
+    d = request.get_json(force=True)
+    if isinstance(d, dict) and "sales" not in d:
+        lines, atomic = [d], True
+    else:
+        lines = d.get("sales") if isinstance(d, dict) else d
+        atomic = isinstance(d, dict) and bool(d.get("atomic"))
+    if not isinstance(lines, list) or not lines:
+        return jsonify({"error": "sales required"}), 400
+
+    conn = get_db()
+    cur = conn.cursor()
+    results = insert_sales(cur, lines)
+    failed = sum(1 for r in results if not r["ok"])
+    applied = 0 if failed and atomic else len(results) - failed
+
+    if not applied:
+        # 400 below; nothing to keep
+        conn.rollback()
+    else:
+        bump_version(cur, "sales")
+        conn.commit()
+        invalidate_cache("sales")
+    cur.close()
+
+    resp = jsonify({
+        "ok": failed == 0,
+        "applied": applied,
+        "failed": failed,
+        "results": results
+    })
+    if not applied:
+        resp.status_code = 400
+    return resp
+
+# ================= OVERDUE =================
+
+# Overdue Page
+@app.route("/overdue")
+@login_required
+def overdue_page():
+    return render_template("overdue.html")
+
+
+# Overdue API
+@app.get("/api/overdue")
+@login_required
+@conditional("entries", every=60)
+def overdue_list():
+
+    rows = get_overdue_entries()
+
+    return jsonify([
+        row_to_obj(r)
+        for r in rows
+    ])
+
+
+
+
+# ================= ACTIVITY =================
+# entry_events: one row per status change, written in the same statement
+# as the change (insert_entry, update_entry_status, delete_entry)
+ACTIVITY_PAGE_SIZE = 50
+ACTIVITY_PAGE_MAX = 500
+TURNAROUND_DAYS = int(os.environ.get("TURNAROUND_DAYS", 90))
+TURNAROUND_CACHE_TTL = 300
+# no time is spent "in" these, the job is over
+FINAL_STATUSES = ("Delivered", "Rejected")
+
+turnaround_cache = TTLCache(TURNAROUND_CACHE_TTL, maxsize=16)
+
+def event_json(r):
+    if r["from_status"] is None:
+        action = "New entry"
+    elif r["to_status"] is None:
+        action = f"Deleted ({r['from_status']})"
+    else:
+        action = f"{r['from_status']} → {r['to_status']}"
+    return {
+        "id": r["id"],
+        "entry_id": r["entry_id"],
+        "customer": r["customer"],
+        "model": r["model"],
+        "priority": r["priority"],
+        "from_status": r["from_status"],
+        "to_status": r["to_status"],
+        "action": action,
+        "at": fmt_date(r["at"]),
+        "recorded_at": fmt_date(r["recorded_at"]),
+        "user": r["username"]
+    }
+
+def activity_page(args):
+    """
+    Newest event time first. Keyset on (at, id): ?after_id=<last id seen>
+    continues below that event, so backdated actions still page cleanly.
+    Filters: entry_id, user_id, status (to_status), from / to (event time).
+    Returns (rows, more).
+    """
+    where, params = [], []
+    for arg, col in (("entry_id", "v.entry_id"), ("user_id", "v.user_id")):
+        if args.get(arg):
+            where.append(f"{col} = %s")
+            params.append(int(args[arg]))
+    if args.get("status"):
+        where.append("v.to_status = %s")
+        params.append(args["status"])
+    if args.get("from"):
+        where.append("v.at >= %s")
+        params.append(parse_day(args["from"]))
+    if args.get("to"):
+        where.append("v.at < %s")
+        params.append(parse_day(args["to"], end=True))
+    if args.get("after_id"):
+        where.append("(v.at, v.id) < (SELECT at, id FROM entry_events WHERE id = %s)")
+        params.append(int(args["after_id"]))
+    limit = max(1, min(int(args.get("limit") or ACTIVITY_PAGE_SIZE), ACTIVITY_PAGE_MAX))
+
+    cur = get_db().cursor()
+    cur.execute(
+        """
+        SELECT v.*, u.username, e.customer, e.model, e.priority
+        FROM entry_events v
+        LEFT JOIN users u ON u.id = v.user_id
+        LEFT JOIN entries e ON e.id = v.entry_id
+        """
+        + (" WHERE " + " AND ".join(where) if where else "")
+        + " ORDER BY v.at DESC, v.id DESC LIMIT %s",
+        params + [limit + 1]
+    )
+    rows = cur.fetchall()
+    cur.close()
+    return [event_json(r) for r in rows[:limit]], len(rows) > limit
+
+def turnaround(start, end):
+    """
+    Hours spent in each status, per priority, for jobs received in
+    [start, end). A span runs from one event of the entry to its next one;
+    the current status of an open job counts up to now.
+    """
+    key = (start.isoformat(), end.isoformat())
+    data = turnaround_cache.get(key)
+    if data is not None:
+        return data
+
+    cur = get_db().cursor()
+    cur.execute("""
+        WITH cohort AS (
+            SELECT entry_id FROM entry_events
+            WHERE from_status IS NULL AND at >= %(start)s AND at < %(end)s
+        ), spans AS (
+            SELECT v.entry_id, v.to_status AS status,
+                   EXTRACT(EPOCH FROM COALESCE(
+                       lead(v.at) OVER (PARTITION BY v.entry_id ORDER BY v.at, v.id),
+                       now()
+                   ) - v.at) / 3600 AS hours,
+                   lead(v.at) OVER (PARTITION BY v.entry_id ORDER BY v.at, v.id) IS NULL AS open
+            FROM entry_events v
+            JOIN cohort USING (entry_id)
+        )
+        SELECT COALESCE(NULLIF(btrim(e.priority), ''), 'Regular') AS priority,
+               s.status,
+               COUNT(*) AS jobs,
+               COUNT(*) FILTER (WHERE s.open) AS open,
+               round(avg(s.hours)::numeric, 1)::float8 AS avg_hours,
+               round((percentile_cont(0.5) WITHIN GROUP (ORDER BY s.hours))::numeric, 1)::float8 AS p50_hours,
+               round((percentile_cont(0.9) WITHIN GROUP (ORDER BY s.hours))::numeric, 1)::float8 AS p90_hours
+        FROM spans s
+        JOIN entries e ON e.id = s.entry_id
+        WHERE s.status IS NOT NULL AND s.status != ALL(%(final)s)
+        GROUP BY 1, 2
+        ORDER BY 1, 2
+    """, {"start": start, "end": end, "final": list(FINAL_STATUSES)})
+    statuses = cur.fetchall()
+
+    # receive -> final status, finished jobs only
+    cur.execute("""
+        WITH jobs AS (
+            SELECT entry_id,
+                   MIN(at) FILTER (WHERE from_status IS NULL) AS received,
+                   MAX(at) FILTER (WHERE to_status = ANY(%(final)s)) AS closed
+            FROM entry_events
+            WHERE entry_id IN (
+                SELECT entry_id FROM entry_events
+                WHERE from_status IS NULL AND at >= %(start)s AND at < %(end)s
+            )
+            GROUP BY entry_id
+        ), t AS (
+            SELECT COALESCE(NULLIF(btrim(e.priority), ''), 'Regular') AS priority,
+                   EXTRACT(EPOCH FROM j.closed - j.received) / 3600 AS hours
+            FROM jobs j
+            JOIN entries e ON e.id = j.entry_id
+            WHERE j.closed IS NOT NULL
+        )
+        SELECT priority,
+               COUNT(*) AS jobs,
+               round(avg(hours)::numeric, 1)::float8 AS avg_hours,
+               round((percentile_cont(0.5) WITHIN GROUP (ORDER BY hours))::numeric, 1)::float8 AS p50_hours,
+               round((percentile_cont(0.9) WITHIN GROUP (ORDER BY hours))::numeric, 1)::float8 AS p90_hours
+        FROM t
+        GROUP BY priority
+        ORDER BY priority
+    """, {"start": start, "end": end, "final": list(FINAL_STATUSES)})
+    totals = cur.fetchall()
+    cur.close()
+
+    data = {
+        "from": fmt_date(start),
+        "to": fmt_date(end),
+        "statuses": statuses,
+        "total": totals
+    }
+    turnaround_cache.set(key, data, tags=("entries",))
+    return data
+
+def turnaround_window(args):
+    # default: jobs received in the last TURNAROUND_DAYS
+    ist = ZoneInfo("Asia/Kolkata")
+    if args.get("to"):
+        end = parse_day(args["to"], end=True).replace(tzinfo=ist)
+    else:
+        # whole minutes, so turnaround_cache gets hits
+        end = now_ist().replace(second=0, microsecond=0)
+    if args.get("from"):
+        start = parse_day(args["from"]).replace(tzinfo=ist)
+    else:
+        start = end - datetime.timedelta(days=TURNAROUND_DAYS)
+    return start, end
+
+@app.route("/activity")
+@login_required
+def activity_log():
+    try:
+        logs, more = activity_page(request.args)
+        report = turnaround(*turnaround_window(request.args))
+    except ValueError:
+        return "Invalid filter", 400
+    return render_template(
+        "activity.html",
+        logs=logs,
+        next_after=logs[-1]["id"] if more else None,
+        turnaround=report
+    )
+
+@app.get("/api/activity")
+@login_required
+@conditional("entries")
+def activity_api():
+    try:
+        rows, more = activity_page(request.args)
+    except ValueError:
+        return jsonify({"error": "Invalid filter"}), 400
+    resp = jsonify(rows)
+    if more:
+        resp.headers["X-Next-After-Id"] = str(rows[-1]["id"])
+    return resp
+
+@app.get("/api/entries/<int:eid>/timeline")
+@login_required
+@conditional("entries")
+def entry_timeline(eid):
+    # oldest first, with the hours the job sat in each status
+    cur = get_db().cursor()
+    cur.execute("""
+        SELECT v.*, u.username, e.customer, e.model, e.priority,
+               EXTRACT(EPOCH FROM lead(v.at) OVER w - v.at) / 3600 AS hours
+        FROM entry_events v
+        LEFT JOIN users u ON u.id = v.user_id
+        LEFT JOIN entries e ON e.id = v.entry_id
+        WHERE v.entry_id = %s
+        WINDOW w AS (ORDER BY v.at, v.id)
+        ORDER BY v.at, v.id
+    """, (eid,))
+    rows = cur.fetchall()
+    cur.close()
+    if not rows:
+        return jsonify({"error": "Entry not found"}), 404
+    return jsonify([
+        dict(event_json(r), hours=round(float(r["hours"]), 1) if r["hours"] is not None else None)
+        for r in rows
+    ])
+
+@app.get("/api/activity/turnaround")
+@login_required
+@conditional("entries", every=TURNAROUND_CACHE_TTL)
+def turnaround_api():
+    try:
+        return jsonify(turnaround(*turnaround_window(request.args)))
+    except ValueError:
+        return jsonify({"error": "Invalid date"}), 400
+
+# ================= ANALYTICS =================
+# Materialized views from migration 13. `flask analytics-refresh` (cron)
+# or the jobs worker, every ANALYTICS_REFRESH_EVERY seconds, refreshes
+# the views whose source changed since their last refresh.
+ANALYTICS_REFRESH_EVERY = int(os.environ.get("ANALYTICS_REFRESH_EVERY", 600))
+ANALYTICS_LOCK = 7303  # pg advisory lock key
+# view -> change_versions name of its source tables
+ANALYTICS_VIEWS = {
+    "analytics_turnaround": "entries",
+    "analytics_volume": "entries",
+    "analytics_throughput": "entries"
+}
+
+def refresh_analytics(conn, force=False, log=print):
+    """
+    Refresh stale views CONCURRENTLY, readers keep the old rows meanwhile.
+    Returns the refreshed names, or None while another process refreshes.
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT pg_try_advisory_lock(%s) ok", (ANALYTICS_LOCK,))
+    if not cur.fetchone()["ok"]:
+        conn.commit()
+        cur.close()
+        return None
+
+    done = []
+    try:
+        cur.execute("SELECT view, source_version FROM analytics_refreshes")
+        last = {r["view"]: r["source_version"] for r in cur.fetchall()}
+        for view, source in ANALYTICS_VIEWS.items():
+            # read first: the refresh then sees at least this version
+            version = table_versions(cur, [source])[0]
+            if not force and last.get(view) == version:
+                continue
+            t = time.perf_counter()
+            cur.execute(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {view}")
+            cur.execute("""
+                INSERT INTO analytics_refreshes(view, source_version, refreshed_at, seconds)
+                VALUES(%s, %s, now(), %s)
+                ON CONFLICT (view) DO UPDATE
+                SET source_version=EXCLUDED.source_version,
+                    refreshed_at=EXCLUDED.refreshed_at, seconds=EXCLUDED.seconds
+            """, (view, version, time.perf_counter() - t))
+            conn.commit()
+            done.append(view)
+            log(f"{view}: refreshed in {time.perf_counter() - t:.2f}s")
+        if done:
+            bump_version(cur, "analytics")
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(%s)", (ANALYTICS_LOCK,))
+        conn.commit()
+        cur.close()
+    return done
+
+@app.cli.command("analytics-refresh")
+@click.option("--force", is_flag=True, help="Refresh even if nothing changed.")
+def analytics_refresh_command(force):
+    """Refresh the analytics materialized views."""
+    conn = connect()
+    done = refresh_analytics(conn, force, log=click.echo)
+    if done is None:
+        click.echo("Another refresh is running")
+    elif not done:
+        click.echo("Analytics up to date")
+    conn.close()
+
+def hours_bucket_mid(bucket):
+    # middle of an analytics_hours_bucket() bucket; the last one is open
+    if bucket is None:
+        return None
+    width = 1 if bucket < 48 else 6 if bucket < 168 else 24 if bucket < 1440 else 0
+    return bucket + width / 2
+
+def analytics_where(args, period, days):
+    """
+    from / to (dates) on the period column; default the last `days` days.
+    type= and priority= narrow to one value.
+    """
+    to = parse_day(args["to"], end=True).date() if args.get("to") else now_ist().date() + datetime.timedelta(days=1)
+    start = parse_day(args["from"]).date() if args.get("from") else to - datetime.timedelta(days=days)
+    unit = "month" if period.endswith("month") else "week"
+    where = [f"{period} >= date_trunc('{unit}', %s::date)", f"{period} < %s"]
+    params = [start, to]
+    for col in ("type", "priority"):
+        if args.get(col):
+            where.append(f"{col} = %s")
+            params.append(args[col])
+    return " WHERE " + " AND ".join(where), params
+
+def analytics_turnaround(args):
+    """
+    Receive -> ready hours grouped by ?by= (month, type, priority; default
+    type,priority). Medians come from the bucket counts, to within half a
+    bucket (30 min under 2 days, 3 h under a week, 12 h beyond).
+    """
+    dims = [d for d in args.get("by", "type,priority").split(",") if d]
+    if not dims or not set(dims) <= {"month", "type", "priority"}:
+        raise ValueError("invalid by")
+    cols = ", ".join(dims)
+    where, params = analytics_where(args, "month", 365)
+
+    cur = get_db().cursor()
+    cur.execute(f"""
+        WITH b AS (
+            SELECT {cols}, bucket, SUM(jobs) AS jobs, SUM(sum_hours) AS sum_hours
+            FROM analytics_turnaround
+            {where}
+            GROUP BY {cols}, bucket
+        ), c AS (
+            SELECT *,
+                   SUM(jobs) OVER (PARTITION BY {cols} ORDER BY bucket) AS cum,
+                   SUM(jobs) OVER (PARTITION BY {cols}) AS total
+            FROM b
+        )
+        SELECT {cols},
+               MAX(total)::int AS jobs,
+               round((SUM(sum_hours) / MAX(total))::numeric, 1)::float8 AS avg_hours,
+               MIN(bucket) FILTER (WHERE cum >= total * 0.5) AS p50,
+               MIN(bucket) FILTER (WHERE cum >= total * 0.9) AS p90
+        FROM c
+        GROUP BY {cols}
+        ORDER BY {cols}
+    """, params)
+    rows = cur.fetchall()
+    cur.close()
+    for r in rows:
+        if "month" in r:
+            r["month"] = r["month"].isoformat()
+        r["p50_hours"] = hours_bucket_mid(r.pop("p50"))
+        r["p90_hours"] = hours_bucket_mid(r.pop("p90"))
+    return rows
+
+def analytics_volume(args):
+    # weekly jobs received / delivered / rejected; rework = Rework priority
+    where, params = analytics_where(args, "week", 84)
+    cur = get_db().cursor()
+    cur.execute(f"""
+        SELECT week,
+               SUM(received)::int AS received,
+               SUM(delivered)::int AS delivered,
+               SUM(rejected)::int AS rejected,
+               COALESCE(SUM(received) FILTER (WHERE priority = 'Rework'), 0)::int AS rework
+        FROM analytics_volume
+        {where}
+        GROUP BY week
+        ORDER BY week
+    """, params)
+    rows = cur.fetchall()
+    cur.close()
+    for r in rows:
+        r["week"] = r["week"].isoformat()
+        r["rework_ratio"] = round(r["rework"] / r["received"], 3) if r["received"] else None
+    return rows
+
+def analytics_throughput(args):
+    # status changes made by each user, e.g. Ready = jobs repaired
+    where, params = analytics_where(
+        {k: v for k, v in args.items() if k in ("from", "to")}, "t.week", 28
+    )
+    cur = get_db().cursor()
+    cur.execute(f"""
+        SELECT t.user_id, u.username, t.status, SUM(t.events)::int AS n
+        FROM analytics_throughput t
+        LEFT JOIN users u ON u.id = t.user_id
+        {where}
+        GROUP BY t.user_id, u.username, t.status
+    """, params)
+    users = {}
+    for r in cur.fetchall():
+        u = users.setdefault(r["user_id"], {
+            "user_id": r["user_id"], "user": r["username"], "total": 0, "statuses": {}
+        })
+        u["statuses"][r["status"]] = r["n"]
+        u["total"] += r["n"]
+    cur.close()
+    return sorted(users.values(), key=lambda u: -u["total"])
 
+def analytics_refreshed_at():
+    cur = get_db().cursor()
+    cur.execute("SELECT MIN(refreshed_at) t FROM analytics_refreshes")
+    t = cur.fetchone()["t"]
     cur.close()
-    conn.close()
+    return fmt_date(t)
+
+ANALYTICS_REPORTS = {
+    "turnaround": analytics_turnaround,
+    "volume": analytics_volume,
+    "throughput": analytics_throughput
+}
 
+@app.get("/api/analytics")
+@login_required
+@conditional("analytics", every=3600)
+def analytics_overview():
+    # everything the dashboard charts need, default windows
     return jsonify({
-        "ok": True,
-        "status": status,
-        "date": action_time
+        "refreshed_at": analytics_refreshed_at(),
+        "turnaround": analytics_turnaround({"by": "priority"}),
+        "turnaround_by_type": analytics_turnaround({"by": "type,priority"}),
+        "volume": analytics_volume({}),
+        "throughput": analytics_throughput({})
     })
 
-# ================= BILL =================
-@app.post("/api/entries/<int:eid>/bill")
+@app.get("/api/analytics/<report>")
 @login_required
-def save_bill(eid):
-    d=request.get_json(force=True)
-    bill={
-        "parts_total":float(d.get("parts_total") or 0),
-        "service_charge":float(d.get("service_charge") or 0),
-        "other":float(d.get("other") or 0)
-    }
-    total=sum(bill.values())
+@conditional("analytics", every=3600)
+def analytics_report(report):
+    if report not in ANALYTICS_REPORTS:
+        return jsonify({"error": "Unknown report"}), 404
+    try:
+        rows = ANALYTICS_REPORTS[report](request.args)
+    except ValueError:
+        return jsonify({"error": "Invalid filter"}), 400
+    return jsonify({"refreshed_at": analytics_refreshed_at(), "rows": rows})
 
-    conn=get_db();cur=conn.cursor()
-    cur.execute("UPDATE entries SET bill_json=%s WHERE id=%s",(json.dumps(bill),eid))
-    cur.execute("""
-        INSERT INTO sales(sale_date,item,qty,rate,amount,payment_mode,note)
-        VALUES(%s,%s,1,%s,%s,%s,%s)
-    """,(now(),"Service",total,total,"Cash",f"Entry {eid}"))
-    conn.commit();cur.close();conn.close()
-    return jsonify({"ok":True})
+# ================= EXPORT =================
+EXPORT_ITERSIZE = int(os.environ.get("EXPORT_ITERSIZE", 2000))
+EXPORT_CHUNK_BYTES = 64 * 1024
 
-# ================= OVERDUE =================
+ENTRY_EXPORT_COLUMNS = (
+    "id", "type", "customer", "phone", "model", "problem",
+    "receive_date", "out_date", "in_date", "ready_date", "return_date", "reject_date",
+    "status", "bill_parts", "bill_service", "bill_other", "bill_total", "priority"
+)
 
-# Overdue Page
-@app.route("/overdue")
-@login_required
-def overdue_page():
-    return render_template("overdue.html")
+def csv_chunks(header, rows):
+    # CSV text in ~64KB pieces
+    si = StringIO()
+    cw = csv.writer(si)
+    cw.writerow(header)
 
+    for r in rows:
+        cw.writerow([fmt_date(v) for v in r])
+        if si.tell() >= EXPORT_CHUNK_BYTES:
+            yield si.getvalue()
+            si.seek(0)
+            si.truncate()
+
+    yield si.getvalue()
+
+def gzip_chunks(chunks):
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31 = gzip container
+    for c in chunks:
+        data = z.compress(c.encode("utf-8"))
+        if data:
+            yield data
+    yield z.flush()
+
+def export_cursor(name, sql, params):
+    # server-side cursor: rows arrive EXPORT_ITERSIZE at a time
+    cur = get_db().cursor(name=name, cursor_factory=psycopg2.extensions.cursor)
+    cur.itersize = EXPORT_ITERSIZE
+    cur.execute(sql, params)
+    return cur
+
+def stream_csv(filename, header, cur):
+    # the request is torn down before the body is sent, so the
+    # connection is held by the generator until the stream ends
+    conn = g.pop("db")
+
+    def release():
+        try:
+            cur.close()
+        except psycopg2.Error:
+            pass
+        get_pool().putconn(conn)
+
+    body = csv_chunks(header, cur)
+    mimetype = "text/csv"
+
+    if request.args.get("gzip"):
+        body = gzip_chunks(body)
+        mimetype = "application/gzip"
+        filename += ".gz"
+
+    resp = Response(
+        body,
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment;filename={filename}"}
+    )
+    resp.call_on_close(release)
+    return resp
+
+def entries_export(args):
+    # same filters as /api/entries (status, from, to, ...)
+    where, params = entry_filters(args)
+    sql = (
+        f"SELECT {','.join(ENTRY_EXPORT_COLUMNS)} FROM entries"
+        + (" WHERE " + " AND ".join(where) if where else "")
+        + " ORDER BY id"
+    )
+    return "entries.csv", ENTRY_EXPORT_COLUMNS, sql, params
+
+def ink_export(args):
+    # ?from=&to= on action_date, ?action=IN|SELL
+    where, params = [], []
+    if args.get("from"):
+        where.append("action_date >= %s")
+        params.append(parse_day(args["from"]))
+    if args.get("to"):
+        where.append("action_date < %s")
+        params.append(parse_day(args["to"], end=True))
+
+    action = args.get("action", "").strip().upper()
+    if action:
+        where.append("action = %s")
+        params.append(action)
+
+    sql = (
+        """
+        SELECT action_date, ink_name, qty, action
+        FROM ink_transactions
+        """
+        + (" WHERE " + " AND ".join(where) if where else "")
+        + " ORDER BY action_date ASC"
+    )
+    return "ink_history.csv", ["Date", "Ink Name", "Quantity", "Type"], sql, params
 
-# Overdue API
-@app.get("/api/overdue")
-@login_required
-def overdue_list():
+# name -> fn(args) returning (filename, header, sql, params); ValueError on bad args
+EXPORTS = {"entries": entries_export, "ink": ink_export}
 
-    rows = get_overdue_entries()
+def export_response(name):
+    try:
+        filename, header, sql, params = EXPORTS[name](request.args)
+    except ValueError:
+        return jsonify({"error": "Invalid filter"}), 400
 
-    return jsonify([
-        row_to_obj(r)
-        for r in rows
-    ])
+    if request.args.get("async"):
+        # ?async=1: a jobs-worker builds the file, poll /api/jobs/<id>
+        args = {k: v for k, v in request.args.items() if k != "async"}
+        return job_accepted(enqueue_job("export", {"export": name, "args": args}))
 
-            
-        
+    cur = export_cursor(f"export_{name}", sql, params)
+    return stream_csv(filename, header, cur)
 
-# ================= EXPORT =================
 @app.get("/export/entries")
 @login_required
 def export_entries():
-    conn=get_db();cur=conn.cursor()
-    cur.execute("SELECT * FROM entries");rows=cur.fetchall()
-    cur.close();conn.close()
-    si=StringIO();cw=csv.writer(si)
-    if rows:
-        cw.writerow(rows[0].keys())
-        for r in rows:cw.writerow(r.values())
-    return Response(si.getvalue(),mimetype="text/csv",
-        headers={"Content-Disposition":"attachment;filename=entries.csv"})
+    return export_response("entries")
+
 # ---------- EXPORT INK HISTORY ----------
 @app.get("/export/ink")
 @login_required
 def export_ink_history():
+    return export_response("ink")
+
+# ================= JOBS =================
+JOB_CHANNEL = "jobs"
+JOB_POLL = 5              # seconds between queue checks without a NOTIFY
+JOB_STALE_AFTER = 300     # running job without heartbeat is picked up again
+JOB_MAX_ATTEMPTS = 3
+JOB_KEEP_DAYS = int(os.environ.get("JOB_KEEP_DAYS", 7))
+
+JOB_HANDLERS = {}
+
+def job_handler(kind):
+    """
+    Register fn(job, params). It runs inside an app context (get_db()
+    works) and returns (filename, mimetype, bytes) or None.
+    """
+    def deco(fn):
+        JOB_HANDLERS[kind] = fn
+        return fn
+    return deco
+
+def enqueue_job(kind, params):
+    # own commit: the job must exist before the client starts polling
     conn = get_db()
     cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO jobs(kind, params, created_by)
+        VALUES(%s, %s, %s)
+        RETURNING id
+    """, (kind, json.dumps(params), current_user()["id"]))
+    job_id = cur.fetchone()["id"]
+    cur.execute("SELECT pg_notify(%s, %s)", (JOB_CHANNEL, str(job_id)))
+    conn.commit()
+    cur.close()
+    return job_id
+
+def job_accepted(job_id):
+    resp = jsonify({"job_id": job_id, "status_url": f"/api/jobs/{job_id}"})
+    resp.status_code = 202
+    resp.headers["Location"] = f"/api/jobs/{job_id}"
+    return resp
+
+class Job:
+    """Handle passed to job handlers for progress reporting."""
+
+    def __init__(self, ctl, row):
+        self.id = row["id"]
+        self.attempts = row["attempts"]
+        self._ctl = ctl
+        self._last = 0.0
+
+    def progress(self, done, total=None, message=None):
+        # throttled; also serves as the heartbeat
+        if time.monotonic() - self._last < 1:
+            return
+        self._last = time.monotonic()
+        cur = self._ctl.cursor()
+        cur.execute("""
+            UPDATE jobs
+            SET progress_done=%s,
+                progress_total=COALESCE(%s, progress_total),
+                message=COALESCE(%s, message),
+                heartbeat_at=now()
+            WHERE id=%s
+        """, (done, total, message, self.id))
+        cur.close()
 
+def dequeue_job(cur, worker):
     cur.execute("""
-        SELECT action_date, ink_name, qty, action
-        FROM ink_transactions
-        ORDER BY action_date ASC
-    """)
+        UPDATE jobs
+        SET status='running', attempts=attempts+1, worker=%s,
+            started_at=now(), heartbeat_at=now()
+        WHERE id = (
+            SELECT id FROM jobs
+            WHERE (status='queued' AND run_after <= now())
+               OR (status='running'
+                   AND heartbeat_at < now() - make_interval(secs => %s))
+            ORDER BY id
+            FOR UPDATE SKIP LOCKED
+            LIMIT 1
+        )
+        RETURNING id, kind, params, attempts
+    """, (worker, JOB_STALE_AFTER))
+    return cur.fetchone()
 
-    rows = cur.fetchall()
+def run_job(ctl, row, log=print):
+    cur = ctl.cursor()
+    job = Job(ctl, row)
+    try:
+        if row["attempts"] > JOB_MAX_ATTEMPTS:
+            raise RuntimeError(f"gave up after {JOB_MAX_ATTEMPTS} attempts")
+        handler = JOB_HANDLERS.get(row["kind"])
+        if handler is None:
+            raise RuntimeError(f"unknown job kind {row['kind']}")
+
+        with app.app_context():
+            result = handler(job, row["params"])
+
+        name, mimetype, data = result or (None, None, None)
+        cur.execute("""
+            UPDATE jobs
+            SET status='done', finished_at=now(), error=NULL,
+                result=%s, result_name=%s, result_type=%s,
+                progress_done=COALESCE(progress_total, progress_done)
+            WHERE id=%s
+        """, (psycopg2.Binary(data) if data is not None else None,
+              name, mimetype, job.id))
+        log(f"job {job.id} {row['kind']}: done")
+    except Exception as e:
+        retry = row["attempts"] < JOB_MAX_ATTEMPTS and not isinstance(e, RuntimeError)
+        cur.execute("""
+            UPDATE jobs
+            SET status=%s, error=%s,
+                run_after=now() + make_interval(secs => %s),
+                finished_at=CASE WHEN %s THEN NULL ELSE now() END
+            WHERE id=%s
+        """, ("queued" if retry else "failed", str(e),
+              30 * row["attempts"], retry, job.id))
+        log(f"job {job.id} {row['kind']}: {'retry' if retry else 'failed'}: {e}")
     cur.close()
-    conn.close()
 
-    si = StringIO()
-    cw = csv.writer(si)
+def run_worker(poll=JOB_POLL, once=False, log=print):
+    ctl = connect()
+    ctl.autocommit = True
+    cur = ctl.cursor()
+    cur.execute(f"LISTEN {JOB_CHANNEL}")
+    worker = f"{os.uname().nodename}:{os.getpid()}"
+    cleaned = refreshed = 0.0
+
+    while True:
+        if time.monotonic() - cleaned > 3600:
+            cur.execute("""
+                DELETE FROM jobs
+                WHERE finished_at < now() - make_interval(days => %s)
+            """, (JOB_KEEP_DAYS,))
+            cleaned = time.monotonic()
+
+        if ANALYTICS_REFRESH_EVERY and time.monotonic() - refreshed > ANALYTICS_REFRESH_EVERY:
+            refreshed = time.monotonic()
+            run_analytics_refresh(log)
+
+        row = dequeue_job(cur, worker)
+        if row is not None:
+            run_job(ctl, row, log)
+            continue
+        if once:
+            break
 
-    cw.writerow(["Date", "Ink Name", "Quantity", "Type"])
+        if select.select([ctl], [], [], poll)[0]:
+            ctl.poll()
+            ctl.notifies.clear()
 
-    for r in rows:
-        cw.writerow([
-            r["action_date"],
-            r["ink_name"],
-            r["qty"],
-            r["action"]
-        ])
+    cur.close()
+    ctl.close()
+
+def run_analytics_refresh(log=print):
+    # own connection: a failed or dropped refresh must not take the
+    # worker (and every queued job) down with it
+    conn = None
+    try:
+        conn = connect()
+        refresh_analytics(conn, log=log)
+    except Exception as e:
+        log(f"analytics refresh failed: {e}")
+    finally:
+        if conn is not None:
+            conn.close()
+
+@app.cli.command("jobs-worker")
+@click.option("--poll", default=JOB_POLL, show_default=True,
+              help="seconds between queue checks")
+@click.option("--once", is_flag=True, help="drain the queue and exit")
+def jobs_worker_command(poll, once):
+    """Run queued background jobs (exports, reports)."""
+    click.echo(f"jobs-worker: {', '.join(sorted(JOB_HANDLERS))}")
+    run_worker(poll, once, log=click.echo)
+
+@job_handler("export")
+def export_job(job, p):
+    filename, header, sql, params = EXPORTS[p["export"]](p.get("args", {}))
+
+    cur = get_db().cursor()
+    cur.execute(f"SELECT COUNT(*) n FROM ({sql}) t", params)
+    total = cur.fetchone()["n"]
+    cur.close()
+    job.progress(0, total, "exporting")
+
+    def counted(rows):
+        for n, r in enumerate(rows, 1):
+            if n % EXPORT_ITERSIZE == 0:
+                job.progress(n)
+            yield r
+
+    cur = export_cursor(f"job_{job.id}", sql, params)
+    chunks = csv_chunks(header, counted(cur))
+    if p.get("args", {}).get("gzip"):
+        data = b"".join(gzip_chunks(chunks))
+        filename, mimetype = filename + ".gz", "application/gzip"
+    else:
+        data = "".join(chunks).encode("utf-8")
+        mimetype = "text/csv"
+    cur.close()
+    return filename, mimetype, data
+
+@job_handler("whatsapp_report")
+def whatsapp_report_job(job, p):
+    kind = p.get("report", "overdue")
+    data = render_report(kind, WHATSAPP_REPORTS[kind]["rows"]())
+    return f"{kind}_report.json", "application/json", json.dumps(data).encode()
+
+def job_json(r):
+    return {
+        "id": r["id"],
+        "kind": r["kind"],
+        "status": r["status"],
+        "attempts": r["attempts"],
+        "progress": {"done": r["progress_done"], "total": r["progress_total"]},
+        "message": r["message"],
+        "error": r["error"],
+        "created_at": r["created_at"],
+        "finished_at": r["finished_at"],
+        "download_url": f"/api/jobs/{r['id']}/download" if r["has_result"] else None
+    }
+
+JOB_COLUMNS = """
+    id, kind, status, attempts, progress_done, progress_total, message,
+    error, created_at, finished_at, created_by, result IS NOT NULL has_result
+"""
+
+def fetch_job(job_id, columns=JOB_COLUMNS):
+    # own jobs only, admins see all
+    cur = get_db().cursor()
+    cur.execute(f"SELECT {columns}, created_by FROM jobs WHERE id=%s", (job_id,))
+    r = cur.fetchone()
+    cur.close()
+    if r is None or (
+        r["created_by"] != current_user()["id"] and not can("jobs.all")
+    ):
+        abort(404)
+    return r
+
+@app.post("/api/jobs")
+@login_required
+def create_job():
+    d = request.get_json(force=True)
+    if d.get("kind") not in JOB_HANDLERS:
+        return jsonify({"error": "Unknown job kind"}), 400
+    return job_accepted(enqueue_job(d["kind"], d.get("params") or {}))
+
+@app.get("/api/jobs")
+@login_required
+def list_jobs():
+    cur = get_db().cursor()
+    cur.execute(f"""
+        SELECT {JOB_COLUMNS} FROM jobs
+        WHERE created_by = %s OR %s
+        ORDER BY id DESC
+        LIMIT 50
+    """, (current_user()["id"], can("jobs.all")))
+    rows = cur.fetchall()
+    cur.close()
+    return jsonify([job_json(r) for r in rows])
+
+@app.get("/api/jobs/<int:job_id>")
+@login_required
+def job_status(job_id):
+    return jsonify(job_json(fetch_job(job_id)))
 
+@app.get("/api/jobs/<int:job_id>/download")
+@login_required
+def job_download(job_id):
+    r = fetch_job(job_id, "result, result_name, result_type")
+    if r["result"] is None:
+        return jsonify({"error": "No result yet"}), 404
     return Response(
-        si.getvalue(),
-        mimetype="text/csv",
-        headers={
-            "Content-Disposition": "attachment;filename=ink_history.csv"
-        }
+        bytes(r["result"]),
+        mimetype=r["result_type"] or "application/octet-stream",
+        headers={"Content-Disposition": f"attachment;filename={r['result_name']}"}
     )
+
 # ================= INK STOCK =================
 @app.route("/ink")
 @login_required
@@ -837,25 +4490,11 @@ def ink_page():
 
 @app.get("/api/ink")
 @login_required
+@conditional("ink")
 def ink_list():
     conn = get_db()
     cur = conn.cursor()
 
-    # tables ensure (safe)
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS ink_master(
-            id SERIAL PRIMARY KEY,
-            ink_name TEXT UNIQUE
-        )
-    """)
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS ink_stock(
-            ink_id INTEGER PRIMARY KEY,
-            qty INTEGER DEFAULT 0,
-            updated_at TEXT
-        )
-    """)
-
     # 🔧 FIXED COLUMN NAME
     cur.execute("""
         SELECT m.id,
@@ -868,72 +4507,201 @@ def ink_list():
 
     rows = cur.fetchall()
     cur.close()
-    conn.close()
     return jsonify(rows)
         
-@app.post("/api/ink/in")
-@login_required
-def ink_in():
-    d = request.get_json(force=True)
+def ink_qty(value):
+    # whole bottles only: 2.7 (or "2.7") is rejected, not truncated to 2
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        raise ValueError
+    return int(value)
+
+def apply_ink_moves(cur, moves):
+    """
+    Apply IN / SELL lines in order inside the caller's transaction.
+    Stock rows are locked once, the running quantity is tracked here, and
+    the writes go out as two execute_values() statements.
+    A sell that would take stock below zero fails; other lines still apply.
+    Returns one result dict per line.
+    """
+    results = []
+    lines = []
 
-    action_date = d.get("date") or now()
+    for n, m in enumerate(moves, 1):
+        try:
+            ink_id = int(m["id"])
+            qty = ink_qty(m["qty"])
+            action = str(m.get("action", "")).lower()
+            if qty <= 0 or action not in ("in", "sell"):
+                raise ValueError
+            when = (
+                datetime.datetime.fromisoformat(m["date"])
+                if m.get("date") else None
+            )
+        except (AttributeError, KeyError, TypeError, ValueError):
+            results.append({"line": n, "ok": False, "error": "Invalid line"})
+            continue
+        results.append({"line": n, "id": ink_id, "action": action, "qty": qty})
+        lines.append((results[-1], ink_id, qty, action, when))
 
-    conn = get_db()
-    cur = conn.cursor()
+    ids = sorted({l[1] for l in lines})
+    stock, names = {}, {}
 
-    # update stock
-    cur.execute("""
-        INSERT INTO ink_stock(ink_id,qty,updated_at)
-        VALUES(%s,%s,%s)
-        ON CONFLICT (ink_id)
-        DO UPDATE SET qty=ink_stock.qty+%s, updated_at=%s
-    """, (d["id"], d["qty"], now(), d["qty"], now()))
+    if ids:
+        cur.execute("""
+            INSERT INTO ink_stock(ink_id, qty, updated_at)
+            SELECT id, 0, now() FROM ink_master WHERE id = ANY(%s)
+            ON CONFLICT (ink_id) DO NOTHING
+        """, (ids,))
+        cur.execute("""
+            SELECT s.ink_id, s.qty, m.ink_name
+            FROM ink_stock s
+            JOIN ink_master m ON m.id = s.ink_id
+            WHERE s.ink_id = ANY(%s)
+            ORDER BY s.ink_id
+            FOR UPDATE OF s
+        """, (ids,))
+        for r in cur.fetchall():
+            stock[r["ink_id"]] = r["qty"] or 0
+            names[r["ink_id"]] = r["ink_name"]
+
+    history = []
+    for res, ink_id, qty, action, when in lines:
+        if ink_id not in stock:
+            res.update(ok=False, error="Unknown ink")
+            continue
+        if action == "sell" and stock[ink_id] < qty:
+            res.update(ok=False, error=f"Insufficient stock ({stock[ink_id]} available)")
+            continue
 
-    # save IN history
-    cur.execute("""
-        INSERT INTO ink_transactions
-        (ink_id, ink_name, qty, action, action_date)
-        SELECT id, ink_name, %s, 'IN', %s
-        FROM ink_master WHERE id=%s
-    """, (d["qty"], action_date, d["id"]))
+        stock[ink_id] += qty if action == "in" else -qty
+        res.update(ok=True, stock=stock[ink_id])
+        history.append((
+            ink_id, names[ink_id], qty, action.upper(), when or now_ist()
+        ))
+
+    if history:
+        touched = sorted({h[0] for h in history})
+        psycopg2.extras.execute_values(cur, """
+            UPDATE ink_stock s
+            SET qty = v.qty, updated_at = now()
+            FROM (VALUES %s) AS v(ink_id, qty)
+            WHERE s.ink_id = v.ink_id
+        """, [(i, stock[i]) for i in touched])
+
+        psycopg2.extras.execute_values(cur, """
+            INSERT INTO ink_transactions
+            (ink_id, ink_name, qty, action, action_date)
+            VALUES %s
+        """, history)
+
+    return results
+
+def journal_ink_moves(moves, atomic, single=False):
+    """
+    Offline: check the lines as far as possible without the database and
+    journal them. Stock is only known on replay, so a sell can still fail
+    there (it shows up as failed in /api/offline).
+    """
+    lines = []
+    for n, m in enumerate(moves, 1):
+        try:
+            line = {
+                "id": int(m["id"]),
+                "qty": ink_qty(m["qty"]),
+                "action": str(m.get("action", "")).lower(),
+                # the time it happened, not the time it syncs
+                "date": datetime.datetime.fromisoformat(m["date"]).strftime(
+                    "%Y-%m-%d %H:%M:%S"
+                ) if m.get("date") else now()
+            }
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return jsonify({"error": f"Invalid line {n}"}), 400
+        if line["qty"] <= 0 or line["action"] not in ("in", "sell"):
+            return jsonify({"error": f"Invalid line {n}"}), 400
+        lines.append(line)
+    return offline_write(
+        "ink_moves", {"moves": lines, "atomic": atomic, "single": single},
+        {"ok": True}
+    )
+
+def ink_move(action):
+    d = request.get_json(force=True)
+    if not isinstance(d, dict):
+        return jsonify({"error": "Invalid line"}), 400
+
+    try:
+        conn = get_db()
+    except DatabaseOffline:
+        return journal_ink_moves([dict(d, action=action)], atomic=True, single=True)
+    cur = conn.cursor()
+    res = apply_ink_moves(cur, [dict(d, action=action)])[0]
 
+    if not res["ok"]:
+        conn.rollback()
+        cur.close()
+        return jsonify({"error": res["error"]}), 400
+
+    bump_version(cur, "ink")
     conn.commit()
+    invalidate_cache("ink")
     cur.close()
-    conn.close()
 
-    return jsonify({"ok": True})
+    return jsonify({"ok": True, "qty": res["stock"]})
+
+@app.post("/api/ink/in")
+@login_required
+@idempotent
+def ink_in():
+    return ink_move("in")
 
 
 @app.post("/api/ink/sell")
 @login_required
+@idempotent
 def ink_sell():
-    d = request.get_json(force=True)
+    return ink_move("sell")
 
-    action_date = d.get("date") or now()
+@app.post("/api/ink/batch")
+@login_required
+@idempotent
+def ink_batch():
+    """
+    {"moves": [{"id", "qty", "action": "in"|"sell", "date"?}, ...],
+     "atomic": false}
+    One transaction for the whole list. With atomic=true any failed line
+    rolls everything back.
+    """
+    d = request.get_json(force=True)
+    moves = d.get("moves") if isinstance(d, dict) else d
+    if not isinstance(moves, list) or not moves:
+        return jsonify({"error": "moves required"}), 400
 
-    conn = get_db()
+    try:
+        conn = get_db()
+    except DatabaseOffline:
+        return journal_ink_moves(moves, atomic=bool(isinstance(d, dict) and d.get("atomic")))
     cur = conn.cursor()
+    results = apply_ink_moves(cur, moves)
+    failed = sum(1 for r in results if not r["ok"])
 
-    # reduce stock
-    cur.execute("""
-        UPDATE ink_stock
-        SET qty = qty - %s, updated_at = %s
-        WHERE ink_id = %s AND qty >= %s
-    """, (d["qty"], now(), d["id"], d["qty"]))
-
-    # save SELL history
-    cur.execute("""
-        INSERT INTO ink_transactions
-        (ink_id, ink_name, qty, action, action_date)
-        SELECT id, ink_name, %s, 'SELL', %s
-        FROM ink_master WHERE id=%s
-    """, (d["qty"], action_date, d["id"]))
-
-    conn.commit()
+    if failed and isinstance(d, dict) and d.get("atomic"):
+        conn.rollback()
+        applied = 0
+    else:
+        applied = len(results) - failed
+        if applied:
+            bump_version(cur, "ink")
+        conn.commit()
+        if applied:
+            invalidate_cache("ink")
     cur.close()
-    conn.close()
 
-    return jsonify({"ok": True})
+    return jsonify({
+        "ok": failed == 0,
+        "applied": applied,
+        "failed": failed,
+        "results": results
+    })
 
 # ---------- ADD NEW INK MODEL ----------
 @app.post("/api/ink/model")
@@ -954,9 +4722,10 @@ def add_ink_model():
         ON CONFLICT DO NOTHING
     """, (name,))
 
+    bump_version(cur, "ink")
     conn.commit()
+    invalidate_cache("ink")
     cur.close()
-    conn.close()
 
     return jsonify({"ok": True})
 
@@ -972,70 +4741,290 @@ def delete_ink(ink_id):
     # फिर master delete
     cur.execute("DELETE FROM ink_master WHERE id=%s", (ink_id,))
 
+    bump_version(cur, "ink")
     conn.commit()
+    invalidate_cache("ink")
     cur.close()
-    conn.close()
 
     return jsonify({"ok": True})
     
 # ---------------- DELETE ----------------
 @app.delete("/api/entries/<int:eid>")
 @login_required
-@admin_required
+@permission_required("entries.delete")
 def delete_entry(eid):
     conn = get_db()
     cur = conn.cursor()
-    cur.execute("DELETE FROM entries WHERE id=%s", (eid,))
+    cur.execute("""
+        WITH e AS (DELETE FROM entries WHERE id=%s RETURNING id, status)
+        INSERT INTO entry_events(entry_id, from_status, at, user_id)
+        SELECT id, status, now(), %s FROM e
+    """, (eid, current_user()["id"]))
+    bump_version(cur, "entries")
     conn.commit()
+    invalidate_cache("entries")
     cur.close()
-    conn.close()
     return jsonify({"deleted": True})
 
 # ---------------- PRINT ----------------
-@app.get("/print/<int:eid>")
-def print_receipt(eid):
+# ================= RECEIPTS =================
+SHOP = {"name": "IT SOLUTIONS", "addr": "GHATSILA COLLEGE ROAD"}
+RECEIPT_BATCH_MAX = 200
+RECEIPT_FONT = os.environ.get(
+    "RECEIPT_FONT", "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+)
+RECEIPT_FONT_BOLD = os.environ.get(
+    "RECEIPT_FONT_BOLD", "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
+)
+
+receipt_cache = TTLCache(3600, maxsize=256)
+_receipt_styles = None
+_receipt_styles_lock = threading.Lock()
+
+def receipt_styles():
+    # fonts and styles are built once per process
+    global _receipt_styles
+    with _receipt_styles_lock:
+        if _receipt_styles is None:
+            font, bold = "Helvetica", "Helvetica-Bold"
+            try:
+                pdfmetrics.registerFont(TTFont("Receipt", RECEIPT_FONT))
+                pdfmetrics.registerFont(TTFont("Receipt-Bold", RECEIPT_FONT_BOLD))
+                font, bold = "Receipt", "Receipt-Bold"
+            except Exception as e:
+                print("receipt font not loaded, using Helvetica:", e)
+
+            grid = [
+                ("FONTNAME", (0, 0), (-1, -1), font),
+                ("FONTSIZE", (0, 0), (-1, -1), 9),
+                ("GRID", (0, 0), (-1, -1), 0.5, colors.HexColor("#cccccc")),
+                ("VALIGN", (0, 0), (-1, -1), "TOP"),
+            ]
+            _receipt_styles = {
+                "title": ParagraphStyle("title", fontName=bold, fontSize=15,
+                                        alignment=TA_CENTER, leading=18),
+                "center": ParagraphStyle("center", fontName=font, fontSize=9,
+                                         alignment=TA_CENTER, leading=12),
+                "h3": ParagraphStyle("h3", fontName=bold, fontSize=11,
+                                     spaceBefore=10, spaceAfter=4),
+                "cell": ParagraphStyle("cell", fontName=font, fontSize=9, leading=11),
+                "details": TableStyle(grid + [
+                    ("FONTNAME", (0, 0), (0, -1), bold),
+                    ("FONTNAME", (2, 0), (2, -1), bold),
+                    ("SPAN", (1, 2), (3, 2)),
+                ]),
+                "bill": TableStyle(grid + [
+                    ("FONTNAME", (0, 0), (0, -1), bold),
+                    ("FONTNAME", (1, 3), (1, 3), bold),
+                    ("ALIGN", (1, 0), (1, 3), "RIGHT"),
+                ]),
+            }
+        return _receipt_styles
+
+def receipt_rows(ids):
+    # entries + the payment mode of their sale, in the order asked for
     conn = get_db()
     cur = conn.cursor()
-    cur.execute("SELECT * FROM entries WHERE id=%s", (eid,))
-    r = cur.fetchone()
+    cur.execute("""
+        SELECT e.*, s.payment_mode
+        FROM entries e
+        LEFT JOIN sales s ON s.entry_id = e.id
+        WHERE e.id = ANY(%s)
+    """, (list(ids),))
+    found = {r["id"]: r for r in cur.fetchall()}
     cur.close()
-    conn.close()
-    if not r:
-        abort(404)
 
-    return render_template("receipt.html", e=row_to_obj(r),
-        shop={"name":"IT SOLUTIONS","addr":"GHATSILA COLLEGE ROAD"}
+    out = []
+    for i in ids:
+        if i in found:
+            e = row_to_obj(found[i])
+            if e["bill"]:
+                e["bill"]["payment_mode"] = found[i]["payment_mode"]
+            out.append(e)
+    return out
+
+def receipt_flowables(e):
+    st = receipt_styles()
+    b = e["bill"] or {}
+    P = lambda v: Paragraph(escape(str(v or "")), st["cell"])
+    money = lambda v: f"{(v or 0):.2f}"
+    total = (b.get("parts_total") or 0) + (b.get("service_charge") or 0) + (b.get("other") or 0)
+
+    return [
+        Paragraph(escape(SHOP["name"]), st["title"]),
+        Paragraph(escape(SHOP["addr"]), st["center"]),
+        Spacer(1, 8),
+        Table([
+            ["Customer", P(e["customer"]), "Phone", P(e["phone"])],
+            ["Device", P(f"{e['type'] or ''} - {e['model'] or ''}"), "Status", P(e["status"])],
+            ["Problem", P(e["problem"]), "", ""],
+            ["Received On", P(e["receive_date"]), "Delivered On", P(e["return_date"])],
+        ], colWidths=[22 * mm, 40 * mm, 24 * mm, 42 * mm], style=st["details"]),
+        Paragraph("Billing", st["h3"]),
+        Table([
+            ["Parts", money(b.get("parts_total"))],
+            ["Service Charge", money(b.get("service_charge"))],
+            ["Other", money(b.get("other"))],
+            ["Total", money(total)],
+            ["Payment Mode", P(b.get("payment_mode"))],
+        ], colWidths=[40 * mm, 88 * mm], style=st["bill"]),
+        Spacer(1, 12),
+        Paragraph(escape(f"Thank you for choosing {SHOP['name']}!"), st["center"]),
+    ]
+
+def receipt_pdf(entries):
+    """
+    One A5 page per entry. Cached on the printed content itself, so an
+    edited entry (bill, status, dates) renders again and nothing else does.
+    """
+    key = hashlib.sha1(json.dumps(entries, sort_keys=True, default=str).encode()).hexdigest()
+    data = receipt_cache.get(key)
+    if data is not None:
+        return data
+
+    buf = BytesIO()
+    doc = SimpleDocTemplate(
+        buf, pagesize=A5, title="Receipt",
+        leftMargin=10 * mm, rightMargin=10 * mm, topMargin=10 * mm, bottomMargin=10 * mm
     )
+    story = []
+    for n, e in enumerate(entries):
+        if n:
+            story.append(PageBreak())
+        story += receipt_flowables(e)
+    doc.build(story)
+
+    data = buf.getvalue()
+    # no table tags: the key already changes with the entry
+    receipt_cache.set(key, data)
+    return data
+
+def pdf_response(data, filename):
+    return Response(data, mimetype="application/pdf", headers={
+        "Content-Disposition": f"inline;filename={filename}"
+    })
+
+@app.get("/print/<int:eid>")
+@login_required
+def print_receipt(eid):
+    rows = receipt_rows([eid])
+    if not rows:
+        abort(404)
+    return render_template("receipt.html", e=rows[0], shop=SHOP)
+
+@app.get("/print/<int:eid>.pdf")
+@login_required
+def print_receipt_pdf(eid):
+    rows = receipt_rows([eid])
+    if not rows:
+        abort(404)
+    return pdf_response(receipt_pdf(rows), f"receipt-{eid}.pdf")
+
+@app.get("/print/batch.pdf")
+@login_required
+def print_receipts_batch():
+    # ?ids=12,15,19 -> one PDF, one page per job, in that order
+    try:
+        ids = [int(v) for v in request.args.get("ids", "").split(",") if v.strip()]
+    except ValueError:
+        return jsonify({"error": "ids must be numbers"}), 400
+    if not ids or len(ids) > RECEIPT_BATCH_MAX:
+        return jsonify({"error": f"1 to {RECEIPT_BATCH_MAX} ids"}), 400
+
+    rows = receipt_rows(list(dict.fromkeys(ids)))
+    if not rows:
+        abort(404)
+    return pdf_response(receipt_pdf(rows), "receipts.pdf")
+
+@job_handler("receipts")
+def receipts_job(job, p):
+    # large batches through the jobs-worker: {"ids": [...]}
+    rows = receipt_rows([int(i) for i in p.get("ids", [])])
+    job.progress(0, len(rows), "rendering")
+    return "receipts.pdf", "application/pdf", receipt_pdf(rows)
 
 
 # ================= CUSTOMERS API =================
 
+CUSTOMER_SEARCH_LIMIT = 10
+customer_search_cache = TTLCache(
+    float(os.environ.get("CUSTOMER_SEARCH_CACHE_TTL", 60)), maxsize=2048
+)
+_has_trgm = None
+
+def has_trgm(cur):
+    global _has_trgm
+    if _has_trgm is None:
+        cur.execute("SELECT 1 FROM pg_extension WHERE extname='pg_trgm'")
+        _has_trgm = cur.fetchone() is not None
+    return _has_trgm
+
+def like_escape(v):
+    return v.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
 @app.get("/api/customers/search")
 @login_required
 def search_customers():
-    q = request.args.get("q", "").strip()
+    """
+    Digits -> mobile prefix match.
+    Text   -> name match, prefix hits first, then by trigram similarity.
+    """
+    q = " ".join(request.args.get("q", "").lower().split())
     if not q:
         return jsonify([])
 
-    conn = get_db()
-    cur = conn.cursor()
+    rows = customer_search_cache.get(q)
+    if rows is None:
+        conn = get_db()
+        cur = conn.cursor()
 
-    cur.execute("""
-        SELECT
-            id,
-            customer AS name,
-            phone AS mobile
-        FROM customers
-        WHERE customer ILIKE %s
-           OR phone ILIKE %s
-        ORDER BY customer
-        LIMIT 10
-    """, (f"%{q}%", f"%{q}%"))
+        digits = "".join(ch for ch in q if ch.isdigit())
+        # numbers are stored as their last 10 digits (no +91 / 0)
+        if q.startswith("+91"):
+            digits = digits[2:]
+        digits = digits.lstrip("0")
+
+        if digits and q.replace(" ", "").lstrip("+").isdigit():
+            cur.execute("""
+                SELECT id, name, mobile
+                FROM customers
+                WHERE mobile_digits LIKE %s
+                ORDER BY mobile_digits
+                LIMIT %s
+            """, (digits + "%", CUSTOMER_SEARCH_LIMIT))
+
+        elif has_trgm(cur):
+            cur.execute("""
+                SELECT id, name, mobile
+                FROM customers
+                WHERE name_norm LIKE %s
+                ORDER BY name_norm LIKE %s DESC,
+                         similarity(name_norm, %s) DESC,
+                         name_norm
+                LIMIT %s
+            """, (
+                "%" + like_escape(q) + "%",
+                like_escape(q) + "%",
+                q,
+                CUSTOMER_SEARCH_LIMIT
+            ))
 
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-    return jsonify(rows)
+        else:
+            cur.execute("""
+                SELECT id, name, mobile
+                FROM customers
+                WHERE name_norm LIKE %s
+                ORDER BY name_norm
+                LIMIT %s
+            """, (like_escape(q) + "%", CUSTOMER_SEARCH_LIMIT))
+
+        rows = cur.fetchall()
+        cur.close()
+        customer_search_cache.set(q, rows, tags=("customers",))
+
+    resp = jsonify(rows)
+    resp.headers["Cache-Control"] = "private, max-age=10"
+    return resp
  
 
 @app.post("/api/customers")
@@ -1051,57 +5040,367 @@ def add_customer():
         ON CONFLICT (mobile) DO NOTHING
     """, (d["name"], d["mobile"], d["address"]))
 
+    bump_version(cur, "customers")
     conn.commit()
+    invalidate_cache("customers")
     cur.close()
-    conn.close()
     return jsonify({"ok": True})
 
     
 
+LEDGER_PAGE_SIZE = 50
+
 @app.get("/api/ledger/<int:cid>")
 @login_required
 def get_ledger(cid):
+    """
+    Newest first, ?before=<next from the previous page>&limit=
+    Each row carries "running_balance" (balance after that row); the
+    cursor carries the balance so a page never re-sums older rows.
+    """
+    limit = max(1, min(request.args.get("limit", LEDGER_PAGE_SIZE, type=int), 500))
     conn = get_db(); cur = conn.cursor()
-    cur.execute("""
-        SELECT * FROM ledger
-        WHERE customer_id=%s
-        ORDER BY entry_date
-    """, (cid,))
+
+    before = request.args.get("before")
+    if before:
+        try:
+            b_date, b_id, running = before.split("|")
+            running = Decimal(running)
+            if not running.is_finite():
+                raise ValueError
+            b_date = datetime.date.fromisoformat(b_date)
+            b_id = int(b_id)
+        except (ValueError, ArithmeticError):
+            # ArithmeticError: decimal.InvalidOperation from Decimal("abc")
+            return jsonify({"error": "Invalid cursor"}), 400
+
+        cur.execute("""
+            SELECT * FROM ledger
+            WHERE customer_id=%s AND (entry_date, id) < (%s, %s)
+            ORDER BY entry_date DESC, id DESC
+            LIMIT %s
+        """, (cid, b_date, b_id, limit + 1))
+    else:
+        cur.execute("""
+            SELECT * FROM ledger
+            WHERE customer_id=%s
+            ORDER BY entry_date DESC, id DESC
+            LIMIT %s
+        """, (cid, limit + 1))
     rows = cur.fetchall()
 
-    cur.execute("""
-        SELECT COALESCE(SUM(cr),0)-COALESCE(SUM(dr),0) bal
-        FROM ledger WHERE customer_id=%s
-    """, (cid,))
-    bal = cur.fetchone()["bal"]
+    cur.execute(
+        "SELECT balance FROM customer_balances WHERE customer_id=%s",
+        (cid,)
+    )
+    r = cur.fetchone()
+    bal = r["balance"] if r else Decimal(0)
+    cur.close()
+
+    if not before:
+        running = bal
+
+    more = len(rows) > limit
+    rows = rows[:limit]
+    for row in rows:
+        row["running_balance"] = float(running)
+        running -= Decimal(str(row["cr"])) - Decimal(str(row["dr"]))
+
+    nxt = None
+    if more:
+        last = rows[-1]
+        nxt = f"{last['entry_date'].isoformat()}|{last['id']}|{running}"
 
-    cur.close(); conn.close()
-    return jsonify({"rows": rows, "balance": bal})
+    return jsonify({"rows": rows, "balance": float(bal), "next": nxt})
 
 @app.post("/api/ledger")
 @login_required
+@idempotent
 def add_ledger():
     d = request.get_json(force=True)
+    try:
+        customer_id = int(d["customer_id"])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"error": "customer_id required"}), 400
+    try:
+        dr = float(d.get("dr") or 0)
+        cr = float(d.get("cr") or 0)
+        if not (math.isfinite(dr) and math.isfinite(cr)):
+            raise ValueError
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid amount"}), 400
+
     conn = get_db(); cur = conn.cursor()
     cur.execute("""
         INSERT INTO ledger(customer_id, entry_date, remark, dr, cr)
         VALUES(%s, %s, %s, %s, %s)
     """, (
-        d["customer_id"],
-        d["date"],
+        customer_id,
+        d.get("date") or now_ist().date(),
         d.get("remark", ""),
-        d.get("dr", 0),
-        d.get("cr", 0)
+        dr,
+        cr
     ))
+    # balance row is updated in the same transaction
+    cur.execute("""
+        INSERT INTO customer_balances(customer_id, balance)
+        VALUES(%s, %s)
+        ON CONFLICT (customer_id) DO UPDATE
+        SET balance = customer_balances.balance + EXCLUDED.balance,
+            updated_at = now()
+        RETURNING balance
+    """, (customer_id, Decimal(str(cr)) - Decimal(str(dr))))
+    bal = cur.fetchone()["balance"]
+    bump_version(cur, "ledger")
     conn.commit()
-    cur.close(); conn.close()
-    return jsonify({"ok": True})
+    cur.close()
+    invalidate_cache("ledger")
+    return jsonify({"ok": True, "balance": float(bal)})
 
 @app.route("/ledger")
 @login_required
 def ledger_page():
     return render_template("ledger.html")
 
+# ================= ADMIN =================
+@app.get("/api/admin/db-pool")
+@login_required
+@permission_required("admin.db")
+def db_pool_stats():
+    return jsonify(get_pool().stats())
+
+INDEX_REPORT_MIN_ROWS = 1000
+
+@app.get("/api/admin/indexes")
+@login_required
+@permission_required("admin.db")
+def index_report():
+    """
+    Index usage since the last stats reset, declared INDEXES that are
+    missing, and missing-index candidates: big tables read mostly by
+    sequential scans, plus the slowest statements when
+    pg_stat_statements is installed.
+    """
+    conn = get_db()
+    cur = conn.cursor()
+
+    cur.execute("""
+        SELECT s.relname AS table, s.indexrelname AS index,
+               s.idx_scan AS scans, s.idx_tup_read AS tuples_read,
+               pg_relation_size(s.indexrelid) AS bytes,
+               i.indisunique AS unique, i.indisvalid AS valid,
+               pg_get_indexdef(s.indexrelid) AS definition
+        FROM pg_stat_user_indexes s
+        JOIN pg_index i ON i.indexrelid = s.indexrelid
+        ORDER BY s.relname, s.indexrelname
+    """)
+    indexes = cur.fetchall()
+    for r in indexes:
+        r["declared"] = r["index"] in INDEXES
+        r["unused"] = r["scans"] == 0 and not r["unique"]
+
+    cur.execute("""
+        SELECT relname AS table, n_live_tup AS rows,
+               seq_scan, seq_tup_read, COALESCE(idx_scan, 0) AS idx_scan,
+               pg_relation_size(relid) AS bytes
+        FROM pg_stat_user_tables
+        WHERE n_live_tup >= %s AND seq_scan > COALESCE(idx_scan, 0)
+        ORDER BY seq_tup_read DESC
+    """, (INDEX_REPORT_MIN_ROWS,))
+    seq_heavy = cur.fetchall()
+    for r in seq_heavy:
+        r["avg_rows_per_seq_scan"] = r["seq_tup_read"] // max(r["seq_scan"], 1)
+
+    slow = None
+    cur.execute("SELECT to_regclass('pg_stat_statements') t")
+    if cur.fetchone()["t"] is not None:
+        cur.execute("""
+            SELECT query, calls,
+                   round(mean_exec_time::numeric, 2)::float8 AS mean_ms,
+                   round(total_exec_time::numeric)::float8 AS total_ms,
+                   rows
+            FROM pg_stat_statements
+            WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
+            ORDER BY total_exec_time DESC
+            LIMIT 20
+        """)
+        slow = cur.fetchall()
+
+    cur.execute("""
+        SELECT stats_reset FROM pg_stat_database
+        WHERE datname = current_database()
+    """)
+    since = cur.fetchone()["stats_reset"]
+    cur.close()
+
+    return jsonify({
+        "stats_since": since,
+        "indexes": indexes,
+        "missing": sorted(set(INDEXES) - {r["index"] for r in indexes}),
+        "candidates": {"seq_scan_tables": seq_heavy, "slow_statements": slow}
+    })
+
+# ================= CHANGE FEED =================
+CHANGE_FEED_HEARTBEAT = 15     # seconds
+CHANGE_FEED_QUEUE = 500        # events buffered per client
+CHANGE_FEED_MAX_CLIENTS = int(os.environ.get("CHANGE_FEED_MAX_CLIENTS", 50))
+CHANGE_FEED_CACHE_TAGS = {"entries": "entries", "ink_stock": "ink", "sales": "sales"}
+
+class ChangeFeed:
+    """
+    One LISTEN connection per worker process, fanned out to every open
+    /api/changes stream. Each NOTIFY batch is turned into full rows once
+    (same shape as the list APIs) so clients patch their tables in place.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subs = set()
+        self._thread = None
+        self._pid = None
+
+    def subscribe(self):
+        q = queue.Queue(maxsize=CHANGE_FEED_QUEUE)
+        with self._lock:
+            if self._pid != os.getpid():
+                self._subs, self._thread, self._pid = set(), None, os.getpid()
+            if len(self._subs) >= CHANGE_FEED_MAX_CLIENTS:
+                return None
+            self._subs.add(q)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="change-feed", daemon=True
+                )
+                self._thread.start()
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subs.discard(q)
+
+    def publish(self, event):
+        with self._lock:
+            subs = list(self._subs)
+        for q in subs:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                # slow client: end its stream, it reconnects and reloads
+                self.unsubscribe(q)
+                with q.mutex:
+                    q.queue.clear()
+                q.put_nowait(None)
+
+    def _idle(self):
+        with self._lock:
+            if self._subs:
+                return False
+            self._thread = None
+            return True
+
+    def _run(self):
+        failures = 0
+        while not self._idle():
+            conn = None
+            try:
+                conn = connect()
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute(f"LISTEN {CHANGE_CHANNEL}")
+                if failures:
+                    # events may have been missed while disconnected
+                    self.publish({"table": "reset"})
+                failures = 0
+
+                while self._subs:
+                    if select.select([conn], [], [], CHANGE_FEED_HEARTBEAT)[0]:
+                        conn.poll()
+                        self._dispatch(cur, conn.notifies)
+                        conn.notifies.clear()
+            except (psycopg2.Error, OSError, RuntimeError) as e:
+                failures += 1
+                print("change feed:", e)
+                time.sleep(min(30, 2 ** failures))
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def _dispatch(self, cur, notifies):
+        # last op per row wins, except an insert stays an insert
+        changes = OrderedDict()
+        for n in notifies:
+            try:
+                c = json.loads(n.payload)
+            except ValueError:
+                continue
+            key = (c["table"], c["id"])
+            prev = changes.pop(key, None)
+            changes[key] = "insert" if prev == "insert" and c["op"] == "update" else c["op"]
+
+        for table in {t for t, _ in changes}:
+            invalidate_cache(CHANGE_FEED_CACHE_TAGS[table])
+
+        rows = {}
+        for table in CHANGE_FEED_TABLES:
+            ids = [i for (t, i), op in changes.items() if t == table and op != "delete"]
+            if ids:
+                rows[table] = {r["id"]: r for r in change_rows(cur, table, ids)}
+
+        for (table, rid), op in changes.items():
+            row = rows.get(table, {}).get(rid)
+            if row is None:
+                op = "delete"
+            self.publish({"table": table, "op": op, "id": rid, "row": row})
+
+def change_rows(cur, table, ids):
+    if table == "entries":
+        cur.execute("SELECT * FROM entries WHERE id = ANY(%s)", (ids,))
+        return [entry_json(r) for r in cur.fetchall()]
+    if table == "ink_stock":
+        cur.execute("""
+            SELECT m.id, m.ink_name AS model, COALESCE(s.qty,0) AS qty
+            FROM ink_master m
+            JOIN ink_stock s ON m.id = s.ink_id
+            WHERE m.id = ANY(%s)
+        """, (ids,))
+        return cur.fetchall()
+    cur.execute("SELECT * FROM sales WHERE id = ANY(%s)", (ids,))
+    return cur.fetchall()
+
+change_feed = ChangeFeed()
+
+@app.get("/api/changes")
+@login_required
+def change_stream():
+    """
+    Server-Sent Events. Event name = table (entries / ink_stock / sales),
+    data = {"op": insert|update|delete, "id", "row"}. A "reset" event
+    means events were lost and the client should reload its list.
+    """
+    q = change_feed.subscribe()
+    if q is None:
+        return jsonify({"error": "Too many live connections"}), 503
+
+    def stream():
+        try:
+            yield "retry: 3000\nevent: ready\ndata: {}\n\n"
+            while True:
+                try:
+                    ev = q.get(timeout=CHANGE_FEED_HEARTBEAT)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                if ev is None:
+                    return
+                yield f"event: {ev['table']}\ndata: {app.json.dumps(ev)}\n\n"
+        finally:
+            change_feed.unsubscribe(q)
+
+    return Response(stream(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
 
 # ================= RUN =================
 if __name__ == "__main__":
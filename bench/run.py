@@ -0,0 +1,335 @@
+"""
+Latency / throughput benchmark for the real routes.
+
+In-process, through the Flask test client (one scenario at a time):
+
+    DATABASE_URL=postgresql://... python bench/run.py --iterations 200
+
+Against a running server, N concurrent logged-in clients for D seconds:
+
+    python bench/run.py --url http://127.0.0.1:8000 --concurrency 16 \
+        --duration 60 --server-pid $(pgrep -f gunicorn | paste -sd,)
+
+Save a run with --save-baseline bench/baseline.json and compare later runs
+with --baseline bench/baseline.json; the exit status is 1 when p50/p95,
+throughput or peak RSS regress past --tolerance.
+"""
+import argparse
+import gzip
+import http.cookiejar
+import json
+import math
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TODAY = time.strftime("%Y-%m-%d 00:00:00")
+
+# name -> (weight in the HTTP mix, request builder)
+# builders get the context found at startup and return (method, path, json)
+SCENARIOS = {
+    "entries_first": (10, lambda x: ("GET", "/api/entries", None)),
+    "entries_filter": (5, lambda x: ("GET", "/api/entries?status=Received,Out&priority=Urgent", None)),
+    "entries_deep": (3, lambda x: ("GET", f"/api/entries?after_id={x['mid_id']}", None)),
+    "entries_search": (3, lambda x: ("GET", "/api/entries?q=Model%2012", None)),
+    "overdue": (5, lambda x: ("GET", "/api/overdue", None)),
+    "dashboard": (8, lambda x: ("GET", "/api/dashboard/summary", None)),
+    "dashboard_page": (2, lambda x: ("GET", "/", None)),
+    "ink_list": (5, lambda x: ("GET", "/api/ink", None)),
+    "ink_in": (2, lambda x: ("POST", "/api/ink/in", {"id": x["ink_id"], "qty": 1, "date": TODAY})),
+    "ink_sell": (2, lambda x: ("POST", "/api/ink/sell", {"id": x["ink_id"], "qty": 1, "date": TODAY})),
+    "customer_search": (5, lambda x: ("GET", "/api/customers/search?q=customer%201", None)),
+    "customer_mobile": (3, lambda x: ("GET", "/api/customers/search?q=80000", None)),
+    "activity_feed": (2, lambda x: ("GET", "/api/activity", None)),
+    "entry_timeline": (2, lambda x: ("GET", f"/api/entries/{x['mid_id']}/timeline", None)),
+    "turnaround": (1, lambda x: ("GET", "/api/activity/turnaround", None)),
+    "analytics": (2, lambda x: ("GET", "/api/analytics", None)),
+    "analytics_monthly": (1, lambda x: ("GET", "/api/analytics/turnaround?by=month,type,priority&from=2000-01-01", None)),
+    "sales_list": (3, lambda x: ("GET", "/api/sales?payment_mode=UPI", None)),
+    "sales_totals": (2, lambda x: ("GET", "/api/sales/totals?by=month&from=2000-01-01", None)),
+    "sales_bulk": (1, lambda x: ("POST", "/api/sales", {"sales": [
+        {"item": "Cable", "qty": 1, "rate": 150}, {"item": "Mouse", "qty": 2, "rate": 250}]})),
+    "export_entries": (1, lambda x: ("GET", "/export/entries", None)),
+}
+
+# ================= CLIENTS =================
+
+class TestClient:
+    """Flask test client; the app runs inside this process."""
+
+    def __init__(self):
+        sys.path.insert(0, os.path.join(HERE, ".."))
+        import app as shop
+        self.c = shop.app.test_client()
+
+    def login(self, user, password):
+        r = self.c.post("/login", data={"username": user, "password": password})
+        if r.status_code != 302:
+            raise SystemExit("login failed")
+
+    def request(self, method, path, body=None):
+        r = self.c.open(path, method=method, json=body)
+        data = r.get_data()   # drains streamed exports too
+        r.close()
+        return r.status_code, data, r.headers
+
+class HTTPClient:
+    """urllib with its own cookie jar, one per load thread."""
+
+    def __init__(self, base):
+        self.base = base.rstrip("/")
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar())
+        )
+
+    def login(self, user, password):
+        form = urllib.parse.urlencode({"username": user, "password": password}).encode()
+        status, _, _ = self.request("POST", "/login", form=form)
+        if status >= 400:
+            raise SystemExit(f"login failed ({status})")
+
+    def request(self, method, path, body=None, form=None):
+        data, headers = form, {"Accept-Encoding": "gzip"}
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+        req = urllib.request.Request(self.base + path, data=data, method=method, headers=headers)
+        try:
+            with self.opener.open(req, timeout=60) as r:
+                data = r.read()
+                if r.headers.get("Content-Encoding") == "gzip":
+                    data = gzip.decompress(data)   # like a browser would
+                return r.status, data, r.headers
+        except urllib.error.HTTPError as e:
+            return e.code, e.read(), e.headers
+        except OSError:
+            return 0, b"", {}
+
+def context(client):
+    """Ids the scenarios need, looked up through the API itself."""
+    _, data, _ = client.request("GET", "/api/entries?limit=1")
+    rows = json.loads(data or "[]")
+    _, data, _ = client.request("GET", "/api/ink")
+    inks = json.loads(data or "[]")
+    bench = [i for i in inks if i["model"].startswith("Bench Ink")] or inks
+    return {
+        "mid_id": rows[0]["id"] // 2 if rows else 1,
+        "ink_id": bench[0]["id"] if bench else 0,
+    }
+
+# ================= STATS =================
+
+def percentile(sorted_ms, p):
+    # nearest rank
+    if not sorted_ms:
+        return 0.0
+    return sorted_ms[max(0, math.ceil(p / 100 * len(sorted_ms)) - 1)]
+
+def summarize(samples, seconds):
+    """samples: [(latency_s, status)]"""
+    ms = sorted(s * 1000 for s, _ in samples)
+    return {
+        "n": len(ms),
+        "errors": sum(1 for _, st in samples if st == 0 or st >= 400),
+        "p50_ms": round(percentile(ms, 50), 2),
+        "p95_ms": round(percentile(ms, 95), 2),
+        "p99_ms": round(percentile(ms, 99), 2),
+        "mean_ms": round(sum(ms) / len(ms), 2) if ms else 0.0,
+        "rps": round(len(ms) / seconds, 1) if seconds else 0.0,
+    }
+
+def peak_rss_mb(pids):
+    """VmHWM of the server processes, or this process when pids is empty."""
+    if not pids:
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return round(total / 1024, 1)
+
+# ================= RUNNERS =================
+
+def timed(client, name, ctx):
+    method, path, body = SCENARIOS[name][1](ctx)
+    t = time.perf_counter()
+    status, _, _ = client.request(method, path, body)
+    return time.perf_counter() - t, status
+
+def run_inprocess(a, names):
+    client = TestClient()
+    client.login(a.user, a.password)
+    ctx = context(client)
+
+    out = {}
+    for name in names:
+        for _ in range(a.warmup):
+            timed(client, name, ctx)
+        samples = []
+        t0 = time.perf_counter()
+        for _ in range(a.iterations):
+            samples.append(timed(client, name, ctx))
+        out[name] = summarize(samples, time.perf_counter() - t0)
+        print_row(name, out[name])
+    return out, None
+
+def run_http(a, names):
+    setup = HTTPClient(a.url)
+    setup.login(a.user, a.password)
+    ctx = context(setup)
+    weights = [SCENARIOS[n][0] for n in names]
+
+    samples = {n: [] for n in names}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + a.warmup_s + a.duration
+    measure_from = time.perf_counter() + a.warmup_s
+
+    def worker(i):
+        rnd = random.Random(a.seed + i)
+        client = HTTPClient(a.url)
+        client.login(a.user, a.password)
+        mine = []
+        while True:
+            start = time.perf_counter()
+            if start >= deadline:
+                break
+            name = rnd.choices(names, weights)[0]
+            lat, status = timed(client, name, ctx)
+            if start >= measure_from:
+                mine.append((name, lat, status))
+        with lock:
+            for name, lat, status in mine:
+                samples[name].append((lat, status))
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(a.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    out = {}
+    for name in names:
+        if samples[name]:
+            out[name] = summarize(samples[name], a.duration)
+            print_row(name, out[name])
+    everything = [s for rows in samples.values() for s in rows]
+    return out, summarize(everything, a.duration)
+
+# ================= REPORT =================
+
+HEADER = f"{'scenario':<18}{'n':>7}{'err':>5}{'p50':>9}{'p95':>9}{'p99':>9}{'req/s':>9}"
+
+def print_row(name, s):
+    print(f"{name:<18}{s['n']:>7}{s['errors']:>5}"
+          f"{s['p50_ms']:>9.1f}{s['p95_ms']:>9.1f}{s['p99_ms']:>9.1f}{s['rps']:>9.1f}")
+
+def compare(result, base, tolerance, min_delta_ms):
+    """Print deltas against a saved run; returns the list of regressions."""
+    bad = []
+
+    def check(label, old, new, higher_is_worse=True, floor=0.0):
+        if not old:
+            return
+        delta = (new - old) / old
+        worse = delta > tolerance if higher_is_worse else -delta > tolerance
+        if worse and abs(new - old) >= floor:
+            bad.append(label)
+            mark = "  REGRESSION"
+        else:
+            mark = ""
+        print(f"  {label:<28}{old:>10.1f} -> {new:>10.1f}  {delta:+7.1%}{mark}")
+
+    print(f"\nvs baseline ({base.get('mode')}, {base.get('when')}):")
+    for name, s in result["scenarios"].items():
+        old = base["scenarios"].get(name)
+        if not old:
+            continue
+        check(f"{name} p50 ms", old["p50_ms"], s["p50_ms"], floor=min_delta_ms)
+        check(f"{name} p95 ms", old["p95_ms"], s["p95_ms"], floor=min_delta_ms)
+    if result.get("total") and base.get("total"):
+        check("total req/s", base["total"]["rps"], result["total"]["rps"], higher_is_worse=False)
+    check("peak RSS MB", base.get("peak_rss_mb"), result["peak_rss_mb"])
+    return bad
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--url", help="benchmark a running server over HTTP instead of in-process")
+    ap.add_argument("--user", default="admin")
+    ap.add_argument("--password", default="admin@123")
+    ap.add_argument("--only", help="comma separated scenario names")
+    ap.add_argument("--iterations", type=int, default=100, help="in-process: requests per scenario")
+    ap.add_argument("--warmup", type=int, default=5, help="in-process: unmeasured requests per scenario")
+    ap.add_argument("--concurrency", type=int, default=8, help="HTTP: parallel clients")
+    ap.add_argument("--duration", type=float, default=30, help="HTTP: measured seconds")
+    ap.add_argument("--warmup-s", type=float, default=3, help="HTTP: unmeasured seconds first")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--server-pid", default="", help="HTTP: comma separated pids for peak RSS")
+    ap.add_argument("--out", help="write the result JSON here")
+    ap.add_argument("--save-baseline", metavar="PATH")
+    ap.add_argument("--baseline", metavar="PATH")
+    ap.add_argument("--tolerance", type=float, default=0.20, help="allowed slowdown, 0.20 = 20%%")
+    ap.add_argument("--min-delta-ms", type=float, default=2.0,
+                    help="ignore latency changes smaller than this")
+    a = ap.parse_args()
+
+    names = list(SCENARIOS)
+    if a.only:
+        names = [n.strip() for n in a.only.split(",") if n.strip()]
+        unknown = set(names) - set(SCENARIOS)
+        if unknown:
+            raise SystemExit("unknown scenario: " + ", ".join(sorted(unknown)))
+
+    mode = "http" if a.url else "inprocess"
+    print(HEADER)
+    if a.url:
+        scenarios, total = run_http(a, names)
+        pids = [int(p) for p in a.server_pid.split(",") if p.strip()]
+    else:
+        scenarios, total = run_inprocess(a, names)
+        pids = []
+
+    result = {
+        "mode": mode,
+        "when": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "args": {k: v for k, v in vars(a).items()
+                 if k in ("url", "iterations", "concurrency", "duration")},
+        "scenarios": scenarios,
+        "total": total,
+        "peak_rss_mb": peak_rss_mb(pids),
+    }
+    if total:
+        print("-" * len(HEADER))
+        print_row("total", total)
+    print(f"peak RSS: {result['peak_rss_mb']} MB"
+          + (" (server)" if pids else " (this process)"))
+
+    for path in filter(None, (a.out, a.save_baseline)):
+        with open(path, "w") as f:
+            json.dump(result, f, indent=2)
+        print("saved", path)
+
+    if a.baseline:
+        with open(a.baseline) as f:
+            base = json.load(f)
+        if base.get("mode") != mode:
+            print(f"warning: baseline was a {base.get('mode')} run")
+        bad = compare(result, base, a.tolerance, a.min_delta_ms)
+        if bad:
+            print(f"\n{len(bad)} regression(s)")
+            sys.exit(1)
+        print("\nno regressions")
+
+if __name__ == "__main__":
+    main()
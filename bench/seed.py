@@ -0,0 +1,230 @@
+"""
+Fill a local PostgreSQL with synthetic shop data for benchmarking.
+
+    DATABASE_URL=postgresql://... DB_SSLMODE=disable \
+        python bench/seed.py --entries 200000 --sales 50000 --reset
+
+Rows are generated inside PostgreSQL (generate_series), so a few hundred
+thousand entries take seconds. Never point this at the live database:
+--reset truncates every business table.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import psycopg2
+from werkzeug.security import generate_password_hash
+
+import app as shop
+
+BUSINESS_TABLES = (
+    "entries", "entry_events", "sales", "sales_daily", "customers", "ledger",
+    "customer_balances", "ink_master", "ink_stock", "ink_transactions",
+    "jobs", "idempotency_keys"
+)
+
+def seed_entries(cur, n, customers):
+    # status mix roughly like the shop: most jobs delivered, some open
+    cur.execute("""
+        WITH g AS (
+            SELECT i, random() r, random() q,
+                   now() - random() * interval '365 days' recv
+            FROM generate_series(1, %(n)s) i
+        ), h AS (
+            SELECT *, CASE
+                WHEN q < .60 THEN 'Delivered'
+                WHEN q < .75 THEN 'Received'
+                WHEN q < .83 THEN 'Out'
+                WHEN q < .88 THEN 'In'
+                WHEN q < .95 THEN 'Ready'
+                ELSE 'Rejected' END st
+            FROM g
+        )
+        INSERT INTO entries(
+            type, customer, phone, model, problem, priority,
+            receive_date, out_date, in_date, ready_date, return_date,
+            reject_date, status, bill_parts, bill_service, bill_other, billed_at
+        )
+        SELECT
+            (ARRAY['Laptop','Desktop','Printer','Mobile','Monitor'])[1 + i %% 5],
+            'Customer ' || (i %% %(customers)s),
+            (9000000000 + (i::bigint * 7919) %% 999999999)::text,
+            'Model ' || (i %% 300),
+            (ARRAY['No power','Screen issue','Slow','Keyboard','Battery'])[1 + i %% 5],
+            CASE WHEN r < .10 THEN 'Urgent' WHEN r < .15 THEN 'Rework' ELSE 'Regular' END,
+            recv,
+            CASE WHEN st IN ('Out','In','Delivered') THEN recv + interval '1 day' END,
+            CASE WHEN st IN ('In','Delivered') THEN recv + interval '3 days' END,
+            CASE WHEN st IN ('Ready','Delivered') THEN recv + interval '4 days' END,
+            CASE WHEN st = 'Delivered' THEN recv + interval '5 days' END,
+            CASE WHEN st = 'Rejected' THEN recv + interval '2 days' END,
+            st,
+            CASE WHEN st = 'Delivered' THEN round((r * 2000)::numeric, 2) END,
+            CASE WHEN st = 'Delivered' THEN 300 + (i %% 5) * 50 END,
+            CASE WHEN st = 'Delivered' THEN 0 END,
+            CASE WHEN st = 'Delivered' THEN recv + interval '5 days' END
+        FROM h
+        RETURNING id
+    """, {"n": n, "customers": max(customers, 1)})
+    ids = [r["id"] for r in cur.fetchall()]
+    return min(ids) if ids else None
+
+def seed_history(cur, first_entry_id):
+    # entry_events rebuilt from the date columns, as migration 12 does
+    if first_entry_id is not None:
+        shop.backfill_entry_events(cur, first_entry_id)
+    return first_entry_id
+
+def seed_sales(cur, first_entry_id, walk_in):
+    if first_entry_id is not None:
+        cur.execute("""
+            INSERT INTO sales(entry_id, sale_date, item, qty, rate, amount, payment_mode, note)
+            SELECT id, billed_at, 'Service', 1, bill_total, bill_total,
+                   (ARRAY['Cash','UPI','Card'])[1 + id %% 3], 'Entry ' || id
+            FROM entries
+            WHERE id >= %s AND billed_at IS NOT NULL
+        """, (first_entry_id,))
+    cur.execute("""
+        INSERT INTO sales(sale_date, item, qty, rate, amount, payment_mode, note)
+        SELECT now() - random() * interval '365 days',
+               (ARRAY['Cable','Mouse','Ink','Keyboard','Charger'])[1 + i %% 5],
+               1 + i %% 3, 150, 150 * (1 + i %% 3),
+               (ARRAY['Cash','UPI','Card'])[1 + i %% 3], 'walk-in'
+        FROM generate_series(1, %s) i
+    """, (walk_in,))
+
+def seed_customers(cur, n):
+    cur.execute("SELECT COALESCE(MAX(id), 0) m FROM customers")
+    start = cur.fetchone()["m"]
+    cur.execute("""
+        INSERT INTO customers(name, mobile, address)
+        SELECT 'Customer ' || i, '8' || lpad((%s + i)::text, 9, '0'), 'Ghatsila'
+        FROM generate_series(1, %s) i
+        ON CONFLICT (mobile) DO NOTHING
+    """, (start, n))
+
+def seed_ledger(cur, n):
+    cur.execute("SELECT MIN(id) lo, MAX(id) hi FROM customers")
+    r = cur.fetchone()
+    if r["lo"] is None or not n:
+        return
+    cur.execute("""
+        INSERT INTO ledger(customer_id, entry_date, remark, dr, cr)
+        SELECT c.id, (now() - random() * interval '365 days')::date,
+               CASE WHEN i %% 2 = 0 THEN 'Repair' ELSE 'Payment' END,
+               CASE WHEN i %% 2 = 0 THEN 500 ELSE 0 END,
+               CASE WHEN i %% 2 = 1 THEN 450 ELSE 0 END
+        FROM generate_series(1, %s) i
+        JOIN customers c ON c.id = %s + (i::bigint * 7919) %% (%s - %s + 1)
+    """, (n, r["lo"], r["hi"], r["lo"]))
+
+def seed_ink(cur, models, tx):
+    cur.execute("""
+        INSERT INTO ink_master(ink_name)
+        SELECT 'Bench Ink ' || i FROM generate_series(1, %s) i
+        ON CONFLICT DO NOTHING
+    """, (models,))
+    # plenty of stock so the load test's sells succeed
+    cur.execute("""
+        INSERT INTO ink_stock(ink_id, qty, updated_at)
+        SELECT id, 100000, now() FROM ink_master WHERE ink_name LIKE 'Bench Ink %%'
+        ON CONFLICT (ink_id) DO UPDATE SET qty = 100000
+    """)
+    cur.execute("""
+        INSERT INTO ink_transactions(ink_id, ink_name, qty, action, action_date)
+        SELECT m.id, m.ink_name, 1 + i %% 4,
+               CASE WHEN i %% 3 = 0 THEN 'IN' ELSE 'SELL' END,
+               now() - random() * interval '365 days'
+        FROM generate_series(1, %s) i
+        JOIN ink_master m ON m.ink_name = 'Bench Ink ' || (1 + i %% %s)
+    """, (tx, max(models, 1)))
+
+def rebuild_rollups(cur):
+    # same statements as migrations 5 and 9
+    cur.execute("TRUNCATE customer_balances, sales_daily")
+    cur.execute("""
+        INSERT INTO customer_balances(customer_id, balance)
+        SELECT customer_id, COALESCE(SUM(cr),0) - COALESCE(SUM(dr),0)
+        FROM ledger WHERE customer_id IS NOT NULL
+        GROUP BY customer_id
+    """)
+    cur.execute("""
+        INSERT INTO sales_daily(day, payment_mode, amount, sale_count)
+        SELECT (sale_date AT TIME ZONE 'Asia/Kolkata')::date,
+               COALESCE(payment_mode, ''), COALESCE(SUM(amount), 0), COUNT(*)
+        FROM sales WHERE sale_date IS NOT NULL
+        GROUP BY 1, 2
+    """)
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--entries", type=int, default=100000)
+    ap.add_argument("--sales", type=int, default=50000, help="walk-in sales (billed jobs add their own)")
+    ap.add_argument("--customers", type=int, default=20000)
+    ap.add_argument("--ledger", type=int, default=100000)
+    ap.add_argument("--ink-models", type=int, default=40)
+    ap.add_argument("--ink-tx", type=int, default=50000)
+    ap.add_argument("--seed", type=float, default=0.42, help="random seed (-1..1)")
+    ap.add_argument("--admin-password", default="admin@123")
+    ap.add_argument("--reset", action="store_true", help="truncate business tables first")
+    a = ap.parse_args()
+
+    # bulk statements are slow by design; keep the slow-query log quiet
+    shop.app.logger.setLevel("ERROR")
+    conn = shop.connect()
+    shop.migrate(conn)
+    cur = conn.cursor()
+    print("seeding", conn.dsn)
+    t0 = time.perf_counter()
+
+    # skip the per-row triggers (NOTIFY, rollup) when allowed; rollups
+    # are rebuilt below either way
+    cur.execute("SAVEPOINT replica")
+    try:
+        cur.execute("SET LOCAL session_replication_role = replica")
+        cur.execute("RELEASE SAVEPOINT replica")
+    except psycopg2.Error:
+        cur.execute("ROLLBACK TO SAVEPOINT replica")
+        print("not superuser: triggers stay on (slower)")
+
+    cur.execute("SELECT setseed(%s)", (a.seed,))
+    if a.reset:
+        cur.execute(f"TRUNCATE {', '.join(BUSINESS_TABLES)} RESTART IDENTITY CASCADE")
+
+    cur.execute("SELECT COUNT(*) n FROM users")
+    if cur.fetchone()["n"] == 0:
+        cur.execute(
+            "INSERT INTO users(username,password_hash,role) VALUES('admin',%s,'admin')",
+            (generate_password_hash(a.admin_password),)
+        )
+
+    steps = (
+        ("customers", lambda: seed_customers(cur, a.customers)),
+        ("entries + history + billed sales", lambda: seed_sales(
+            cur, seed_history(cur, seed_entries(cur, a.entries, a.customers)), a.sales)),
+        ("ledger", lambda: seed_ledger(cur, a.ledger)),
+        ("ink", lambda: seed_ink(cur, a.ink_models, a.ink_tx)),
+        ("rollups", lambda: rebuild_rollups(cur)),
+    )
+    for name, fn in steps:
+        t = time.perf_counter()
+        fn()
+        print(f"  {name}: {time.perf_counter() - t:.1f}s")
+
+    shop.bump_version(cur, "entries", "sales", "ink", "customers", "ledger")
+    conn.commit()
+
+    conn.autocommit = True
+    cur.execute("ANALYZE")
+    shop.refresh_analytics(conn, force=True, log=lambda m: print(" ", m))
+    for t in ("entries", "entry_events", "sales", "customers", "ledger", "ink_transactions"):
+        cur.execute(f"SELECT COUNT(*) n FROM {t}")
+        print(f"  {t}: {cur.fetchone()['n']} rows")
+    print(f"done in {time.perf_counter() - t0:.1f}s")
+    conn.close()
+
+if __name__ == "__main__":
+    main()